@@ -0,0 +1,277 @@
+import os
+import time
+import socket
+import signal
+import asyncio
+import logging
+import multiprocessing
+from protocol import (Frame, ProtocolError, read_frame_async, write_frame_async, OP_CHUNK, OP_HELLO, OP_CHOKED,
+                      CHUNK_OPCODES)
+from server import handle_frame, handle_hello, compress_response, resolve_chunks, record_request, IDLE_TIMEOUT
+from metrics import server_sessions
+from chunk_cache import ChunkCache
+from upload_limiter import UploadLimiter
+from log_utils import setup_logging, reset_logging_after_fork
+
+# Set up logging to display info and error messages
+setup_logging()
+
+# Default number of pending connections the kernel queues before we accept them
+DEFAULT_BACKLOG = 1024
+
+# Default maximum number of client sessions served at once (per worker)
+MAX_SESSIONS = 10000
+
+# Bytes queued on a session's transport before writes wait for the client to catch up
+WRITE_BUFFER_HIGH = 1024 * 1024
+
+# Seconds to let active sessions finish their current request during shutdown
+SHUTDOWN_GRACE_PERIOD = 5
+
+
+# Chunk server that runs every client session on a single asyncio event loop.
+# It speaks the same protocol and serves the same file_chunks as server.start_server,
+# but an idle session only costs a small coroutine instead of a whole thread.
+# Chunks are compressed on a worker thread, so compressing a large chunk doesn't hold up other sessions,
+# and a session waiting for the upload limits to let a chunk go out only sleeps its own coroutine.
+class AsyncChunkServer:
+    def __init__(self, file_chunks, max_sessions=MAX_SESSIONS, idle_timeout=IDLE_TIMEOUT, manifest=None, cache=None,
+                 compression=None, limiter=None):
+        self.file_chunks = file_chunks
+        self.manifest = manifest  # Precomputed chunk digests
+        self.cache = cache  # ChunkCache to serve hot chunks from (None to read the chunk source directly)
+        self.compression = compression  # Compression algorithms clients may ask for (None for any installed one)
+        self.limiter = limiter  # UploadLimiter shaping what is sent to clients (None for no limits)
+        self.max_sessions = max_sessions
+        self.idle_timeout = idle_timeout
+        self.sessions = set()
+        self.busy_sessions = set()  # Sessions in the middle of answering a request
+        self._server = None
+        self._stopping = None
+        self._loop = None
+
+    # Function to serve one client session until it disconnects, idles out or the server stops
+    async def _handle_session(self, reader, writer):
+        addr = writer.get_extra_info('peername')
+
+        # Refuse sessions beyond the limit instead of letting them pile up
+        if len(self.sessions) >= self.max_sessions:
+            logging.warning("Rejecting connection from %s: %s sessions already active", addr, self.max_sessions)
+            writer.close()
+            return
+
+        task = asyncio.current_task()
+        self.sessions.add(task)
+        server_sessions.inc()
+        writer.transport.set_write_buffer_limits(high=WRITE_BUFFER_HIGH)
+        session_compression = None
+        session = self.limiter.open_session(addr) if self.limiter is not None and addr else None
+
+        try:
+            while not self._stopping.is_set():
+                # Wait for the next request frame (None once the client hangs up)
+                request = await asyncio.wait_for(read_frame_async(reader), self.idle_timeout)
+                if request is None:
+                    break
+                self.busy_sessions.add(task)
+
+                # Build the response(s) and tag them with the request id so the client can match them
+                start_time = time.monotonic()
+                served_chunks = sent_bytes = 0
+                if request.opcode == OP_HELLO:
+                    response, session_compression = handle_hello(request, self.compression)
+                    if session is not None:
+                        self.limiter.identify(session, request.chunk_index)
+                    write_frame_async(writer, response.opcode, payload=response.payload, request_id=request.request_id)
+                    await writer.drain()
+                    record_request(request, start_time, 0, len(response.payload))
+                    self.busy_sessions.discard(task)
+                    continue
+
+                chunks, responses = await self._loop.run_in_executor(None, self._build_responses, request)
+                for response in responses:
+                    # A peer without an upload slot is told to ask again later
+                    if response.opcode == OP_CHUNK and session is not None and self.limiter.choked(session):
+                        response = Frame(OP_CHOKED, response.chunk_index)
+                    if session_compression and response.opcode == OP_CHUNK:
+                        response = await self._loop.run_in_executor(None, compress_response, response, chunks,
+                                                                    session_compression)
+                    if session is not None and response.opcode in CHUNK_OPCODES:
+                        await self.limiter.acquire_async(session, len(response.payload))
+                    served_chunks += response.opcode in CHUNK_OPCODES
+                    if response.opcode == OP_CHUNK and hasattr(chunks, 'chunk_location'):
+                        # Chunks from a file-backed store go out with sendfile() instead of being copied
+                        file, offset, length = chunks.chunk_location(response.chunk_index)
+                        write_frame_async(writer, response.opcode, response.chunk_index, b'',
+                                          response.digest, request.request_id, length, response.hash_id)
+                        await writer.drain()
+                        if length:
+                            await self._loop.sendfile(writer.transport, file, offset, length)
+                        sent_bytes += length
+                    else:
+                        write_frame_async(writer, response.opcode, response.chunk_index, response.payload,
+                                          response.digest, request.request_id, hash_id=response.hash_id)
+                        sent_bytes += len(response.payload)
+
+                        # Wait here while the client is slow to read, so a slow reader can't make us buffer unbounded data
+                        await writer.drain()
+                record_request(request, start_time, served_chunks, sent_bytes)
+                self.busy_sessions.discard(task)
+
+        except asyncio.TimeoutError:
+            logging.info("Closing idle client session %s.", addr)
+
+        except asyncio.CancelledError:
+            pass
+
+        except ProtocolError as e:
+            logging.error("Protocol error from %s: %s", addr, e)
+
+        except (ConnectionError, OSError) as e:
+            logging.error("Socket error: %s", e)
+
+        except Exception as e:
+            logging.error("Error handling client request: %s", e)
+
+        finally:
+            server_sessions.dec()
+            if session is not None:
+                self.limiter.close_session(session)
+            self.sessions.discard(task)
+            self.busy_sessions.discard(task)
+            writer.close()
+
+    # Function to find the chunks a request refers to and build its responses (all of a batch's at once;
+    # they are views of the chunks rather than copies). It runs on a worker thread: reading a chunk can
+    # page in part of a memory-mapped file, and a digest in an algorithm other than the manifest's means
+    # hashing the whole chunk, which would hold up every session on the event loop.
+    def _build_responses(self, request):
+        chunks, chunk_manifest = resolve_chunks(request, self.file_chunks, self.manifest, self.cache)
+        return chunks, list(handle_frame(request, chunks, chunk_manifest))
+
+    # Function to accept clients on the given port until stop() is called
+    # (`ready`, if given, is a threading.Event set once the server is accepting connections)
+    async def serve(self, port, host='0.0.0.0', backlog=DEFAULT_BACKLOG, reuse_port=False, ready=None):
+        self._loop = asyncio.get_running_loop()
+        self._stopping = asyncio.Event()
+        self._server = await asyncio.start_server(self._handle_session, host, port,
+                                                  backlog=backlog, reuse_port=reuse_port)
+        logging.info("Async server listening on port %s (pid %s)...", port, os.getpid())
+        if ready is not None:
+            ready.set()
+
+        # Shut down gracefully on SIGINT/SIGTERM when running on the main thread
+        try:
+            for sig in (signal.SIGINT, signal.SIGTERM):
+                self._loop.add_signal_handler(sig, self.stop)
+        except (NotImplementedError, RuntimeError, ValueError):
+            pass
+
+        try:
+            await self._stopping.wait()
+        finally:
+            await self._shutdown()
+
+    # Function to ask the server to stop (safe to call from any thread)
+    def stop(self):
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._stopping.set)
+
+    # Function to stop accepting, close idle sessions, and give busy ones time to finish
+    async def _shutdown(self):
+        self._server.close()
+
+        # Idle sessions are just waiting for a request, so they can be closed right away
+        idle = self.sessions - self.busy_sessions
+        for task in idle:
+            task.cancel()
+
+        if self.busy_sessions:
+            logging.info("Waiting for %s sessions to finish...", len(self.busy_sessions))
+            _, pending = await asyncio.wait(list(self.busy_sessions), timeout=SHUTDOWN_GRACE_PERIOD)
+            for task in pending:
+                task.cancel()
+            idle |= pending
+
+        await asyncio.gather(*idle, return_exceptions=True)
+        await self._server.wait_closed()
+
+        logging.info("Async server has been shut down.")
+
+
+# Function to run one event loop serving the file chunks
+def _run_worker(port, file_chunks, backlog, max_sessions, idle_timeout, reuse_port, manifest, cache=None,
+                compression=None, limiter=None):
+    server = AsyncChunkServer(file_chunks, max_sessions, idle_timeout, manifest, cache, compression, limiter)
+    asyncio.run(server.serve(port, backlog=backlog, reuse_port=reuse_port))
+
+
+# Function to run an event loop in a worker process of its own
+def _run_worker_process(*args):
+    reset_logging_after_fork()
+    _run_worker(*args)
+
+
+# Function to give one worker process its share of the cache and the upload limits.
+# Worker processes can't share a ChunkCache or an UploadLimiter, so each gets a fresh one with
+# 1/workers of the memory budget, of the total and per-peer rates and of the upload slots (peer
+# weights are kept as they are), and the workers together stay within the limits asked for.
+# The split is static: a worker that gets fewer connections doesn't lend its bandwidth to the others.
+def _worker_share(cache, limiter, workers):
+    if cache is not None:
+        cache = ChunkCache(max(1, cache.max_bytes // workers), cache.read_ahead)
+    if limiter is not None:
+        share = UploadLimiter(limiter.bucket.rate and limiter.bucket.rate / workers,
+                              limiter.peer_rate and limiter.peer_rate / workers,
+                              limiter.upload_slots and max(1, limiter.upload_slots // workers),
+                              limiter.burst_seconds, limiter.peer_key)
+        share.peer_rates = {host: rate and rate / workers for host, rate in limiter.peer_rates.items()}
+        share.weights = dict(limiter.weights)
+        limiter = share
+    return cache, limiter
+
+
+# Function to start the asyncio server, with one event loop per worker process.
+# With more than one worker the processes share the port through SO_REUSEPORT and
+# the kernel spreads incoming connections between them; the cache and upload limits
+# are then split between the workers (see _worker_share).
+def start_async_server(port, file_chunks, workers=1, backlog=DEFAULT_BACKLOG,
+                       max_sessions=MAX_SESSIONS, idle_timeout=IDLE_TIMEOUT, manifest=None, cache=None,
+                       compression=None, limiter=None):
+    if workers is None:
+        workers = os.cpu_count() or 1
+
+    # SO_REUSEPORT is required for several processes to listen on one port
+    if workers > 1 and not hasattr(socket, 'SO_REUSEPORT'):
+        logging.warning("SO_REUSEPORT is not available; running a single worker.")
+        workers = 1
+
+    if workers == 1:
+        _run_worker(port, file_chunks, backlog, max_sessions, idle_timeout, False, manifest, cache, compression,
+                    limiter)
+        return
+
+    cache, limiter = _worker_share(cache, limiter, workers)
+    processes = [
+        multiprocessing.Process(target=_run_worker_process, daemon=True,
+                                args=(port, file_chunks, backlog, max_sessions, idle_timeout, True, manifest,
+                                      cache, compression, limiter))
+        for _ in range(workers)
+    ]
+    for process in processes:
+        process.start()
+    logging.info("Started %s async server workers on port %s.", workers, port)
+
+    try:
+        for process in processes:
+            process.join()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        # Ask every worker to shut down gracefully
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+        for process in processes:
+            process.join()
+        logging.info("Server has been shut down.")
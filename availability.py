@@ -0,0 +1,101 @@
+import threading
+
+
+# Function to build a bitfield (one bit per chunk, most significant bit first) from chunk indices
+def bitfield_from_chunks(chunk_indices, total_chunks):
+    bitfield = bytearray((total_chunks + 7) // 8)
+    for chunk_index in chunk_indices:
+        if 0 <= chunk_index < total_chunks:
+            bitfield[chunk_index >> 3] |= 0x80 >> (chunk_index & 7)
+    return bytes(bitfield)
+
+
+# Function to list the chunk indices set in a bitfield
+def chunks_from_bitfield(bitfield, total_chunks):
+    return [i for i in range(min(total_chunks, len(bitfield) * 8)) if bitfield[i >> 3] & (0x80 >> (i & 7))]
+
+
+# Function to build a bitfield with every chunk set
+def full_bitfield(total_chunks):
+    return bitfield_from_chunks(range(total_chunks), total_chunks)
+
+
+# Inverted chunk-availability index: for every chunk, the set of peers that have it.
+# Each peer gets a bit position and each chunk keeps an integer bitset of its peers, so
+# "who has chunk i", "how rare is chunk i" and "does peer p have chunk i" are O(1)
+# lookups instead of scans over every peer's chunk list. Dropped peers are masked out
+# rather than cleared from every chunk.
+class AvailabilityIndex:
+    def __init__(self, total_chunks):
+        self.total_chunks = total_chunks
+        self.chunk_peers = [0] * total_chunks  # Bitset of peer bits per chunk
+        self.peer_bits = {}  # Maps peer name -> bit position
+        self.peer_names = []  # Maps bit position -> peer name
+        self.live_mask = 0  # Bits of peers that haven't been dropped
+        self._lock = threading.Lock()
+
+    # Function to return a peer's bit, registering the peer if it is new
+    def _bit(self, name):
+        bit = self.peer_bits.get(name)
+        if bit is None:
+            bit = self.peer_bits[name] = len(self.peer_names)
+            self.peer_names.append(name)
+        self.live_mask |= 1 << bit
+        return bit
+
+    # Function to record that a peer has the given chunks
+    def add_chunks(self, name, chunk_indices):
+        with self._lock:
+            flag = 1 << self._bit(name)
+            for chunk_index in chunk_indices:
+                if 0 <= chunk_index < self.total_chunks:
+                    self.chunk_peers[chunk_index] |= flag
+
+    # Function to record a peer's full bitfield
+    def set_bitfield(self, name, bitfield):
+        self.add_chunks(name, chunks_from_bitfield(bitfield, self.total_chunks))
+
+    # Function to record a single HAVE announcement
+    def have(self, name, chunk_index):
+        self.add_chunks(name, (chunk_index,))
+
+    # Function to record that a peer turned out not to have a chunk
+    def remove_chunk(self, name, chunk_index):
+        with self._lock:
+            bit = self.peer_bits.get(name)
+            if bit is not None:
+                self.chunk_peers[chunk_index] &= ~(1 << bit)
+
+    # Function to stop counting a peer as a source
+    def remove_peer(self, name):
+        with self._lock:
+            bit = self.peer_bits.get(name)
+            if bit is not None:
+                self.live_mask &= ~(1 << bit)
+
+    # Function to check whether a live peer has a chunk
+    def has(self, name, chunk_index):
+        bit = self.peer_bits.get(name)
+        return bit is not None and bool(self.chunk_peers[chunk_index] & self.live_mask & (1 << bit))
+
+    # Function to count the live peers that have a chunk
+    def count(self, chunk_index):
+        return (self.chunk_peers[chunk_index] & self.live_mask).bit_count()
+
+    # Function to list the live peers that have a chunk
+    def holders(self, chunk_index):
+        peers = self.chunk_peers[chunk_index] & self.live_mask
+        names = []
+        while peers:
+            low_bit = peers & -peers
+            names.append(self.peer_names[low_bit.bit_length() - 1])
+            peers ^= low_bit
+        return names
+
+    # Function to list the chunks a peer has
+    def peer_chunks(self, name):
+        bit = self.peer_bits.get(name)
+        if bit is None:
+            return []
+        flag = 1 << bit
+        return [i for i, peers in enumerate(self.chunk_peers) if peers & flag]
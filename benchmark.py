@@ -0,0 +1,303 @@
+import os
+import sys
+import json
+import time
+import random
+import socket
+import asyncio
+import logging
+import argparse
+import shutil
+import resource
+import tempfile
+import threading
+import subprocess
+from chunk_store import ContentStore
+from client import ConnectionPool
+from chunk_cache import ChunkCache
+from downloader import download_to_file
+from file_utils import compute_file_hash, save_manifest, load_manifest, DEFAULT_HASH_ALGORITHM
+from server import start_server
+from async_server import AsyncChunkServer
+from tracker import start_tracker, TrackerClient
+from proxy_shim import LinkShim
+from log_utils import setup_logging
+
+# Only warnings and errors, so logging doesn't skew the measurements
+setup_logging()
+logging.getLogger().setLevel(logging.WARNING)
+
+# Seconds to wait for a node's server to start accepting connections
+STARTUP_TIMEOUT = 10
+
+# Seconds a single leecher may take before the benchmark gives up on it
+LEECH_TIMEOUT = 600
+
+
+# Function to find a free TCP port on localhost
+def free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+# Function to wait until something is listening on a local port
+def wait_for_port(port, timeout=STARTUP_TIMEOUT):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"Nothing is listening on port {port}")
+            time.sleep(0.05)
+
+
+# Function to write a file of pseudo-random bytes (the same bytes for the same seed)
+def make_test_file(path, size, seed=0, text=False):
+    rng = random.Random(seed)
+    with open(path, 'wb') as f:
+        remaining = size
+        while remaining:
+            block = min(remaining, 1024 * 1024)
+            f.write(random_text(rng, block) if text else rng.randbytes(block))
+            remaining -= block
+
+
+# Function to make `size` bytes of log-like text (compressible, unlike random bytes)
+def random_text(rng, size):
+    words = [b'INFO', b'DEBUG', b'WARNING', b'chunk', b'peer', b'request', b'served', b'from', b'connection',
+             b'opened', b'closed', b'bytes', b'in', b'ms']
+    lines = []
+    length = 0
+    while length < size:
+        line = b'%d ' % rng.randrange(10 ** 9) + b' '.join(rng.choices(words, k=rng.randint(4, 12))) + b'\n'
+        lines.append(line)
+        length += len(line)
+    return b''.join(lines)[:size]
+
+
+# Function to return (CPU seconds, peak RSS in bytes) used so far by this process or its children
+def resource_usage(who=resource.RUSAGE_SELF):
+    usage = resource.getrusage(who)
+    peak_rss = usage.ru_maxrss if sys.platform == 'darwin' else usage.ru_maxrss * 1024
+    return usage.ru_utime + usage.ru_stime, peak_rss
+
+
+# Function to start a chunk server for `store` on a free port; returns the port
+def start_node_server(store, server_kind='threaded', cache=None):
+    port = free_port()
+    if server_kind == 'async':
+        server = AsyncChunkServer(store, cache=cache)
+        threading.Thread(target=lambda: asyncio.run(server.serve(port, host='127.0.0.1')), daemon=True).start()
+    else:
+        threading.Thread(target=start_server, args=(port, store), kwargs={'cache': cache}, daemon=True).start()
+    wait_for_port(port)
+    return port
+
+
+# Function to put a link shim in front of a local port when any impairment is configured;
+# returns the port peers should connect to
+def shim_port(port, config, shims):
+    if not (config['latency'] or config['bandwidth'] or config['loss']):
+        return port
+    shim = LinkShim('127.0.0.1', port, config['latency'], config['bandwidth'], config['loss'],
+                    seed=config['seed'] + len(shims)).start()
+    shims.append(shim)
+    return shim.port
+
+
+# Function to download the benchmark file as one leecher; returns its result record.
+# In swarm mode the leecher also serves what it has and announces it to the tracker.
+def leech(manifest, output_file, seed_ports, config, tracker_address=None, shims=None):
+    pool = ConnectionPool(compression=config['compression'])
+    store = tracker = None
+    if tracker_address:
+        store = ContentStore()
+        listen_port = shim_port(start_node_server(store, config['server']), config, shims if shims is not None else [])
+        tracker = TrackerClient(tracker_address, listen_port, pool)
+
+    peer_chunk_map = {f"127.0.0.1:{port}": range(len(manifest.digests)) for port in seed_ports}
+    cpu_before, _ = resource_usage()
+    start_time = time.monotonic()
+    complete = download_to_file(output_file, manifest, peer_chunk_map, store=store, tracker=tracker, pool=pool,
+                                window=config['window'])
+    seconds = time.monotonic() - start_time
+    cpu_after, peak_rss = resource_usage()
+    pool.close_all()
+
+    # Check the result end to end, not just chunk by chunk
+    if complete and config['verify']:
+        complete = (compute_file_hash(output_file, algorithm=manifest.algorithm)
+                    == compute_file_hash(config['source_file'], algorithm=manifest.algorithm))
+
+    result = {
+        'complete': complete,
+        'seconds': seconds,
+        'bytes': manifest.file_size,
+        'throughput_bytes_per_second': manifest.file_size / seconds if seconds else None,
+    }
+
+    # CPU and memory can only be attributed to one leecher when it has a process to itself
+    if config['mode'] == 'subprocess':
+        result['cpu_seconds'] = cpu_after - cpu_before
+        result['max_rss_bytes'] = peak_rss
+    return result
+
+
+# Function to run one leecher in a child process and collect its result
+def leech_in_subprocess(manifest_path, output_file, seed_ports, config, tracker_address=None):
+    command = [sys.executable, os.path.abspath(__file__), 'leech', '--manifest', manifest_path,
+               '--output', output_file, '--seed-ports', ','.join(map(str, seed_ports)),
+               '--config', json.dumps(config)]
+    if tracker_address:
+        command += ['--tracker', tracker_address]
+    result = subprocess.run(command, capture_output=True, text=True, timeout=LEECH_TIMEOUT)
+    if result.returncode != 0:
+        error_lines = result.stderr.strip().splitlines()
+        return {'complete': False, 'error': error_lines[-1] if error_lines else f"exit code {result.returncode}"}
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+# Function to run a complete benchmark described by `config`; returns the JSON-ready report
+def run_benchmark(config):
+    shims = []
+    work_dir = tempfile.mkdtemp(prefix='p2p-benchmark-')
+    source_file = config['source_file'] = os.path.join(work_dir, 'source.bin')
+    make_test_file(source_file, config['file_size'], config['seed'], config['text'])
+
+    # Start the seeds, each behind its own link shim
+    cpu_before, _ = resource_usage()
+    seed_store = ContentStore()
+    file_id = seed_store.add_file(source_file, config['chunk_size'], config['algorithm'])
+    manifest = seed_store.get_file(file_id).manifest
+    manifest_path = os.path.join(work_dir, 'source.manifest')
+    save_manifest(manifest, manifest_path)
+    seed_cache = ChunkCache(config['cache_bytes'], config['read_ahead']) if config['cache_bytes'] else None
+    seed_ports = [shim_port(start_node_server(seed_store, config['server'], seed_cache), config, shims)
+                  for _ in range(config['seeds'])]
+
+    # In swarm mode leechers find each other (and the seeds) through a tracker
+    tracker_address = None
+    if config['swarm']:
+        tracker_port = free_port()
+        threading.Thread(target=start_tracker, args=(tracker_port,), daemon=True).start()
+        wait_for_port(tracker_port)
+        tracker_address = f"127.0.0.1:{tracker_port}"
+        for port in seed_ports:
+            TrackerClient(tracker_address, port).announce(file_id, seed_store.get_file(file_id).bitfield())
+
+    # Run every leecher at once
+    results = [None] * config['leechers']
+
+    def run_leecher(index):
+        output_file = os.path.join(work_dir, f'leecher{index}.bin')
+        try:
+            if config['mode'] == 'subprocess':
+                results[index] = leech_in_subprocess(manifest_path, output_file, seed_ports, config, tracker_address)
+            else:
+                results[index] = leech(manifest, output_file, seed_ports, config, tracker_address, shims)
+        except Exception as e:
+            results[index] = {'complete': False, 'error': str(e)}
+
+    start_time = time.monotonic()
+    threads = [threading.Thread(target=run_leecher, args=(i,)) for i in range(config['leechers'])]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    wall_seconds = time.monotonic() - start_time
+
+    cpu_after, peak_rss = resource_usage()
+    child_cpu, child_peak_rss = resource_usage(resource.RUSAGE_CHILDREN)
+    for shim in shims:
+        shim.close()
+    shutil.rmtree(work_dir, ignore_errors=True)
+
+    completed = [result for result in results if result.get('complete')]
+    return {
+        'config': {key: value for key, value in config.items() if key != 'source_file'},
+        'file_id': file_id,
+        'chunk_size': manifest.chunk_size,
+        'chunks': len(manifest.digests),
+        'all_complete': len(completed) == len(results),
+        'completion_seconds': wall_seconds,
+        'aggregate_throughput_bytes_per_second': manifest.file_size * len(completed) / wall_seconds,
+        'cpu_seconds': {'benchmark_process': cpu_after - cpu_before, 'leecher_processes': child_cpu},
+        'max_rss_bytes': {'benchmark_process': peak_rss, 'leecher_processes': child_peak_rss},
+        'seed_cache': seed_cache.stats() if seed_cache else None,
+        'leechers': results,
+    }
+
+
+# Function to build the benchmark configuration from command-line arguments
+def config_from_args(args):
+    return {
+        'file_size': args.file_size,
+        'chunk_size': args.chunk_size,
+        'algorithm': args.algorithm,
+        'seeds': args.seeds,
+        'leechers': args.leechers,
+        'swarm': args.swarm,
+        'mode': args.mode,
+        'server': args.server,
+        'window': args.window,
+        'cache_bytes': args.cache_bytes,
+        'read_ahead': args.read_ahead,
+        'compression': [name for name in args.compression.split(',') if name],
+        'latency': args.latency,
+        'bandwidth': args.bandwidth,
+        'loss': args.loss,
+        'seed': args.seed,
+        'text': args.text,
+        'verify': not args.no_verify,
+    }
+
+
+# Entry point: `benchmark.py run [options]` runs a benchmark and prints the JSON report
+# (`benchmark.py leech` is the child process used by --mode subprocess)
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark a local swarm of seeds and leechers.")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = commands.add_parser('run', help="run a benchmark and print a JSON report")
+    run_parser.add_argument('--file-size', type=int, default=64 * 1024 * 1024, help="bytes in the shared file")
+    run_parser.add_argument('--chunk-size', type=int, default=None, help="bytes per chunk (default: chosen from the file size)")
+    run_parser.add_argument('--algorithm', default=DEFAULT_HASH_ALGORITHM, help="chunk hash algorithm")
+    run_parser.add_argument('--seeds', type=int, default=1, help="nodes that start with the whole file")
+    run_parser.add_argument('--leechers', type=int, default=3, help="nodes that download the file")
+    run_parser.add_argument('--swarm', action='store_true', help="let leechers serve each other through a tracker")
+    run_parser.add_argument('--mode', choices=('inprocess', 'subprocess'), default='inprocess',
+                            help="run leechers as threads or as separate processes")
+    run_parser.add_argument('--server', choices=('threaded', 'async'), default='threaded', help="chunk server to run")
+    run_parser.add_argument('--window', type=int, default=8, help="requests in flight per peer")
+    run_parser.add_argument('--cache-bytes', type=int, default=0, help="memory budget of the seeds' chunk cache (0 for none)")
+    run_parser.add_argument('--read-ahead', type=int, default=0, help="chunks the seeds' cache loads ahead")
+    run_parser.add_argument('--compression', default='',
+                            help="comma-separated compression algorithms the leechers ask for, best first (e.g. zstd,zlib)")
+    run_parser.add_argument('--latency', type=float, default=0.0, help="one-way link delay in seconds")
+    run_parser.add_argument('--bandwidth', type=float, default=None, help="link bandwidth per node in bytes per second")
+    run_parser.add_argument('--loss', type=float, default=0.0, help="fraction of segments delayed as if lost")
+    run_parser.add_argument('--text', action='store_true', help="share log-like text instead of random bytes")
+    run_parser.add_argument('--seed', type=int, default=0, help="random seed for the file contents and loss")
+    run_parser.add_argument('--no-verify', action='store_true', help="skip the whole-file hash check")
+    run_parser.add_argument('--output', help="also write the JSON report to this file")
+
+    leech_parser = commands.add_parser('leech', help=argparse.SUPPRESS)
+    leech_parser.add_argument('--manifest', required=True)
+    leech_parser.add_argument('--output', required=True)
+    leech_parser.add_argument('--seed-ports', required=True)
+    leech_parser.add_argument('--config', required=True)
+    leech_parser.add_argument('--tracker')
+
+    args = parser.parse_args()
+    if args.command == 'leech':
+        seed_ports = [int(port) for port in args.seed_ports.split(',') if port]
+        report = leech(load_manifest(args.manifest), args.output, seed_ports, json.loads(args.config), args.tracker)
+    else:
+        report = run_benchmark(config_from_args(args))
+        if args.output:
+            with open(args.output, 'w') as f:
+                json.dump(report, f, indent=2)
+    print(json.dumps(report, indent=None if args.command == 'leech' else 2))
@@ -0,0 +1,218 @@
+import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from file_utils import generate_digest
+from compression import compress_chunk
+from availability import full_bitfield
+from log_utils import setup_logging
+from metrics import cache_hits, cache_misses, cache_evictions, cache_bytes
+
+setup_logging()
+
+# Default memory budget for cached chunk data, in bytes
+DEFAULT_CACHE_BYTES = 64 * 1024 * 1024
+
+# Default number of following chunks to load in the background after a chunk is read (0 for none)
+DEFAULT_READ_AHEAD = 0
+
+
+# One cached chunk: its bytes, the digests worked out for it so far ({algorithm: digest})
+# and its compressed forms ({algorithm: compressed bytes, or None if it doesn't compress})
+class CacheEntry:
+    __slots__ = ('data', 'digests', 'compressed', 'size')
+
+    def __init__(self, data):
+        self.data = data
+        self.digests = {}
+        self.compressed = {}
+        self.size = len(data)  # Bytes counted against the cache budget
+
+
+# Byte-budgeted LRU cache of chunk data, keyed by (file id, chunk index).
+# Under a flash crowd every joining node asks for the same first chunks of a file; the
+# cache keeps those hot chunks in RAM (as plain bytes, so they don't depend on the page
+# cache keeping them) together with any digests computed for them, and evicts the least
+# recently used chunks once the data exceeds `max_bytes`. With `read_ahead`, reading a
+# chunk also loads the next few chunks of the file on a background thread, since
+# downloaders tend to work through a file in order.
+class ChunkCache:
+    def __init__(self, max_bytes=DEFAULT_CACHE_BYTES, read_ahead=DEFAULT_READ_AHEAD):
+        self.max_bytes = max_bytes
+        self.read_ahead = read_ahead
+        self.entries = OrderedDict()  # Maps (file id, chunk index) -> CacheEntry, least recently used first
+        self.size = 0  # Bytes of chunk data held
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._pending = set()  # Keys being loaded by read-ahead
+        self._lock = threading.Lock()
+        self._loader = ThreadPoolExecutor(max_workers=1) if read_ahead else None
+
+    # Function to return the cached entry for a key (None on a miss), marking it recently used
+    def get(self, key):
+        with self._lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+            else:
+                self.entries.move_to_end(key)
+                self.hits += 1
+        if entry is None:
+            cache_misses.inc()
+        else:
+            cache_hits.inc()
+        return entry
+
+    # Function to return the cached entry for a key without counting a lookup or changing its place
+    def peek(self, key):
+        with self._lock:
+            return self.entries.get(key)
+
+    # Function to add a chunk to the cache, evicting the least recently used chunks to stay in budget;
+    # returns its entry (chunks larger than the whole budget are returned but not kept)
+    def put(self, key, data):
+        data = bytes(data)
+        with self._lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                return entry
+            entry = CacheEntry(data)
+            if len(data) > self.max_bytes:
+                return entry
+            self.entries[key] = entry
+            self.size += entry.size
+            evicted, size = self._evict()
+        if evicted:
+            cache_evictions.inc(evicted)
+        cache_bytes.set(size)
+        return entry
+
+    # Function to keep a compressed form of a cached chunk (None records that it doesn't compress),
+    # counting it against the budget
+    def add_compressed(self, key, entry, algorithm, compressed):
+        with self._lock:
+            if algorithm in entry.compressed:
+                return
+            entry.compressed[algorithm] = compressed
+            if compressed is None or self.entries.get(key) is not entry:
+                return
+            entry.size += len(compressed)
+            self.size += len(compressed)
+            evicted, size = self._evict()
+        if evicted:
+            cache_evictions.inc(evicted)
+        cache_bytes.set(size)
+
+    # Function to evict the least recently used chunks until the cache is within budget
+    # (called with the lock held); returns (chunks evicted, bytes now held)
+    def _evict(self):
+        evicted = 0
+        while self.size > self.max_bytes:
+            _, old = self.entries.popitem(last=False)
+            self.size -= old.size
+            evicted += 1
+        self.evictions += evicted
+        return evicted, self.size
+
+    # Function to return a chunk's entry, loading it with `load()` on a miss
+    def load(self, key, load):
+        entry = self.get(key)
+        if entry is None:
+            entry = self.put(key, load())
+        return entry
+
+    # Function to load the chunks after `chunk_index` of a file in the background
+    def prefetch(self, file_id, chunk_index, chunks):
+        if self._loader is None:
+            return
+        for next_index in range(chunk_index + 1, min(chunk_index + 1 + self.read_ahead, len(chunks))):
+            key = (file_id, next_index)
+            with self._lock:
+                if key in self.entries or key in self._pending:
+                    continue
+                self._pending.add(key)
+            self._loader.submit(self._prefetch_chunk, key, chunks)
+
+    # Function run on the loader thread to read one chunk into the cache
+    def _prefetch_chunk(self, key, chunks):
+        try:
+            chunk_index = key[1]
+            if not hasattr(chunks, 'has') or chunks.has(chunk_index):
+                self.put(key, chunks[chunk_index])
+        except Exception as e:
+            logging.debug("Read-ahead of chunk %s failed: %s", key, e)
+        finally:
+            with self._lock:
+                self._pending.discard(key)
+
+    # Function to drop every cached chunk
+    def clear(self):
+        with self._lock:
+            self.entries.clear()
+            self.size = 0
+        cache_bytes.set(0)
+
+    # Function to return the hit/miss statistics as plain data
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'chunks': len(self.entries),
+                'bytes': self.size,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+            }
+
+
+# A chunk source read through a ChunkCache.
+# It can be used anywhere the server expects a chunk list. It deliberately has no
+# chunk_location(), so chunks are sent from the cached bytes rather than with sendfile().
+class CachedChunks:
+    def __init__(self, chunks, cache, file_id=''):
+        self.chunks = chunks
+        self.cache = cache
+        self.file_id = file_id
+
+    # Function to return the number of chunks in the file
+    def __len__(self):
+        return len(self.chunks)
+
+    # Function to check whether a chunk can be served yet
+    def has(self, chunk_index):
+        return self.chunks.has(chunk_index) if hasattr(self.chunks, 'has') else 0 <= chunk_index < len(self.chunks)
+
+    # Function to return a bitfield of the chunks that can be served
+    def bitfield(self):
+        return self.chunks.bitfield() if hasattr(self.chunks, 'bitfield') else full_bitfield(len(self))
+
+    # Function to return a chunk, from the cache when possible
+    def __getitem__(self, chunk_index):
+        entry = self.cache.load((self.file_id, chunk_index), lambda: self.chunks[chunk_index])
+        self.cache.prefetch(self.file_id, chunk_index, self.chunks)
+        return entry.data
+
+    # Function to return a chunk's digest, computing it only the first time it is asked for
+    # (while the chunk stays cached)
+    def digest(self, chunk_index, algorithm, chunk=None):
+        entry = self.cache.peek((self.file_id, chunk_index))
+        if entry is None:
+            return generate_digest(self.chunks[chunk_index] if chunk is None else chunk, algorithm)
+        digest = entry.digests.get(algorithm)
+        if digest is None:
+            digest = entry.digests[algorithm] = generate_digest(entry.data, algorithm)
+        return digest
+
+    # Function to return a chunk compressed with `algorithm` (None if it doesn't compress),
+    # compressing it only the first time it is asked for (while the chunk stays cached)
+    def compressed(self, chunk_index, algorithm, chunk=None):
+        key = (self.file_id, chunk_index)
+        entry = self.cache.peek(key)
+        if entry is None:
+            return compress_chunk(self.chunks[chunk_index] if chunk is None else chunk, algorithm)
+        if algorithm not in entry.compressed:
+            self.cache.add_compressed(key, entry, algorithm, compress_chunk(entry.data, algorithm))
+        return entry.compressed[algorithm]
@@ -0,0 +1,235 @@
+import os
+import mmap
+import logging
+import threading
+from file_utils import load_or_build_manifest, choose_chunk_size, chunk_range, DEFAULT_HASH_ALGORITHM
+from availability import full_bitfield, bitfield_from_chunks
+from log_utils import setup_logging
+
+# Set up logging to display informational messages
+setup_logging()
+
+
+# Chunk source backed by a memory-mapped file.
+# It can be used anywhere a list of chunks is expected (len() and indexing), but chunks
+# are memoryview slices of the mapping, so nothing is read into the Python heap and the
+# operating system's page cache holds the data. The server uses chunk_location() to send
+# chunks straight from the page cache with sendfile().
+class MmapChunkStore:
+    def __init__(self, file_path, chunk_size=None):
+        self.file_path = file_path
+        self.file = open(file_path, 'rb')
+        self.file_size = os.fstat(self.file.fileno()).st_size
+        self.chunk_size = chunk_size or choose_chunk_size(self.file_size)
+
+        # mmap can't map an empty file, so an empty file simply has no chunks
+        if self.file_size:
+            self.mmap = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+            self.view = memoryview(self.mmap)
+        else:
+            self.mmap = None
+            self.view = memoryview(b'')
+
+        logging.info("Mapped %s: %s bytes in %s chunks of %s bytes.", file_path, self.file_size, len(self),
+                     self.chunk_size)
+
+    # Function to return the number of chunks in the file
+    def __len__(self):
+        return (self.file_size + self.chunk_size - 1) // self.chunk_size
+
+    # Function to return the (offset, length) of a chunk in the file
+    def chunk_range(self, chunk_index):
+        if not 0 <= chunk_index < len(self):
+            raise IndexError(f"Chunk index {chunk_index} out of range")
+        offset = chunk_index * self.chunk_size
+        return offset, min(self.chunk_size, self.file_size - offset)
+
+    # Function to return the (open file, offset, length) a chunk can be sent from
+    def chunk_location(self, chunk_index):
+        offset, length = self.chunk_range(chunk_index)
+        return self.file, offset, length
+
+    # Function to return a chunk as a zero-copy memoryview slice
+    def __getitem__(self, chunk_index):
+        if chunk_index < 0:
+            chunk_index += len(self)
+        offset, length = self.chunk_range(chunk_index)
+        return self.view[offset:offset + length]
+
+    # Function to iterate over every chunk in order
+    def __iter__(self):
+        for chunk_index in range(len(self)):
+            yield self[chunk_index]
+
+    # Function to unmap and close the file
+    def close(self):
+        self.view.release()
+        if self.mmap is not None:
+            try:
+                self.mmap.close()
+            except BufferError:
+                # Chunks handed out earlier are still in use; the mapping is freed once they are released
+                logging.warning("Chunks of %s are still in use; leaving the mapping open.", self.file_path)
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+# Content-addressed chunk store holding many files.
+# Files are identified by their manifest's root hash (the file id) and every chunk is
+# indexed by its digest, so a chunk that appears in several files is stored and served
+# from a single location. Seeded files are read in place through memory maps; chunks
+# added on their own (e.g. while downloading) are kept as blobs in `blob_dir`.
+class ContentStore:
+    def __init__(self, blob_dir=None):
+        self.blob_dir = blob_dir
+        self.files = {}  # Maps file id -> StoredFile
+        self.locations = {}  # Maps (algorithm, digest) -> (path, offset, length)
+        self._sources = {}  # Maps path -> MmapChunkStore, opened on first use
+        self._chunk_sizes = {}  # Maps path -> chunk size of the manifest it was stored under
+        self._lock = threading.Lock()
+
+    # Function to seed a file; returns its file id
+    # (pass chunk_indices to seed only some of its chunks, the way a node that owns part of a file does;
+    # `workers`, `processes`, `progress` and `content_defined` are used if the file's manifest has to be
+    # built, and `index` is a SeedIndex to look it up in first)
+    def add_file(self, file_path, chunk_size=None, algorithm=DEFAULT_HASH_ALGORITHM, manifest=None, chunk_indices=None,
+                 workers=None, processes=False, progress=None, content_defined=False, index=None):
+        manifest = manifest or load_or_build_manifest(file_path, chunk_size, algorithm=algorithm, workers=workers,
+                                                      processes=processes, progress=progress,
+                                                      content_defined=content_defined, index=index)
+        if chunk_indices is not None:
+            chunk_indices = {i for i in chunk_indices if 0 <= i < len(manifest.digests)}
+
+        # Index every chunk we don't already have under its digest
+        new_chunks = 0
+        with self._lock:
+            for chunk_index, digest in enumerate(manifest.digests):
+                key = (manifest.algorithm, digest)
+                if key not in self.locations and (chunk_indices is None or chunk_index in chunk_indices):
+                    self.locations[key] = (file_path, *chunk_range(manifest, chunk_index))
+                    new_chunks += 1
+            self.files[manifest.root_hash] = StoredFile(self, manifest, chunk_indices=chunk_indices)
+            self._chunk_sizes[file_path] = manifest.chunk_size
+
+        seeded_chunks = len(manifest.digests) if chunk_indices is None else len(chunk_indices)
+        logging.info("Seeding %s as %s: %s chunks, %s already stored.", file_path, manifest.root_hash,
+                     seeded_chunks, seeded_chunks - new_chunks)
+        return manifest.root_hash
+
+    # Function to serve a file that is still being downloaded into a PartialFile.
+    # Only the chunks already written are offered; call chunk_written() as each one lands.
+    def add_partial_file(self, manifest, partial):
+        with self._lock:
+            stored_file = self.files[manifest.root_hash] = StoredFile(self, manifest, partial)
+            self._chunk_sizes[partial.output_file] = manifest.chunk_size
+            for chunk_index in range(len(manifest.digests)):
+                if partial.has(chunk_index):
+                    self._add_partial_location(stored_file, chunk_index)
+        return manifest.root_hash
+
+    # Function to make a chunk just written to a partial file available to peers
+    def chunk_written(self, file_id, chunk_index):
+        stored_file = self.files.get(file_id)
+        if stored_file is not None and stored_file.partial is not None:
+            with self._lock:
+                self._add_partial_location(stored_file, chunk_index)
+
+    # Function to index one chunk of a partial file under its digest
+    def _add_partial_location(self, stored_file, chunk_index):
+        manifest = stored_file.manifest
+        self.locations.setdefault((manifest.algorithm, manifest.digests[chunk_index]),
+                                  (stored_file.partial.output_file, *chunk_range(manifest, chunk_index)))
+
+    # Function to store a single chunk (such as one just downloaded) as a blob
+    def add_chunk(self, algorithm, digest, data):
+        key = (algorithm, digest)
+        if key in self.locations:
+            return
+        if self.blob_dir is None:
+            raise ValueError("This store has no blob directory for individual chunks")
+
+        os.makedirs(self.blob_dir, exist_ok=True)
+        blob_path = os.path.join(self.blob_dir, f"{algorithm}-{digest.hex()}")
+        with open(blob_path, 'wb') as f:
+            f.write(data)
+        with self._lock:
+            self.locations[key] = (blob_path, 0, len(data))
+            self._chunk_sizes[blob_path] = len(data)
+
+    # Function to look up a seeded file by id (None if we don't have it)
+    def get_file(self, file_id):
+        return self.files.get(file_id)
+
+    # Function to find a chunk by digest in any stored file (None if we don't have it)
+    def find_chunk(self, algorithm, digest):
+        location = self.locations.get((algorithm, digest))
+        if location is None:
+            return None
+        source, offset, length = self._open(location)
+        return source.view[offset:offset + length]
+
+    # Function to return the memory map and byte range for a stored location
+    def _open(self, location):
+        path, offset, length = location
+        source = self._sources.get(path)
+        if source is None:
+            with self._lock:
+                source = self._sources.get(path)
+                if source is None:
+                    source = self._sources[path] = MmapChunkStore(path, self._chunk_sizes.get(path))
+        return source, offset, length
+
+    # Function to close every open memory map
+    def close(self):
+        with self._lock:
+            sources, self._sources = list(self._sources.values()), {}
+        for source in sources:
+            source.close()
+
+
+# One file in a ContentStore, usable anywhere a chunk list is expected
+# (`partial` is the PartialFile of a file that is still downloading, `chunk_indices`
+# the chunks served when only part of the file is seeded)
+class StoredFile:
+    def __init__(self, store, manifest, partial=None, chunk_indices=None):
+        self.store = store
+        self.manifest = manifest
+        self.partial = partial
+        self.chunk_indices = chunk_indices
+
+    # Function to check whether a chunk can be served yet
+    def has(self, chunk_index):
+        if self.chunk_indices is not None:
+            return chunk_index in self.chunk_indices
+        return self.partial is None or self.partial.has(chunk_index)
+
+    # Function to return a bitfield of the chunks that can be served
+    def bitfield(self):
+        if self.chunk_indices is not None:
+            return bitfield_from_chunks(self.chunk_indices, len(self))
+        if self.partial is None:
+            return full_bitfield(len(self))
+        return bytes(self.partial.bitfield)
+
+    # Function to return the number of chunks in the file
+    def __len__(self):
+        return len(self.manifest.digests)
+
+    # Function to return the (open file, offset, length) a chunk can be sent from
+    def chunk_location(self, chunk_index):
+        if not 0 <= chunk_index < len(self):
+            raise IndexError(f"Chunk index {chunk_index} out of range")
+        location = self.store.locations[(self.manifest.algorithm, self.manifest.digests[chunk_index])]
+        source, offset, length = self.store._open(location)
+        return source.file, offset, length
+
+    # Function to return a chunk as a zero-copy memoryview slice
+    def __getitem__(self, chunk_index):
+        if not 0 <= chunk_index < len(self):
+            raise IndexError(f"Chunk index {chunk_index} out of range")
+        return self.store.find_chunk(self.manifest.algorithm, self.manifest.digests[chunk_index])
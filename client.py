@@ -1,52 +1,391 @@
+import time
 import socket
 import logging
-from file_utils import generate_checksum, verify_chunk
+import itertools
+import threading
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+from file_utils import verify_chunk, HASH_ALGORITHMS, HASH_IDS, HASH_NAMES, DEFAULT_HASH_ALGORITHM
+from protocol import (Frame, recv_frame, send_frame, pack_batch_request, OP_GET_CHUNK, OP_GET_BITFIELD, OP_CHUNK,
+                      OP_ERROR, OP_HELLO, OP_COMPRESSED_CHUNK, OP_CHOKED, MAX_PAYLOAD_SIZE)
+from compression import compression_algorithms, decompress_chunk, COMPRESSION_IDS, COMPRESSION_NAMES
+from log_utils import setup_logging
+from peer_scheduler import peer_scheduler, backoff_delay
+from metrics import bytes_received, client_request_seconds, client_requests_in_flight, peer_requests
 
-logging.basicConfig(level=logging.INFO)
+setup_logging()
 
-# Function to request a chunk of data from a peer with retry logic
-def get_chunk_from_peer(peer_ip, peer_port, chunk_index, retries=3):
+# Default number of requests a client may have outstanding on one peer connection
+MAX_OUTSTANDING_REQUESTS = 16
+
+# Default timeout (in seconds) for connecting to a peer and for each chunk request
+REQUEST_TIMEOUT = 5
+
+
+# A long-lived connection to a single peer.
+# Many chunk requests can be in flight at once; each one is tagged with a request id
+# and a background reader thread resolves the matching Future when its response arrives,
+# so responses may come back in any order. A batched request is answered by one frame
+# per chunk; each of those chunks gets its own Future and counts as one outstanding request.
+# With `compression` (algorithm names, best first) the connection starts with a HELLO
+# handshake, and compressed chunks are decompressed by the reader thread, so callers
+# always see plain CHUNK frames (and verify the uncompressed data).
+class PeerConnection:
+    def __init__(self, peer_ip, peer_port, max_outstanding=MAX_OUTSTANDING_REQUESTS, timeout=REQUEST_TIMEOUT,
+                 compression=(), listen_port=None):
+        self.peer_ip = peer_ip
+        self.peer_port = peer_port
+        self.name = f"{peer_ip}:{peer_port}"
+        self.closed = False
+        self.compression = None  # Compression algorithm agreed with the peer
+
+        # Connect to the peer, then switch to blocking mode for the reader thread
+        self.sock = socket.create_connection((peer_ip, peer_port), timeout=timeout)
+        try:
+            if compression or listen_port:
+                self.compression = self._handshake(compression_algorithms(compression), listen_port)
+        except Exception:
+            self.sock.close()
+            raise
+        self.sock.settimeout(None)
+
+        self._request_ids = itertools.count(1)
+        self._pending = {}  # Maps request id (or (request id, chunk index) in a batch) -> Future waiting for the response
+        self._chunk_sizes = {}  # Maps the same keys -> expected length of the chunk asked for, where known
+        self._lock = threading.Lock()  # Guards _pending and serializes writes to the socket
+        self._slots = threading.BoundedSemaphore(max_outstanding)  # Limits outstanding requests
+
+        # Start the thread that reads responses and hands them to the waiting requests
+        self._reader = threading.Thread(target=self._read_responses, daemon=True)
+        self._reader.start()
+
+    # Function to offer the peer our compression algorithms (and tell it the port we serve chunks
+    # on, if we do); returns the algorithm it picked (None for none)
+    def _handshake(self, compression, listen_port=None):
+        send_frame(self.sock, OP_HELLO, listen_port or 0, payload=bytes(COMPRESSION_IDS[name] for name in compression))
+        response = recv_frame(self.sock)
+        if response is None:
+            raise ConnectionError(f"{self.name} closed the connection during the handshake")
+
+        # Peers without compression support answer with an error, which just means no compression
+        if response.opcode != OP_HELLO or not response.payload:
+            return None
+        algorithm = COMPRESSION_NAMES.get(response.payload[0])
+        if algorithm not in compression:
+            raise ConnectionError(f"{self.name} picked compression we didn't offer: {response.payload[0]}")
+        logging.debug("Using %s compression with %s", algorithm, self.name)
+        return algorithm
+
+    # Function to turn a COMPRESSED_CHUNK frame back into a CHUNK frame of at most `max_size` bytes
+    # (a chunk that fails to decompress or expands past that comes out empty, so it fails
+    # verification like any other corrupt chunk)
+    def _decompress(self, frame, max_size=MAX_PAYLOAD_SIZE):
+        try:
+            payload = decompress_chunk(frame.payload, self.compression, max_size)
+        except ValueError as e:
+            logging.warning("Could not decompress chunk %s from %s: %s", frame.chunk_index, self.name, e)
+            payload = b''
+        return Frame(OP_CHUNK, frame.chunk_index, frame.digest, payload, frame.request_id, frame.hash_id)
+
+    # Function to send a request and return a Future that resolves to the response frame
+    # (`chunk_size`, if known, is the length of the chunk asked for; a compressed chunk may not expand past it)
+    def request(self, opcode, chunk_index=0, payload=b'', digest=b'', timeout=REQUEST_TIMEOUT, hash_id=0,
+                chunk_size=None):
+        return self._send(opcode, chunk_index, payload, digest, timeout, hash_id, chunk_sizes=[chunk_size])[0]
+
+    # Function to send a request answered by one frame per chunk in `chunk_indices`;
+    # returns a list of Futures, one per chunk, in the same order
+    # (`chunk_sizes`, if given, maps chunk indices to the lengths of the chunks)
+    def request_batch(self, opcode, chunk_index, chunk_indices, payload=b'', timeout=REQUEST_TIMEOUT, hash_id=0,
+                      chunk_sizes=None):
+        sizes = [chunk_sizes.get(i) for i in chunk_indices] if chunk_sizes else None
+        return self._send(opcode, chunk_index, payload, b'', timeout, hash_id, chunk_indices, sizes)
+
+    # Function to register the Futures for a request and send it
+    def _send(self, opcode, chunk_index, payload, digest, timeout, hash_id, batch=None, chunk_sizes=None):
+        # Wait for free slots so we never have more than max_outstanding requests in flight
+        slots = 1 if batch is None else len(batch)
+        if not self._acquire_slots(slots, timeout):
+            raise socket.timeout(f"Too many outstanding requests to {self.peer_ip}:{self.peer_port}")
+
+        futures = [Future() for _ in range(slots)]
+        keys = []
+        try:
+            with self._lock:
+                if self.closed:
+                    raise ConnectionError(f"Connection to {self.peer_ip}:{self.peer_port} is closed")
+                request_id = next(self._request_ids) & 0xFFFFFFFF
+                keys = [request_id] if batch is None else [(request_id, i) for i in batch]
+                self._pending.update(zip(keys, futures))
+                self._chunk_sizes.update((key, size) for key, size in zip(keys, chunk_sizes or ()) if size is not None)
+                client_requests_in_flight.inc(len(keys), peer=self.name)
+                send_frame(self.sock, opcode, chunk_index, payload, digest, request_id, hash_id)
+        except Exception as e:
+            # Sending failed, so the connection is no longer usable; give back the slots close() won't
+            with self._lock:
+                popped = sum(self._pending.pop(key, None) is not None for key in keys)
+                for key in keys:
+                    self._chunk_sizes.pop(key, None)
+            client_requests_in_flight.dec(popped, peer=self.name)
+            for _ in range(slots - len(keys) + popped):
+                self._slots.release()
+            self.close(e)
+            raise
+
+        # Record how long each response takes to arrive
+        sent_at = time.monotonic()
+        for future in futures:
+            future.add_done_callback(lambda f: self._record_latency(f, sent_at))
+        return futures
+
+    # Function to record the latency of a request that got its response
+    def _record_latency(self, future, sent_at):
+        if not future.cancelled() and future.exception() is None:
+            client_request_seconds.observe(time.monotonic() - sent_at, peer=self.name)
+
+    # Function to take `count` request slots, giving them all back if they aren't free in time
+    def _acquire_slots(self, count, timeout):
+        deadline = time.monotonic() + timeout
+        for acquired in range(count):
+            if not self._slots.acquire(timeout=max(0, deadline - time.monotonic())):
+                for _ in range(acquired):
+                    self._slots.release()
+                return False
+        return True
+
+    # Function to return how many requests are waiting for a response on this connection
+    def outstanding(self):
+        with self._lock:
+            return len(self._pending)
+
+    # Function to request a single chunk, returning a Future for the response frame
+    # (`file_id` picks the file on peers seeding several, `algorithm` asks the peer for
+    # digests in that hash algorithm instead of its default, and `chunk_size` is the
+    # chunk's length from the manifest, if known)
+    def get_chunk(self, chunk_index, timeout=REQUEST_TIMEOUT, algorithm=None, file_id=None, chunk_size=None):
+        payload = bytes.fromhex(file_id) if file_id else b''
+        return self.request(OP_GET_CHUNK, chunk_index, payload, timeout=timeout,
+                            hash_id=HASH_IDS[algorithm] if algorithm else 0, chunk_size=chunk_size)
+
+    # Function to request several chunks in one round trip, returning a Future per chunk (in the given order)
+    # (`chunk_sizes`, if given, maps chunk indices to their lengths from the manifest)
+    def get_chunks(self, chunk_indices, timeout=REQUEST_TIMEOUT, algorithm=None, file_id=None, chunk_sizes=None):
+        chunk_indices = list(dict.fromkeys(chunk_indices))
+        opcode, chunk_index, payload = pack_batch_request(chunk_indices, file_id)
+        return self.request_batch(opcode, chunk_index, chunk_indices, payload, timeout,
+                                  HASH_IDS[algorithm] if algorithm else 0, chunk_sizes)
+
+    # Function to ask the peer which chunks of a file it has, returning a Future for the BITFIELD frame
+    def get_bitfield(self, file_id=None, timeout=REQUEST_TIMEOUT):
+        payload = bytes.fromhex(file_id) if file_id else b''
+        return self.request(OP_GET_BITFIELD, 0, payload, timeout=timeout)
+
+    # Function run by the reader thread to dispatch responses to their requests
+    def _read_responses(self):
+        error = None
+        try:
+            while True:
+                frame = recv_frame(self.sock)
+                if frame is None:
+                    break  # The peer closed the connection
+
+                with self._lock:
+                    key = frame.request_id
+                    future = self._pending.pop(key, None)
+                    if future is None:
+                        key = (frame.request_id, frame.chunk_index)
+                        future = self._pending.pop(key, None)
+                    chunk_size = self._chunk_sizes.pop(key, MAX_PAYLOAD_SIZE)
+
+                bytes_received.inc(len(frame.payload))
+                if frame.opcode == OP_COMPRESSED_CHUNK and self.compression:
+                    frame = self._decompress(frame, chunk_size)
+
+                # Free the slot whether or not anyone is still waiting for this response
+                if future is not None:
+                    self._slots.release()
+                    client_requests_in_flight.dec(peer=self.name)
+                    if future.set_running_or_notify_cancel():
+                        future.set_result(frame)
+                else:
+                    logging.warning("Unexpected response %s from %s:%s", frame.request_id, self.peer_ip, self.peer_port)
+
+        except Exception as e:
+            error = e
+
+        finally:
+            self.close(error)
+
+    # Function to close the connection and fail every request still waiting for a response
+    def close(self, error=None):
+        with self._lock:
+            if self.closed:
+                return
+            self.closed = True
+            pending, self._pending = self._pending, {}
+            self._chunk_sizes.clear()
+
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+
+        # Wake up everyone still waiting so they can retry elsewhere
+        client_requests_in_flight.dec(len(pending), peer=self.name)
+        for future in pending.values():
+            self._slots.release()
+            if future.set_running_or_notify_cancel():
+                future.set_exception(error or ConnectionError(f"Connection to {self.peer_ip}:{self.peer_port} closed"))
+
+
+# Pool of persistent peer connections keyed by "ip:port", shared by every download.
+# `compression` lists the compression algorithms new connections offer (empty for none), and
+# `listen_port` is the port our own chunk server listens on, told to peers in the handshake.
+class ConnectionPool:
+    def __init__(self, max_outstanding=MAX_OUTSTANDING_REQUESTS, timeout=REQUEST_TIMEOUT, compression=(),
+                 listen_port=None):
+        self.max_outstanding = max_outstanding
+        self.timeout = timeout
+        self.compression = compression_algorithms(compression)
+        self.listen_port = listen_port
+        self._connections = {}
+        self._connecting = {}  # Maps "ip:port" -> lock held while connecting to that peer
+        self._lock = threading.Lock()
+
+    # Function to get an open connection to a peer, connecting if needed
+    def get(self, peer_ip, peer_port):
+        key = f"{peer_ip}:{peer_port}"
+        with self._lock:
+            connection = self._connections.get(key)
+            if connection is not None and not connection.closed:
+                return connection
+            connecting = self._connecting.setdefault(key, threading.Lock())
+
+        # Connect and shake hands holding only this peer's lock, so a slow or dead peer
+        # only holds up the callers that want a connection to it
+        with connecting:
+            with self._lock:
+                connection = self._connections.get(key)
+            if connection is not None and not connection.closed:
+                return connection
+
+            # No usable connection yet, so open a new one and remember it
+            connection = PeerConnection(peer_ip, peer_port, self.max_outstanding, self.timeout, self.compression,
+                                        self.listen_port)
+            with self._lock:
+                self._connections[key] = connection
+        logging.info("Opened persistent connection to %s%s", key,
+                     f" ({connection.compression} compression)" if connection.compression else "")
+        return connection
+
+    # Function to drop a connection from the pool (e.g. after a timeout) so the next call reconnects
+    def discard(self, connection, error=None):
+        key = f"{connection.peer_ip}:{connection.peer_port}"
+        with self._lock:
+            if self._connections.get(key) is connection:
+                del self._connections[key]
+        connection.close(error)
+
+    # Function to close every pooled connection
+    def close_all(self):
+        with self._lock:
+            connections, self._connections = list(self._connections.values()), {}
+        for connection in connections:
+            connection.close()
+
+
+# Connection pool used by get_chunk_from_peer unless a different one is passed in
+connection_pool = ConnectionPool()
+
+
+# Function to check that a response frame carries a valid chunk.
+# With an expected digest (from the file's manifest) the chunk is checked against that,
+# using the manifest's algorithm, instead of the digest the peer sent along with it.
+def verify_response(response, expected_digest=None, algorithm=None):
+    if response.opcode != OP_CHUNK:
+        return False
+    if expected_digest is not None:
+        return verify_chunk(response.payload, expected_digest, algorithm or DEFAULT_HASH_ALGORITHM)
+
+    # Otherwise check the chunk against the peer's digest, in whichever algorithm the peer used
+    algorithm = HASH_NAMES.get(response.hash_id)
+    if algorithm not in HASH_ALGORITHMS:
+        return False
+    return verify_chunk(response.payload, response.digest, algorithm)
+
+
+# Function to request a chunk of data from a peer with retry logic.
+# Retries back off exponentially (with jitter), the timeout follows the peer's usual latency,
+# and a peer the scheduler has banned for sending corrupt chunks isn't asked at all.
+def get_chunk_from_peer(peer_ip, peer_port, chunk_index, retries=3, pool=None, expected_digest=None, algorithm=None,
+                        file_id=None, scheduler=None):
+    pool = pool or connection_pool
+    scheduler = scheduler or peer_scheduler
+    peer = f"{peer_ip}:{peer_port}"
     attempt = 0
     while attempt < retries:
+        if scheduler.banned(peer):
+            logging.error("Not asking %s for chunk %s: the peer is banned.", peer, chunk_index)
+            return None
+
+        # Wait before each retry, longer after every failure (and until a choking peer may be asked again)
+        if attempt:
+            time.sleep(max(backoff_delay(attempt), scheduler.retry_in(peer)))
+
+        connection = None
         try:
-            # Create a new socket using IPv4 (AF_INET) and TCP (SOCK_STREAM)
-            client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            
-            # Set a timeout for the socket connection (5 seconds)
-            client.settimeout(5)
-            
-            # Connect to the peer using the provided IP address and port
-            client.connect((peer_ip, peer_port))
-            
-            # Send a request for the chunk, formatted as "GET_CHUNK <chunk_index>"
-            client.sendall(f"GET_CHUNK {chunk_index}".encode('utf-8'))  # Encode the request into bytes
-            
-            # Receive the chunk data and the checksum from the peer (with a buffer size of 512 bytes for chunk and checksum)
-            response = client.recv(1024)  # We assume the chunk and checksum are sent together
-            client.close()
-
-            # Split the chunk data and checksum (assuming they are separated by ||)
-            chunk, checksum = response.split(b'||')
-            
+            # Reuse the persistent connection to this peer (or open one)
+            connection = pool.get(peer_ip, peer_port)
+
+            # Send a GET_CHUNK request and wait for the matching response frame
+            sent_at = time.monotonic()
+            response = connection.get_chunk(chunk_index, algorithm=algorithm, file_id=file_id).result(
+                timeout=scheduler.timeout(peer, REQUEST_TIMEOUT))
+
+            # The peer isn't uploading to us right now; back off and ask again
+            if response.opcode == OP_CHOKED:
+                peer_requests.inc(peer=peer, result='choked')
+                scheduler.record_choked(peer)
+                logging.info("Peer %s:%s is choking us; asking for chunk %s again later.", peer_ip, peer_port, chunk_index)
+                continue
+
+            # The peer doesn't have the chunk, so retrying won't help
+            if response.opcode == OP_ERROR:
+                peer_requests.inc(peer=peer, result='rejected')
+                logging.error("Peer %s:%s rejected chunk %s: %s", peer_ip, peer_port, chunk_index,
+                              bytes(response.payload).decode('utf-8', 'replace'))
+                return None
+
             # Log and validate the checksum of the received chunk
-            if verify_chunk(chunk, checksum.decode('utf-8')):  # Verify if the checksum matches
-                logging.info(f"Successfully downloaded and verified chunk {chunk_index} from {peer_ip}:{peer_port}")
-                return chunk  # Return the valid chunk
+            if verify_response(response, expected_digest, algorithm):  # Verify if the checksum matches
+                peer_requests.inc(peer=peer, result='success')
+                scheduler.record_success(peer, sent_at, len(response.payload))
+                logging.debug("Successfully downloaded and verified chunk %s from %s:%s", chunk_index, peer_ip, peer_port)
+                return response.payload  # Return the valid chunk
             else:
-                logging.warning(f"Checksum mismatch for chunk {chunk_index} from {peer_ip}:{peer_port}. Retrying...")
-        
-        # Handle socket timeout errors (e.g., if the peer does not respond in time)
-        except socket.timeout:
-            logging.error(f"Connection to {peer_ip}:{peer_port} timed out on attempt {attempt + 1}/{retries}. Retrying...")
-        
+                peer_requests.inc(peer=peer, result='checksum_failure')
+                scheduler.record_corruption(peer)
+                logging.warning("Checksum mismatch for chunk %s from %s:%s. Retrying...", chunk_index, peer_ip, peer_port)
+
+        # Handle timeouts (e.g., if the peer does not respond in time)
+        except (socket.timeout, FutureTimeoutError) as e:
+            peer_requests.inc(peer=peer, result='timeout')
+            scheduler.record_failure(peer)
+            logging.error("Connection to %s:%s timed out on attempt %s/%s. Retrying...", peer_ip, peer_port, attempt + 1, retries)
+            # The connection may be stuck, so reconnect on the next attempt
+            if connection is not None:
+                pool.discard(connection, e)
+
         # Handle any other exceptions that might occur (e.g., connection errors, send/receive errors)
         except Exception as e:
-            logging.error(f"Error fetching chunk {chunk_index} from {peer_ip}:{peer_port}: {e}")
-        
+            peer_requests.inc(peer=peer, result='error')
+            scheduler.record_failure(peer)
+            logging.error("Error fetching chunk %s from %s:%s: %s", chunk_index, peer_ip, peer_port, e)
+
         finally:
             # Increment the attempt count and retry
             attempt += 1
 
     # Return None if the chunk could not be fetched after all retry attempts
-    logging.error(f"Failed to download chunk {chunk_index} from {peer_ip}:{peer_port} after {retries} attempts.")
+    logging.error("Failed to download chunk %s from %s:%s after %s attempts.", chunk_index, peer_ip, peer_port, retries)
     return None
@@ -0,0 +1,118 @@
+import lzma
+import zlib
+import logging
+from log_utils import setup_logging
+
+setup_logging()
+
+# Compression algorithms that can be negotiated for chunk transfers, by name: (compress, decompress).
+# decompress(data, max_size) raises ValueError if the data is corrupt or expands past max_size.
+COMPRESSORS = {}
+
+# Compression level used for each algorithm (compressed chunks are cached, so favour the ratio a little)
+COMPRESSION_LEVELS = {'zlib': 6, 'lzma': 1, 'zstd': 3}
+
+# Chunks shorter than this are always sent as they are
+MIN_COMPRESSIBLE_SIZE = 128
+
+# A compressed chunk is only sent if it saves at least this fraction of the bytes
+MIN_COMPRESSION_SAVING = 0.1
+
+# Large chunks are first tried with a fast compressor on a sample this big, so random or
+# already-compressed data is recognised without compressing the whole chunk
+SAMPLE_SIZE = 16 * 1024
+
+
+# Function to decompress a zlib stream of at most `max_size` bytes
+def _zlib_decompress(data, max_size):
+    try:
+        decompressor = zlib.decompressobj()
+        chunk = decompressor.decompress(data, max_size)
+    except zlib.error as e:
+        raise ValueError(f"Corrupt zlib data: {e}") from None
+    if decompressor.unconsumed_tail or not decompressor.eof:
+        raise ValueError("zlib data is truncated or expands too far")
+    return chunk
+
+
+# Function to decompress an xz stream of at most `max_size` bytes
+def _lzma_decompress(data, max_size):
+    try:
+        decompressor = lzma.LZMADecompressor()
+        chunk = decompressor.decompress(data, max_size)
+    except lzma.LZMAError as e:
+        raise ValueError(f"Corrupt lzma data: {e}") from None
+    if not decompressor.eof:
+        raise ValueError("lzma data is truncated or expands too far")
+    return chunk
+
+
+COMPRESSORS['zlib'] = (lambda data: zlib.compress(data, COMPRESSION_LEVELS['zlib']), _zlib_decompress)
+COMPRESSORS['lzma'] = (lambda data: lzma.compress(data, preset=COMPRESSION_LEVELS['lzma']), _lzma_decompress)
+
+# Zstandard compresses about as well as zlib at several times the speed, but it's an optional dependency
+try:
+    import zstandard
+
+    # Function to decompress a zstd frame of at most `max_size` bytes
+    def _zstd_decompress(data, max_size):
+        try:
+            # A frame that records its size is decompressed in one allocation of that size, so check it first
+            if zstandard.frame_content_size(data) > max_size:
+                raise ValueError("zstd data expands too far")
+            return zstandard.ZstdDecompressor().decompress(data, max_output_size=max_size)
+        except zstandard.ZstdError as e:
+            raise ValueError(f"Corrupt zstd data: {e}") from None
+
+    COMPRESSORS['zstd'] = (lambda data: zstandard.ZstdCompressor(level=COMPRESSION_LEVELS['zstd']).compress(data),
+                           _zstd_decompress)
+except ImportError:
+    pass
+
+# Numeric ids used to name a compression algorithm on the wire (0 means "uncompressed")
+COMPRESSION_IDS = {'zlib': 1, 'lzma': 2, 'zstd': 3}
+COMPRESSION_NAMES = {compression_id: name for name, compression_id in COMPRESSION_IDS.items()}
+
+# Algorithms offered in a handshake when none are given, best first (only the installed ones)
+DEFAULT_COMPRESSION = tuple(name for name in ('zstd', 'zlib') if name in COMPRESSORS)
+
+
+# Function to check a list of compression algorithm names, returning it as a tuple
+def compression_algorithms(names):
+    names = tuple(names or ())
+    unknown = [name for name in names if name not in COMPRESSORS]
+    if unknown:
+        raise ValueError(f"Unsupported compression algorithm(s): {', '.join(unknown)}")
+    return names
+
+
+# Function to choose the algorithm for a session: the first one the client offers that we support
+def choose_compression(offered_ids, supported=None):
+    supported = COMPRESSORS if supported is None else supported
+    for compression_id in offered_ids:
+        name = COMPRESSION_NAMES.get(compression_id)
+        if name in supported:
+            return name
+    return None
+
+
+# Function to compress a chunk; returns None when the chunk is too small or doesn't compress
+# well enough to be worth it (the chunk is then sent as it is)
+def compress_chunk(chunk, algorithm):
+    size = len(chunk)
+    if size < MIN_COMPRESSIBLE_SIZE:
+        return None
+    limit = size * (1 - MIN_COMPRESSION_SAVING)
+
+    # Skip random-looking data after compressing just a sample of it
+    if size > 2 * SAMPLE_SIZE and len(zlib.compress(chunk[:SAMPLE_SIZE], 1)) > SAMPLE_SIZE * (1 - MIN_COMPRESSION_SAVING):
+        logging.debug("Chunk of %s bytes looks incompressible; sending it as is.", size)
+        return None
+
+    compressed = COMPRESSORS[algorithm][0](chunk)
+    return compressed if len(compressed) <= limit else None
+
+
+# Function to decompress a chunk sent with `algorithm`, refusing anything that expands past `max_size`
+def decompress_chunk(data, algorithm, max_size):
+    return COMPRESSORS[algorithm][1](data, max_size)
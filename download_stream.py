@@ -0,0 +1,147 @@
+import io
+import os
+import bisect
+import logging
+import threading
+from downloader import download_to_file, DownloadControl, DEFAULT_PREFETCH
+from file_utils import chunk_range
+from log_utils import setup_logging
+
+setup_logging()
+
+
+# Read-only file object over a download that is still running, so a consumer (a decompressor,
+# a parser, a media player) can start on a large file seconds after the download starts.
+# The file is downloaded into `output_file` on a background thread exactly as by
+# download_to_file (same options, resumable, served to other peers with a store), except that
+# the `prefetch` chunks from the read position on are fetched first and in order. A read only
+# blocks until the chunk under the read position is on disk; seeking moves the prefetch window.
+# Wrap it in io.BufferedReader for buffered or line-by-line reads. Closing the stream before
+# the download finishes cancels it (the partial file stays behind and can be resumed).
+class DownloadStream(io.RawIOBase):
+    def __init__(self, output_file, manifest, peer_chunk_map, prefetch=DEFAULT_PREFETCH, control=None, **options):
+        super().__init__()
+        self.output_file = output_file
+        self.manifest = manifest
+        self.control = control or DownloadControl()
+        self.position = 0  # Byte offset of the next read
+        self.complete = None  # Result of the download once it has finished
+        self.error = None  # Exception that ended the download, if any
+        self._partial = None
+        self._downloader = None
+        self._requested = 0  # Chunk the downloader was last told the reader needs
+        self._fd = None
+        self._finished = False
+        self._changed = threading.Condition()
+
+        report = options.pop('on_progress', None)
+
+        # Function to wake up readers whenever a chunk arrives (and pass the update on)
+        def on_progress(update):
+            if report is not None:
+                report(update)
+            with self._changed:
+                self._changed.notify_all()
+
+        self._thread = threading.Thread(target=self._download, daemon=True,
+                                        args=(peer_chunk_map, prefetch, on_progress, options))
+        self._thread.start()
+
+    # Function run on the download thread
+    def _download(self, peer_chunk_map, prefetch, on_progress, options):
+        try:
+            self.complete = download_to_file(self.output_file, self.manifest, peer_chunk_map, on_start=self._started,
+                                             prefetch=prefetch, control=self.control, on_progress=on_progress,
+                                             **options)
+        except Exception as e:
+            logging.error("Streaming download of %s failed: %s", self.output_file, e)
+            self.error = e
+        finally:
+            with self._changed:
+                self._finished = True
+                self._changed.notify_all()
+
+    # Function called by download_to_file once the output file exists, before any chunk is requested
+    def _started(self, partial, downloader):
+        with self._changed:
+            self._partial = partial
+            self._downloader = downloader
+            self._fd = os.open(self.output_file, os.O_RDONLY)
+            if downloader is not None:
+                downloader.seek(self._requested)
+            self._changed.notify_all()
+
+    # Function to find the chunk holding a byte offset
+    def _chunk_at(self, offset):
+        if self.manifest.chunk_offsets is not None:
+            return bisect.bisect_right(self.manifest.chunk_offsets, offset) - 1
+        return offset // self.manifest.chunk_size
+
+    # Function to block until a chunk is on disk, moving the prefetch window to it first
+    def _wait_for(self, chunk_index):
+        with self._changed:
+            if chunk_index != self._requested:
+                self._requested = chunk_index
+                if self._downloader is not None:
+                    self._downloader.seek(chunk_index)
+            while self._partial is None or not self._partial.has(chunk_index):
+                if self._finished:
+                    raise OSError(f"Chunk {chunk_index} of {self.output_file} could not be downloaded"
+                                  + (f": {self.error}" if self.error else ""))
+                self._changed.wait()
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    # Function to read into `buffer` from the read position, up to the end of the chunk it falls in
+    def readinto(self, buffer):
+        if self.closed:
+            raise ValueError("I/O operation on closed stream")
+        if self.position >= self.manifest.file_size or not len(buffer):
+            return 0
+
+        chunk_index = self._chunk_at(self.position)
+        self._wait_for(chunk_index)
+        offset, length = chunk_range(self.manifest, chunk_index)
+        data = os.pread(self._fd, min(len(buffer), offset + length - self.position), self.position)
+        buffer[:len(data)] = data
+        self.position += len(data)
+        return len(data)
+
+    # Function to move the read position; the prefetch window follows it
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.position
+        elif whence == io.SEEK_END:
+            offset += self.manifest.file_size
+        if offset < 0:
+            raise ValueError(f"Negative seek position {offset}")
+        self.position = offset
+        if offset < self.manifest.file_size:
+            with self._changed:
+                self._requested = self._chunk_at(offset)
+                if self._downloader is not None:
+                    self._downloader.seek(self._requested)
+        return offset
+
+    def tell(self):
+        return self.position
+
+    # Function to stop the download if it is still running and release the file
+    def close(self):
+        if self.closed:
+            return
+        if not self._finished:
+            self.control.cancel()
+        self._thread.join()
+        if self._fd is not None:
+            os.close(self._fd)
+        super().close()
+
+    # Function to wait for the whole download to finish; returns True if the file is complete
+    def wait(self, timeout=None):
+        self._thread.join(timeout)
+        return bool(self.complete)
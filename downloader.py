@@ -0,0 +1,667 @@
+import os
+import time
+import queue
+import random
+import socket
+import logging
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from client import connection_pool, verify_response, REQUEST_TIMEOUT
+from protocol import OP_ERROR, OP_BITFIELD, OP_CHOKED
+from partial_file import PartialFile
+from chunk_store import ContentStore
+from file_utils import load_or_build_manifest, diff_manifests, chunk_range
+from availability import AvailabilityIndex, chunks_from_bitfield, full_bitfield
+from log_utils import setup_logging, ProgressLogger
+from peer_scheduler import peer_scheduler
+from metrics import chunks_downloaded, peer_requests
+
+setup_logging()
+
+# Default number of chunk requests kept in flight to each peer
+DEFAULT_WINDOW = 8
+
+# Once this few chunks are missing, every idle peer that has one of them is asked for it too
+ENDGAME_THRESHOLD = 4
+
+# Maximum number of peers asked for the same chunk during endgame
+MAX_ENDGAME_REQUESTS = 3
+
+# Number of consecutive failures (timeouts, bad checksums, lost connections) before a peer is dropped
+MAX_PEER_FAILURES = 3
+
+# Seconds between peer list refreshes from the tracker
+TRACKER_POLL_INTERVAL = 5
+
+# With a tracker, seconds to wait for new peers when nobody has the remaining chunks
+STALL_TIMEOUT = 30
+
+# Seconds between checks for free slots on a connection another download has filled
+# (downloads sharing a connection pool share each peer's connection)
+SHARED_SLOT_POLL_INTERVAL = 0.01
+
+# Longest wait for a peer to come back from its backoff before checking on the download again
+MAX_BACKOFF_WAIT = 1.0
+
+# Seconds between checks of a paused download's control
+PAUSE_POLL_INTERVAL = 0.1
+
+# Chunks after the read position of a streamed download that are fetched first, in order
+DEFAULT_PREFETCH = 16
+
+
+# Handle for pausing, resuming or cancelling a running download from another thread (such as a GUI).
+# A paused download sends no new requests but still takes in the chunks already requested;
+# a cancelled one stops as soon as it notices, leaving a resumable partial file behind.
+class DownloadControl:
+    def __init__(self):
+        self._running = threading.Event()
+        self._running.set()
+        self._cancelled = threading.Event()
+
+    # Function to stop sending new requests until resume() is called
+    def pause(self):
+        self._running.clear()
+
+    # Function to carry on after pause()
+    def resume(self):
+        self._running.set()
+
+    # Function to stop the download
+    def cancel(self):
+        self._cancelled.set()
+        self._running.set()
+
+    @property
+    def paused(self):
+        return not self._running.is_set()
+
+    @property
+    def cancelled(self):
+        return self._cancelled.is_set()
+
+
+# Download state kept for each peer in the swarm
+class PeerState:
+    def __init__(self, name):
+        self.name = name
+        peer_ip, peer_port = name.rsplit(':', 1)
+        self.peer_ip = peer_ip
+        self.peer_port = int(peer_port)
+        self.connection = None  # Persistent connection from the pool, once connected
+        self.connecting = False
+        self.failures = 0
+        self.dead = False
+        self.queue = deque()  # Chunks this peer has, rarest first
+
+
+# Parallel swarm download engine.
+# Chunks are fetched concurrently from every peer that has them: each peer gets up to
+# `window` pipelined requests on its persistent connection, chunks are picked rarest-first,
+# and once only a few chunks remain (endgame) they are requested from several peers at
+# once, cancelling the duplicates as soon as one copy arrives.
+# With a manifest, every chunk is verified against the manifest's digest rather than
+# the digest sent by the peer. With a sink (such as a PartialFile), verified chunks are
+# handed to the sink as they arrive instead of being kept in memory.
+# `control` (a DownloadControl) lets another thread pause or cancel the download, and
+# `on_progress` is called on the download thread with a dict for each step: 'start'
+# (total_chunks, have), 'chunk' (chunk_index, peer, bytes) and 'done' (downloaded, missing,
+# cancelled), so a user interface can follow along.
+# A PeerScheduler tracks each peer's health: the fastest peers get first pick of the
+# chunks and full windows, requests time out after a peer's usual latency rather than a
+# fixed timeout, failing peers back off before they are retried, and peers that send
+# corrupt chunks are banned for a while.
+# With `prefetch`, the download is being read while it runs (see DownloadStream): the
+# `prefetch` chunks from the read position on are requested first, in order, and only
+# then the rest rarest-first. seek() moves the read position from any thread.
+class SwarmDownloader:
+    def __init__(self, peer_chunk_map, total_chunks, available_chunks=None, window=DEFAULT_WINDOW,
+                 endgame_threshold=ENDGAME_THRESHOLD, request_timeout=REQUEST_TIMEOUT,
+                 max_peer_failures=MAX_PEER_FAILURES, pool=None, manifest=None, sink=None, on_chunk=None,
+                 tracker=None, stall_timeout=STALL_TIMEOUT, scheduler=None, control=None, on_progress=None,
+                 prefetch=0):
+        self.pool = pool or connection_pool
+        self.scheduler = scheduler or peer_scheduler
+        self.manifest = manifest
+        self.file_id = manifest.root_hash if manifest else None
+        self.sink = sink
+        self.on_chunk = on_chunk
+        self.control = control
+        self.on_progress = on_progress
+        self.tracker = tracker
+        self.stall_timeout = stall_timeout
+        self.window = max(1, min(window, self.pool.max_outstanding))
+        self.endgame_threshold = endgame_threshold
+        self.request_timeout = request_timeout
+        self.max_peer_failures = max_peer_failures
+        self.prefetch = prefetch
+        self.position = 0  # Chunk the reader of a streamed download needs next
+        self.downloaded_count = 0
+
+        # Start with the chunks we already have locally
+        self.chunks = [None] * total_chunks
+        for chunk_index, chunk in (available_chunks or {}).items():
+            if 0 <= chunk_index < total_chunks:
+                self.chunks[chunk_index] = chunk
+        self.missing = {i for i in range(total_chunks) if self.chunks[i] is None and not (sink and sink.has(i))}
+
+        # Record which peers hold each chunk, then give each peer its queue of chunks
+        self.availability = AvailabilityIndex(total_chunks)
+        self.peers = {}
+        for name, peer_chunks in peer_chunk_map.items():
+            self.availability.add_chunks(name, peer_chunks)
+        for name, peer_chunks in peer_chunk_map.items():
+            self.peers[name] = PeerState(name)
+            self._queue_chunks(self.peers[name], set(peer_chunks))
+
+        self.in_flight = {}  # Maps chunk index -> {peer name: (future, deadline, connection, sent_at, first_in_request)}
+        self.events = queue.Queue()  # Completed requests and connections, handled on the download thread
+        self.pending_bitfields = 0  # BITFIELD requests still waiting for an answer
+        self.progress = ProgressLogger("Downloading", len(self.missing))  # Periodic summaries instead of a line per chunk
+
+    # Function to download every missing chunk; returns the chunk list (None where a chunk couldn't be fetched)
+    def run(self):
+        last_progress = time.monotonic()
+        downloaded_before = self.downloaded_count
+        connector = ThreadPoolExecutor(max_workers=32)
+
+        # Keep the peer list fresh from the tracker while we download
+        stop_polling = threading.Event()
+        if self.tracker is not None and self.file_id:
+            threading.Thread(target=self._poll_tracker, args=(stop_polling,), daemon=True).start()
+
+        self._report('start', total_chunks=len(self.chunks),
+                     have=[i for i in range(len(self.chunks)) if i not in self.missing])
+        cancelled = False
+        try:
+            while self.missing:
+                if self.control is not None and self.control.cancelled:
+                    logging.info("Download cancelled with %s chunks missing", len(self.missing))
+                    cancelled = True
+                    break
+
+                # While paused, only take in the chunks already requested
+                paused = self.control is not None and self.control.paused
+                if not paused:
+                    self._schedule(connector)
+
+                # Stop if nothing is in flight and no peer can provide the remaining chunks
+                # (with a tracker, wait a while for new peers to show up first)
+                waiting = PAUSE_POLL_INTERVAL if paused else self._time_until_peer_ready()
+                busy = (self.in_flight or self.pending_bitfields or waiting is not None
+                        or any(peer.connecting for peer in self.peers.values()))
+                if self.downloaded_count != downloaded_before or paused:
+                    downloaded_before, last_progress = self.downloaded_count, time.monotonic()
+                if not busy and (self.tracker is None or time.monotonic() - last_progress > self.stall_timeout):
+                    logging.error("No available peer has the remaining chunks: %s", sorted(self.missing))
+                    break
+
+                # Wait for the next completed request (or the next request deadline, or a peer becoming ready)
+                try:
+                    timeout = self._time_until_deadline()
+                    if waiting is not None:
+                        timeout = min(timeout, waiting)
+                    self._handle_event(self.events.get(timeout=timeout))
+                except queue.Empty:
+                    pass
+                self._expire_requests()
+
+        finally:
+            stop_polling.set()
+            connector.shutdown(wait=False)
+            for requests in self.in_flight.values():
+                for future, *_ in requests.values():
+                    future.cancel()
+            self.in_flight.clear()
+
+        self.progress.finish()
+        logging.debug("Downloaded %s chunks from %s peers.", self.downloaded_count, len(self.peers))
+        self._report('done', downloaded=self.downloaded_count, missing=len(self.missing), cancelled=cancelled)
+        return self.chunks
+
+    # Function to stop fetching chunks that are no longer needed (such as the rest of an
+    # erasure-coded stripe that can already be rebuilt), cancelling their requests
+    def skip(self, chunk_indices):
+        for chunk_index in chunk_indices:
+            self.missing.discard(chunk_index)
+            for future, *_ in self.in_flight.pop(chunk_index, {}).values():
+                future.cancel()
+
+    # Function to move the read position of a streamed download (safe to call from any thread)
+    def seek(self, chunk_index):
+        self.events.put(('seek', chunk_index))
+
+    # Function to pass a progress update to the on_progress callback, if there is one
+    def _report(self, kind, **details):
+        if self.on_progress is not None:
+            try:
+                self.on_progress({'type': kind, 'file_id': self.file_id, **details})
+            except Exception as e:
+                logging.error("Progress callback failed: %s", e)
+
+    # Function to hand out new requests to every peer with free slots in its window,
+    # fastest peers first so they get first pick of the chunks
+    def _schedule(self, connector):
+        endgame = len(self.missing) <= self.endgame_threshold
+        chunk_size = self.manifest.chunk_size if self.manifest else 0
+
+        for name in self.scheduler.rank(list(self.peers), chunk_size):
+            peer = self.peers[name]
+            # Skip peers that are backing off after a failure or are banned
+            if peer.dead or peer.connecting or not self.scheduler.available(name):
+                continue
+
+            # (Re)connect in the background so a dead peer doesn't stall the other downloads
+            if peer.connection is None or peer.connection.closed:
+                peer.connection = None
+                if peer.queue or endgame:
+                    peer.connecting = True
+                    future = connector.submit(self.pool.get, peer.peer_ip, peer.peer_port)
+                    future.add_done_callback(lambda f, peer=peer: self.events.put(('connected', peer, f)))
+                continue
+
+            # Fill the free part of the window (smaller for slow peers), then send those chunks as one batched request
+            free_slots = self.scheduler.window(name, self.window) - peer.connection.outstanding()
+            batch = []
+            while len(batch) < free_slots:
+                chunk_index = self._next_chunk(peer, batch)
+                if chunk_index is None and endgame:
+                    chunk_index = self._endgame_chunk(peer, batch)
+                if chunk_index is None:
+                    break
+                batch.append(chunk_index)
+            if batch:
+                self._request(peer, batch)
+
+    # Function to pick the rarest missing chunk from a peer's queue that nobody is fetching yet
+    # (`batch` holds the chunks already picked for this peer's next request); in a streamed
+    # download, the first such chunk of the prefetch window comes before them
+    def _next_chunk(self, peer, batch=()):
+        for chunk_index in range(self.position, min(self.position + self.prefetch, len(self.chunks))):
+            if (chunk_index in self.missing and chunk_index not in self.in_flight and chunk_index not in batch
+                    and self.availability.has(peer.name, chunk_index)):
+                return chunk_index
+        while peer.queue:
+            chunk_index = peer.queue.popleft()
+            if chunk_index in self.missing and chunk_index not in self.in_flight and chunk_index not in batch:
+                return chunk_index
+        return None
+
+    # Function to pick an already requested chunk to duplicate on this peer during endgame
+    # (`batch` holds the chunks already picked for this peer's next request)
+    def _endgame_chunk(self, peer, batch=()):
+        candidates = [
+            chunk_index for chunk_index in self.missing
+            if self.availability.has(peer.name, chunk_index)
+            and chunk_index not in batch
+            and peer.name not in self.in_flight.get(chunk_index, {})
+            and len(self.in_flight.get(chunk_index, {})) < MAX_ENDGAME_REQUESTS
+        ]
+        if not candidates:
+            return None
+        return min(candidates, key=lambda i: len(self.in_flight.get(i, {})))
+
+    # Function to request chunks from a peer in one round trip (a single chunk is a plain GET_CHUNK)
+    def _request(self, peer, chunk_indices):
+        connection = peer.connection
+        algorithm, file_id = (self.manifest.algorithm, self.manifest.root_hash) if self.manifest else (None, None)
+        chunk_sizes = {i: chunk_range(self.manifest, i)[1] for i in chunk_indices} if self.manifest else {}
+        try:
+            if len(chunk_indices) == 1:
+                futures = [connection.get_chunk(chunk_indices[0], self.request_timeout, algorithm, file_id,
+                                                chunk_sizes.get(chunk_indices[0]))]
+            else:
+                futures = connection.get_chunks(chunk_indices, self.request_timeout, algorithm, file_id, chunk_sizes)
+        except Exception as e:
+            for chunk_index in chunk_indices:
+                self._requeue(chunk_index)
+            self._peer_failed(peer, connection, e)
+            return False
+
+        # A batch streams back one chunk after another, so give the later chunks more time
+        start = time.monotonic()
+        timeout = self.scheduler.timeout(peer.name, self.request_timeout)
+        for position, (chunk_index, future) in enumerate(zip(chunk_indices, futures)):
+            deadline = start + timeout * (1 + position / len(chunk_indices))
+            self.in_flight.setdefault(chunk_index, {})[peer.name] = (future, deadline, connection, start, position == 0)
+            future.add_done_callback(lambda f, chunk_index=chunk_index: self.events.put(('chunk', peer, chunk_index, f)))
+        return True
+
+    # Function to add chunks a peer has to its queue, rarest first (ties broken randomly so peers spread out)
+    def _queue_chunks(self, peer, chunk_indices):
+        wanted = [i for i in chunk_indices if i in self.missing]
+        random.shuffle(wanted)
+        wanted.sort(key=self.availability.count)
+        peer.queue.extend(wanted)
+
+    # Function to merge a peer's bitfield (from the tracker or the peer itself) into the index
+    def _update_peer(self, name, bitfield):
+        peer = self.peers.get(name)
+        if peer is None:
+            peer = self.peers[name] = PeerState(name)
+            logging.info("Discovered peer %s", name)
+        if peer.dead:
+            return
+
+        # Only chunks we didn't know this peer had need to be queued
+        new_chunks = [i for i in chunks_from_bitfield(bitfield, len(self.chunks))
+                      if not self.availability.has(name, i)]
+        self.availability.add_chunks(name, new_chunks)
+        self._queue_chunks(peer, new_chunks)
+
+    # Function run on a background thread to fetch the peer list from the tracker periodically
+    def _poll_tracker(self, stop_polling):
+        while not stop_polling.is_set():
+            try:
+                self.events.put(('peers', self.tracker.get_peers(self.file_id)))
+            except Exception as e:
+                logging.error("Tracker request failed: %s", e)
+            stop_polling.wait(TRACKER_POLL_INTERVAL)
+
+    # Function to process a completed connection attempt or chunk request
+    def _handle_event(self, event):
+        if event[0] == 'seek':
+            self.position = event[1]
+            return
+
+        if event[0] == 'peers':
+            for name, bitfield in event[1].items():
+                self._update_peer(name, bitfield)
+            return
+
+        if event[0] == 'connected':
+            _, peer, future = event
+            peer.connecting = False
+            try:
+                peer.connection = future.result()
+            except Exception as e:
+                logging.error("Could not connect to %s: %s", peer.name, e)
+                self._peer_failed(peer, None, e)
+                return
+
+            # Ask the peer which chunks it has, in case it has more than we were told
+            try:
+                bitfield_future = peer.connection.get_bitfield(self.file_id)
+                self.pending_bitfields += 1
+                bitfield_future.add_done_callback(lambda f: self.events.put(('bitfield', peer, f)))
+            except Exception as e:
+                self._peer_failed(peer, peer.connection, e)
+            return
+
+        if event[0] == 'bitfield':
+            _, peer, future = event
+            self.pending_bitfields -= 1
+            if not future.cancelled() and future.exception() is None and future.result().opcode == OP_BITFIELD:
+                self._update_peer(peer.name, future.result().payload)
+            return
+
+        _, peer, chunk_index, future = event
+
+        # Ignore responses for requests we already gave up on
+        requests = self.in_flight.get(chunk_index, {})
+        entry = requests.get(peer.name)
+        if entry is None or entry[0] is not future:
+            return
+        del requests[peer.name]
+        if not requests:
+            del self.in_flight[chunk_index]
+        if future.cancelled() or chunk_index not in self.missing:
+            return
+
+        # The request failed (timeout or lost connection)
+        error = future.exception()
+        if error is not None:
+            peer_requests.inc(peer=peer.name, result='timeout' if isinstance(error, socket.timeout) else 'error')
+            logging.error("Error fetching chunk %s from %s: %s", chunk_index, peer.name, error)
+            self._requeue(chunk_index)
+            self._peer_failed(peer, entry[2], error)
+            return
+
+        response = future.result()
+
+        # The peer isn't uploading to us right now: get the chunk elsewhere, or from it after a backoff
+        if response.opcode == OP_CHOKED:
+            peer_requests.inc(peer=peer.name, result='choked')
+            logging.debug("Peer %s is choking us; requeueing chunk %s", peer.name, chunk_index)
+            self._requeue(chunk_index)
+            self.scheduler.record_choked(peer.name)
+            return
+
+        # The peer doesn't actually have this chunk, so stop asking it
+        if response.opcode == OP_ERROR:
+            peer_requests.inc(peer=peer.name, result='rejected')
+            logging.warning("Peer %s does not have chunk %s", peer.name, chunk_index)
+            self.availability.remove_chunk(peer.name, chunk_index)
+            self._requeue(chunk_index)
+            return
+
+        if self.manifest:
+            valid = verify_response(response, self.manifest.digests[chunk_index], self.manifest.algorithm)
+        else:
+            valid = verify_response(response)
+        if not valid:
+            peer_requests.inc(peer=peer.name, result='checksum_failure')
+            logging.warning("Checksum mismatch for chunk %s from %s", chunk_index, peer.name)
+            self._requeue(chunk_index)
+            self.scheduler.record_corruption(peer.name)
+            return
+
+        # Store the verified chunk and cancel any duplicate requests for it
+        if self.sink is not None:
+            self.sink.write_chunk(chunk_index, response.payload)
+        else:
+            self.chunks[chunk_index] = response.payload
+        self.missing.discard(chunk_index)
+        self.downloaded_count += 1
+        chunks_downloaded.inc()
+        peer_requests.inc(peer=peer.name, result='success')
+        self.progress.update(1, len(response.payload))
+        self.scheduler.record_success(peer.name, entry[3], len(response.payload), entry[4])
+        self._extend_deadlines(peer)
+        peer.failures = 0
+        logging.debug("Downloaded chunk %s from %s", chunk_index, peer.name)
+        if self.on_chunk is not None:
+            self.on_chunk(chunk_index)
+        self._report('chunk', chunk_index=chunk_index, peer=peer.name, bytes=len(response.payload))
+
+        for other_name, (other_future, *_) in self.in_flight.pop(chunk_index, {}).items():
+            other_future.cancel()
+            logging.debug("Cancelled duplicate request for chunk %s to %s", chunk_index, other_name)
+
+    # Function to put a chunk back at the front of every live holder's queue
+    def _requeue(self, chunk_index):
+        if chunk_index not in self.missing or chunk_index in self.in_flight:
+            return
+        for name in self.availability.holders(chunk_index):
+            self.peers[name].queue.appendleft(chunk_index)
+
+    # Function to record a failure for a peer: the peer backs off before it is tried again,
+    # and is dropped once it fails too often in a row
+    def _peer_failed(self, peer, connection, error):
+        # Several requests fail together when a connection dies; only count that once
+        if connection is not None:
+            if connection is not peer.connection:
+                return
+            self.pool.discard(connection, error)
+            peer.connection = None
+
+        self.scheduler.record_failure(peer.name)
+        peer.failures += 1
+        if peer.failures >= self.max_peer_failures and not peer.dead:
+            peer.dead = True
+            self.availability.remove_peer(peer.name)
+            logging.error("Dropping peer %s after %s failures", peer.name, peer.failures)
+
+    # Function to push back the deadlines of a peer's other requests when one of its chunks arrives:
+    # a peer that keeps delivering (e.g. one limiting its upload rate) is slow, not stuck, and the
+    # requests queued behind the chunk that arrived are only now being served
+    def _extend_deadlines(self, peer):
+        now = time.monotonic()
+        for requests in self.in_flight.values():
+            entry = requests.get(peer.name)
+            if entry is not None:
+                future, deadline, connection, sent_at, first_in_request = entry
+                requests[peer.name] = (future, max(deadline, now + deadline - sent_at), connection, sent_at,
+                                       first_in_request)
+
+    # Function to fail requests that have been waiting longer than the request timeout
+    def _expire_requests(self):
+        now = time.monotonic()
+        for chunk_index, requests in list(self.in_flight.items()):
+            for name, (future, deadline, connection, *_) in list(requests.items()):
+                if deadline <= now and not future.done():
+                    logging.error("Request for chunk %s to %s timed out", chunk_index, name)
+                    # Closing the connection fails every request on it, which requeues their chunks
+                    self.pool.discard(connection, socket.timeout("request timed out"))
+
+    # Function to return how long until a peer that has chunks for us can take requests again,
+    # because it is backing off after a failure or its connection's window is full of requests
+    # from another download sharing the connection (None if no peer is waiting like that;
+    # banned peers don't count, so a download doesn't wait out a ban)
+    def _time_until_peer_ready(self):
+        requesting = {name for requests in self.in_flight.values() for name in requests}
+        waits = []
+        for peer in self.peers.values():
+            if peer.dead or not peer.queue or peer.name in requesting or self.scheduler.banned(peer.name):
+                continue
+            backoff = self.scheduler.retry_in(peer.name)
+            if backoff:
+                waits.append(min(backoff, MAX_BACKOFF_WAIT))
+            elif (peer.connection is not None and not peer.connection.closed
+                  and peer.connection.outstanding() >= self.scheduler.window(peer.name, self.window)):
+                waits.append(SHARED_SLOT_POLL_INTERVAL)
+        return min(waits) if waits else None
+
+    # Function to work out how long to wait for the next event
+    def _time_until_deadline(self):
+        deadlines = [entry[1] for requests in self.in_flight.values() for entry in requests.values()]
+        if not deadlines:
+            return 1.0
+        return min(1.0, max(0.01, min(deadlines) - time.monotonic()))
+
+
+# Function to download the chunks missing from `available_chunks` using every peer in `peer_chunk_map`
+def download_chunks(available_chunks, peer_chunk_map, total_chunks, **options):
+    downloader = SwarmDownloader(peer_chunk_map, total_chunks, available_chunks, **options)
+    return downloader.run(), downloader.downloaded_count
+
+
+# Function to download a file described by `manifest` straight into `output_file`.
+# Chunks are written to disk as they are verified, and an interrupted download picks up
+# where it left off the next time this is called. With a ContentStore, chunks the store
+# already holds (from any file) are copied locally instead of downloaded, chunks are served
+# to other peers as soon as they are written, and the finished file stays in the store so
+# this node seeds it. `local` is another source of chunks to copy rather than download
+# (anything with the store's find_chunk, such as a ContentStore holding an older version
+# of the file). With a TrackerClient (that has our listen port), the node announces
+# itself as a source of the file and sends a HAVE for every chunk it finishes.
+# `skip`, if given, is called as skip(partial, chunk_index) for every chunk on disk and returns
+# the chunks that are no longer needed because of it; those are not downloaded.
+# `on_start`, if given, is called as on_start(partial, downloader) once the local chunks are
+# in place, just before the download starts (downloader is None if nothing is missing).
+# Returns True once the file is complete (every chunk that is still needed is on disk).
+def download_to_file(output_file, manifest, peer_chunk_map, store=None, tracker=None, skip=None, local=None,
+                     on_start=None, **options):
+    file_id = manifest.root_hash
+    with PartialFile(output_file, manifest.file_size, manifest.chunk_size, bytes.fromhex(file_id),
+                     manifest.chunk_offsets, manifest.digests, manifest.algorithm) as partial:
+        sources = [source for source in (store, local) if source is not None]
+        for chunk_index in partial.missing() if sources else ():
+            for source in sources:
+                chunk = source.find_chunk(manifest.algorithm, manifest.digests[chunk_index])
+                if chunk is not None:
+                    partial.write_chunk(chunk_index, chunk)
+                    break
+        if store is not None:
+            store.add_partial_file(manifest, partial)
+
+        # Only announce chunks we can actually serve, i.e. when a store backs our server
+        announcing = store is not None and tracker is not None and tracker.listen_port is not None
+        if announcing:
+            _announce(tracker, file_id, partial.bitfield)
+
+        # Chunks made unnecessary by the chunks already on disk
+        unneeded = set()
+        if skip is not None:
+            for chunk_index in range(partial.total_chunks):
+                if partial.has(chunk_index):
+                    unneeded.update(skip(partial, chunk_index))
+
+        # Function called with each chunk as soon as it is on disk
+        def chunk_done(chunk_index):
+            if skip is not None:
+                downloader.skip(skip(partial, chunk_index))
+            if store is not None:
+                store.chunk_written(file_id, chunk_index)
+            if announcing:
+                try:
+                    tracker.have(file_id, chunk_index)
+                except socket.error as e:
+                    logging.error("Failed to send HAVE %s to the tracker: %s", chunk_index, e)
+
+        complete = partial.complete()
+        if complete:
+            if on_start is not None:
+                on_start(partial, None)
+        else:
+            downloader = SwarmDownloader(peer_chunk_map, partial.total_chunks, manifest=manifest, sink=partial,
+                                         on_chunk=chunk_done, tracker=tracker, **options)
+            downloader.skip(unneeded)
+            if on_start is not None:
+                on_start(partial, downloader)
+            downloader.run()
+            complete = not downloader.missing
+        bitfield = bytes(partial.bitfield)
+
+    if partial.complete() and store is not None:
+        store.add_file(output_file, manifest=manifest)
+    if announcing:
+        _announce(tracker, file_id, bitfield)
+    return complete
+
+
+# Function to update `local_file`, an older version of a file, to the version described by `manifest`,
+# writing it to `output_file` (which may be `local_file` itself). The old version is cut into chunks
+# the same way as the new one and only the chunks it doesn't have are downloaded; the rest are
+# copied from it. With content-defined chunks (see file_utils.content_defined_chunks) an insertion
+# or deletion only changes the chunks around it, so little more than the changed bytes is fetched.
+# Other arguments are as for download_to_file (a file updated in place must not be one the store
+# seeds, since the store would go on reading the old version). Returns True once the new version is complete.
+def sync_to_file(output_file, manifest, local_file, peer_chunk_map, store=None, tracker=None, **options):
+    old_manifest = load_or_build_manifest(local_file, manifest.chunk_size, algorithm=manifest.algorithm,
+                                          content_defined=manifest.chunk_offsets is not None)
+    reused = diff_manifests(old_manifest, manifest)
+    reused_bytes = sum(chunk_range(manifest, chunk_index)[1] for chunk_index in reused)
+    logging.info("Syncing %s from %s: %s/%s chunks (%s/%s bytes) unchanged, %s to download.", output_file,
+                 local_file, len(reused), len(manifest.digests), reused_bytes, manifest.file_size,
+                 len(manifest.digests) - len(reused))
+
+    local = ContentStore()
+    try:
+        local.add_file(local_file, manifest=old_manifest)
+        if os.path.abspath(output_file) != os.path.abspath(local_file):
+            return download_to_file(output_file, manifest, peer_chunk_map, store, tracker, local=local, **options)
+
+        # Updating in place: build the new version next to the old one, which is read until it is done.
+        # The store only serves it once it has replaced the old version.
+        temp_file = output_file + '.sync'
+        if not download_to_file(temp_file, manifest, peer_chunk_map, tracker=tracker, local=local, **options):
+            return False
+    finally:
+        local.close()
+
+    os.replace(temp_file, output_file)
+    if store is not None:
+        store.add_file(output_file, manifest=manifest)
+        if tracker is not None and tracker.listen_port is not None:
+            _announce(tracker, manifest.root_hash, full_bitfield(len(manifest.digests)))
+    return True
+
+
+# Function to announce our chunks of a file to the tracker, logging (not raising) failures
+def _announce(tracker, file_id, bitfield):
+    try:
+        tracker.announce(file_id, bitfield)
+    except Exception as e:
+        logging.error("Failed to announce %s to the tracker: %s", file_id, e)
@@ -0,0 +1,304 @@
+import os
+import struct
+import logging
+import argparse
+from collections import namedtuple
+from file_utils import rebuild_file, choose_chunk_size, load_or_build_manifest, DEFAULT_HASH_ALGORITHM
+from downloader import download_to_file
+from log_utils import setup_logging
+
+# NumPy vectorizes the field arithmetic, but it's an optional dependency
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+setup_logging()
+
+# Default stripe shape: every DATA_SHARDS chunks of a file get PARITY_SHARDS parity chunks,
+# and any DATA_SHARDS chunks of a stripe are enough to rebuild it
+DEFAULT_DATA_SHARDS = 8
+DEFAULT_PARITY_SHARDS = 4
+
+# Irreducible polynomial of the GF(2^8) field the coding works in (x^8 + x^4 + x^3 + x^2 + 1)
+GF_POLYNOMIAL = 0x11d
+
+# Erasure layout sidecar: magic, version, original file size, chunk size, data shards, parity shards
+LAYOUT_MAGIC = b'P2EC'
+LAYOUT_VERSION = 1
+LAYOUT_HEADER = struct.Struct('!4sBQIBB')
+
+# How a file was erasure coded. The coded file is the original file cut into stripes of
+# `data_shards` chunks (the last chunk zero-padded, and missing chunks of the last stripe all
+# zeros), each stripe followed by its `parity_shards` parity chunks, all `chunk_size` bytes.
+ErasureLayout = namedtuple('ErasureLayout', ['file_size', 'chunk_size', 'data_shards', 'parity_shards'])
+
+
+# Log and antilog tables of the field, for multiplying and inverting elements
+GF_EXP = [0] * 512
+GF_LOG = [0] * 256
+_value = 1
+for _power in range(255):
+    GF_EXP[_power] = _value
+    GF_LOG[_value] = _power
+    _value <<= 1
+    if _value & 0x100:
+        _value ^= GF_POLYNOMIAL
+for _power in range(255, 512):
+    GF_EXP[_power] = GF_EXP[_power - 255]
+
+
+# Function to multiply two field elements
+def gf_mul(a, b):
+    if a == 0 or b == 0:
+        return 0
+    return GF_EXP[GF_LOG[a] + GF_LOG[b]]
+
+
+# Function to invert a (non-zero) field element
+def gf_inverse(a):
+    if a == 0:
+        raise ZeroDivisionError("0 has no inverse in GF(256)")
+    return GF_EXP[255 - GF_LOG[a]]
+
+
+# Multiplication tables: MUL_TABLES[c] maps every byte x to c * x. Without NumPy they are used
+# with bytes.translate(), which multiplies a whole shard by c at C speed.
+MUL_TABLES = [bytes(gf_mul(c, x) for x in range(256)) for c in range(256)]
+MUL_ARRAY = numpy.frombuffer(b''.join(MUL_TABLES), dtype=numpy.uint8).reshape(256, 256) if numpy else None
+
+
+# Function to add up (XOR) shards scaled by field coefficients: sum of coefficients[i] * shards[i]
+def combine(coefficients, shards, size):
+    if numpy is not None:
+        total = numpy.zeros(size, dtype=numpy.uint8)
+        for coefficient, shard in zip(coefficients, shards):
+            if coefficient:
+                values = numpy.frombuffer(shard, dtype=numpy.uint8)
+                total ^= values if coefficient == 1 else MUL_ARRAY[coefficient][values]
+        return total.tobytes()
+
+    # Without NumPy, scale each shard with a translation table and add them as big integers
+    total = 0
+    for coefficient, shard in zip(coefficients, shards):
+        if coefficient:
+            shard = bytes(shard)
+            total ^= int.from_bytes(shard if coefficient == 1 else shard.translate(MUL_TABLES[coefficient]), 'little')
+    return total.to_bytes(size, 'little')
+
+
+# Function to build the parity rows of the coding matrix.
+# Row i, column j is 1 / (x_i + y_j) with x_i = data_shards + i and y_j = j (a Cauchy matrix),
+# so the identity rows of the data shards plus any of these rows leave every square
+# selection invertible: any `data_shards` chunks of a stripe determine the others.
+def parity_matrix(data_shards, parity_shards):
+    if not 0 < data_shards or not 0 <= parity_shards or data_shards + parity_shards > 256:
+        raise ValueError("A stripe needs 1 or more data shards and at most 256 shards in all")
+    return [[gf_inverse((data_shards + i) ^ j) for j in range(data_shards)] for i in range(parity_shards)]
+
+
+# Function to invert a square matrix over the field (Gauss-Jordan elimination)
+def invert_matrix(matrix):
+    size = len(matrix)
+    rows = [list(row) + [int(i == j) for j in range(size)] for i, row in enumerate(matrix)]
+    for column in range(size):
+        pivot = next((r for r in range(column, size) if rows[r][column]), None)
+        if pivot is None:
+            raise ValueError("The coding matrix is singular")
+        rows[column], rows[pivot] = rows[pivot], rows[column]
+
+        # Scale the pivot row to 1, then clear the column from every other row
+        scale = gf_inverse(rows[column][column])
+        rows[column] = [gf_mul(scale, value) for value in rows[column]]
+        for r in range(size):
+            factor = rows[r][column]
+            if r != column and factor:
+                rows[r] = [value ^ gf_mul(factor, pivot_value) for value, pivot_value in zip(rows[r], rows[column])]
+    return [row[size:] for row in rows]
+
+
+# Function to work out the parity chunks of one stripe of equally sized data chunks
+def encode_stripe(data, parity_shards, matrix=None):
+    matrix = matrix or parity_matrix(len(data), parity_shards)
+    size = len(data[0])
+    return [combine(row, data, size) for row in matrix]
+
+
+# Function to rebuild the data chunks of a stripe from any `data_shards` of its chunks.
+# `shards` maps a shard's position in the stripe (data first, then parity) to its bytes.
+def decode_stripe(shards, data_shards, parity_shards, matrix=None):
+    if len(shards) < data_shards:
+        raise ValueError(f"A stripe needs {data_shards} chunks to be rebuilt, got {len(shards)}")
+    if all(i in shards for i in range(data_shards)):
+        return [shards[i] for i in range(data_shards)]
+
+    # Use every data shard we have, then as many parity shards as it takes
+    matrix = matrix or parity_matrix(data_shards, parity_shards)
+    chosen = sorted(shards)[:data_shards]
+    rows = [[int(i == j) for j in range(data_shards)] if i < data_shards else matrix[i - data_shards]
+            for i in chosen]
+    inverse = invert_matrix(rows)
+    chosen_shards = [shards[i] for i in chosen]
+    size = len(chosen_shards[0])
+    return [shards[j] if j in shards else combine(inverse[j], chosen_shards, size) for j in range(data_shards)]
+
+
+# Function to return the number of stripes and chunks of each kind in a layout
+def stripe_counts(layout):
+    data_chunks = (layout.file_size + layout.chunk_size - 1) // layout.chunk_size
+    stripes = (data_chunks + layout.data_shards - 1) // layout.data_shards
+    return stripes, data_chunks
+
+
+# Function to erasure code a list of chunks (such as chunk_file's output); returns the coded chunk list
+def encode_chunks(chunks, data_shards=DEFAULT_DATA_SHARDS, parity_shards=DEFAULT_PARITY_SHARDS):
+    chunk_size = max((len(chunk) for chunk in chunks), default=0)
+    matrix = parity_matrix(data_shards, parity_shards)
+    coded = []
+    for start in range(0, len(chunks), data_shards):
+        data = [bytes(chunk).ljust(chunk_size, b'\0') for chunk in chunks[start:start + data_shards]]
+        data += [bytes(chunk_size)] * (data_shards - len(data))
+        coded += data + encode_stripe(data, parity_shards, matrix)
+    return coded
+
+
+# Function to recover the original chunks from coded chunks (None where a chunk is missing)
+def decode_chunks(coded, layout):
+    stripe_shards = layout.data_shards + layout.parity_shards
+    matrix = parity_matrix(layout.data_shards, layout.parity_shards)
+    _, data_chunks = stripe_counts(layout)
+    chunks = []
+    for start in range(0, len(coded), stripe_shards):
+        shards = {i: chunk for i, chunk in enumerate(coded[start:start + stripe_shards]) if chunk is not None}
+        chunks += decode_stripe(shards, layout.data_shards, layout.parity_shards, matrix)
+    chunks = chunks[:data_chunks]
+    if chunks:
+        chunks[-1] = chunks[-1][:layout.file_size - (data_chunks - 1) * layout.chunk_size]
+    return chunks
+
+
+# Function to write a layout sidecar (atomically, via a temporary file)
+def save_layout(layout, layout_path):
+    temp_path = layout_path + '.tmp'
+    with open(temp_path, 'wb') as f:
+        f.write(LAYOUT_HEADER.pack(LAYOUT_MAGIC, LAYOUT_VERSION, *layout))
+    os.replace(temp_path, layout_path)
+
+
+# Function to read a layout sidecar written by save_layout
+def load_layout(layout_path):
+    with open(layout_path, 'rb') as f:
+        data = f.read()
+    try:
+        magic, version, *fields = LAYOUT_HEADER.unpack(data)
+    except struct.error:
+        raise ValueError(f"{layout_path} is not an erasure layout file") from None
+    if magic != LAYOUT_MAGIC or version != LAYOUT_VERSION:
+        raise ValueError(f"{layout_path} is not a supported erasure layout file")
+    return ErasureLayout(*fields)
+
+
+# Function to erasure code a file into `coded_path` (default: <file>.rs) one stripe at a time;
+# returns the layout, which is also saved next to the coded file (<coded file>.erasure).
+# The coded file is seeded and downloaded like any other file (it has a manifest of its own).
+def encode_file(file_path, coded_path=None, chunk_size=None, data_shards=DEFAULT_DATA_SHARDS,
+                parity_shards=DEFAULT_PARITY_SHARDS):
+    coded_path = coded_path or file_path + '.rs'
+    file_size = os.path.getsize(file_path)
+    layout = ErasureLayout(file_size, chunk_size or choose_chunk_size(file_size), data_shards, parity_shards)
+    matrix = parity_matrix(data_shards, parity_shards)
+    stripe_bytes = layout.chunk_size * data_shards
+
+    with open(file_path, 'rb') as source, open(coded_path, 'wb') as coded:
+        while block := source.read(stripe_bytes):
+            block = block.ljust(stripe_bytes, b'\0')
+            data = [block[i:i + layout.chunk_size] for i in range(0, stripe_bytes, layout.chunk_size)]
+            coded.write(block)
+            for parity in encode_stripe(data, parity_shards, matrix):
+                coded.write(parity)
+
+    save_layout(layout, coded_path + '.erasure')
+    stripes, data_chunks = stripe_counts(layout)
+    logging.info("Erasure coded %s into %s: %s data chunks in %s stripes of %s+%s chunks.", file_path, coded_path,
+                 data_chunks, stripes, data_shards, parity_shards)
+    return layout
+
+
+# Function to rebuild the original file from a coded file of which only the chunks in
+# `available` are on disk (None if all of them are); each stripe needs `data_shards` of them
+def decode_file(coded_path, layout, output_file, available=None):
+    stripes, data_chunks = stripe_counts(layout)
+    stripe_shards = layout.data_shards + layout.parity_shards
+    matrix = parity_matrix(layout.data_shards, layout.parity_shards)
+
+    # Function to yield the original chunks one stripe at a time, for rebuild_file
+    def data_chunks_of(coded):
+        for stripe in range(stripes):
+            first = stripe * stripe_shards
+            positions = [i for i in range(stripe_shards) if available is None or first + i in available]
+
+            # Read the data chunks we have and only as many parity chunks as the rebuild needs
+            have_data = [i for i in positions if i < layout.data_shards]
+            positions = have_data + [i for i in positions if i >= layout.data_shards][:layout.data_shards - len(have_data)]
+            shards = {i: os.pread(coded.fileno(), layout.chunk_size, (first + i) * layout.chunk_size) for i in positions}
+            for i, chunk in enumerate(decode_stripe(shards, layout.data_shards, layout.parity_shards, matrix)):
+                chunk_index = stripe * layout.data_shards + i
+                if chunk_index < data_chunks:
+                    yield chunk[:layout.file_size - chunk_index * layout.chunk_size]
+
+    with open(coded_path, 'rb') as coded:
+        rebuild_file(data_chunks_of(coded), output_file)
+
+
+# Function to download an erasure-coded file and rebuild the original into `output_file`.
+# `manifest` is the coded file's manifest. Chunks are requested from every peer at once, and
+# as soon as any `data_shards` chunks of a stripe are on disk the rest of that stripe is dropped,
+# so slow or missing peers only hold up a stripe if fewer than `data_shards` of its chunks
+# can be had. The coded chunks go to <output_file>.rs (and are served from there with a store).
+# Returns True once the original file has been rebuilt.
+def download_erasure_coded(output_file, manifest, layout, peer_chunk_map, store=None, tracker=None, **options):
+    stripe_shards = layout.data_shards + layout.parity_shards
+    have = set()
+
+    # Function to list the chunks of a stripe that are no longer needed once a chunk is on disk
+    def unneeded(partial, chunk_index):
+        have.add(chunk_index)
+        first = chunk_index - chunk_index % stripe_shards
+        stripe = range(first, first + stripe_shards)
+        if sum(partial.has(i) for i in stripe) < layout.data_shards:
+            return ()
+        return [i for i in stripe if not partial.has(i)]
+
+    coded_path = output_file + '.rs'
+    if not download_to_file(coded_path, manifest, peer_chunk_map, store, tracker, skip=unneeded, **options):
+        return False
+    decode_file(coded_path, layout, output_file, have)
+    return True
+
+
+# Function to read a file's coded form and layout written by encode_file; returns (manifest, layout)
+def load_coded_file(coded_path, algorithm=DEFAULT_HASH_ALGORITHM):
+    layout = load_layout(coded_path + '.erasure')
+    return load_or_build_manifest(coded_path, layout.chunk_size, algorithm=algorithm), layout
+
+
+# Entry point: erasure code a file, or rebuild one from its complete coded form
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Erasure code files with Reed-Solomon over GF(256).")
+    commands = parser.add_subparsers(dest='command', required=True)
+    encode_parser = commands.add_parser('encode', help="write <file>.rs, its layout and its manifest")
+    encode_parser.add_argument('file')
+    encode_parser.add_argument('--chunk-size', type=int, default=None, help="bytes per chunk (default: chosen from the file size)")
+    encode_parser.add_argument('--data-shards', type=int, default=DEFAULT_DATA_SHARDS, help="data chunks per stripe")
+    encode_parser.add_argument('--parity-shards', type=int, default=DEFAULT_PARITY_SHARDS, help="parity chunks per stripe")
+    decode_parser = commands.add_parser('decode', help="rebuild the original file from a coded file")
+    decode_parser.add_argument('coded_file')
+    decode_parser.add_argument('output')
+    args = parser.parse_args()
+
+    if args.command == 'encode':
+        encode_file(args.file, chunk_size=args.chunk_size, data_shards=args.data_shards,
+                    parity_shards=args.parity_shards)
+        load_coded_file(args.file + '.rs')
+    else:
+        decode_file(args.coded_file, load_layout(args.coded_file + '.erasure'), args.output)
@@ -1,38 +1,494 @@
+import os
+import struct
 import logging
 import hashlib
+import threading
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from log_utils import setup_logging, ProgressLogger
 
 # Set up logging to display informational messages
-logging.basicConfig(level=logging.INFO)
+setup_logging()
+
+# Hash algorithms that can be used for chunk checksums, by name
+HASH_ALGORITHMS = {
+    'md5': hashlib.md5,
+    'sha256': hashlib.sha256,
+    'blake2b': hashlib.blake2b,
+}
+
+# xxHash is much faster than the cryptographic hashes, but it's an optional dependency
+try:
+    import xxhash
+    HASH_ALGORITHMS['xxh3_128'] = xxhash.xxh3_128
+except ImportError:
+    pass
+
+# NumPy finds content-defined chunk boundaries a whole block at a time, but it's an optional dependency
+# (see requirements-optional.txt); without it they are found by a pure-Python loop at a few MB/s
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Numeric ids used to name a hash algorithm on the wire and in manifest files (0 means "not specified")
+HASH_IDS = {'md5': 1, 'sha256': 2, 'blake2b': 3, 'xxh3_128': 4}
+HASH_NAMES = {hash_id: name for name, hash_id in HASH_IDS.items()}
+
+# SHA-256 is hardware-accelerated on most current CPUs, which makes it faster than MD5 or BLAKE2 there
+DEFAULT_HASH_ALGORITHM = 'sha256'
+
+# Size of the buffer used when hashing whole files
+FILE_HASH_BUFFER_SIZE = 1024 * 1024
+
+# Range of chunk sizes picked for a file when no chunk size is given
+MIN_CHUNK_SIZE = 16 * 1024
+MAX_CHUNK_SIZE = 4 * 1024 * 1024
+
+# Number of chunks a file is aimed to be split into when its chunk size is picked automatically
+TARGET_CHUNK_COUNT = 1024
+
+# Files smaller than this are hashed on the calling thread (starting workers would cost more than it saves)
+PARALLEL_HASH_MIN_SIZE = 32 * 1024 * 1024
+
+# Bytes of the file covered by each parallel hashing task (rounded to whole chunks)
+HASH_RANGE_SIZE = 16 * 1024 * 1024
+
+# Default number of workers hashing a large file
+DEFAULT_HASH_WORKERS = os.cpu_count() or 1
+
+# Content-defined chunks are between average/CDC_SIZE_RATIO and average*CDC_SIZE_RATIO bytes long
+CDC_SIZE_RATIO = 4
+
+# Bytes read at a time while looking for content-defined chunk boundaries
+CDC_READ_SIZE = 4 * 1024 * 1024
+
+# Gear table of the rolling hash that places content-defined chunk boundaries: one fixed
+# pseudo-random 64-bit value per byte value (every node must use the same table)
+GEAR = [int.from_bytes(hashlib.sha256(b'gear %d' % value).digest()[:8], 'big') for value in range(256)]
+GEAR_MASK = (1 << 64) - 1
+
+# The gear hash only depends on the last 64 bytes it has seen (older ones are shifted out)
+GEAR_WINDOW = 64
+GEAR_ARRAY = numpy.array(GEAR, dtype=numpy.uint64) if numpy else None
+
+# Bytes whose gear hashes are computed together (their 64-bit hashes fit in the CPU cache)
+GEAR_SEGMENT = 64 * 1024
+
+# Without NumPy, content-defined chunking runs at a few MB/s; files larger than this get a warning
+CDC_SLOW_WARNING_SIZE = 256 * 1024 * 1024
+
+# Function to pick a chunk size for a file of the given size
+def choose_chunk_size(file_size):
+    """Returns the power-of-two chunk size (16 KiB to 4 MiB) that splits a file into about TARGET_CHUNK_COUNT chunks."""
+    chunk_size = MIN_CHUNK_SIZE
+    while chunk_size < MAX_CHUNK_SIZE and chunk_size * TARGET_CHUNK_COUNT < file_size:
+        chunk_size *= 2
+    return chunk_size
+
+# Function to look up a hash algorithm by name
+def get_hash_function(algorithm=DEFAULT_HASH_ALGORITHM):
+    """Returns the hashlib-style constructor for a registered hash algorithm."""
+    try:
+        return HASH_ALGORITHMS[algorithm]
+    except KeyError:
+        raise ValueError(f"Unsupported hash algorithm: {algorithm}") from None
+
+# Function to generate a binary digest for a data chunk
+def generate_digest(data, algorithm=DEFAULT_HASH_ALGORITHM):
+    """Generates the binary digest of a data chunk."""
+    return get_hash_function(algorithm)(data).digest()
 
 # Function to generate a checksum for a data chunk
-def generate_checksum(data):
-    """Generates an MD5 checksum for a given data chunk."""
-    return hashlib.md5(data).hexdigest()
+def generate_checksum(data, algorithm=DEFAULT_HASH_ALGORITHM):
+    """Generates a hexadecimal checksum for a given data chunk."""
+    return generate_digest(data, algorithm).hex()
 
 # Function to verify if a chunk matches the expected checksum
-def verify_chunk(chunk, expected_checksum):
-    """Verifies the checksum of a data chunk against an expected checksum."""
-    actual_checksum = generate_checksum(chunk)
-    return actual_checksum == expected_checksum
+def verify_chunk(chunk, expected_checksum, algorithm=DEFAULT_HASH_ALGORITHM):
+    """Verifies a data chunk against an expected binary digest or hexadecimal checksum."""
+    actual_digest = generate_digest(chunk, algorithm)
+    if isinstance(expected_checksum, str):
+        return actual_digest.hex() == expected_checksum
+    return actual_digest == expected_checksum
 
 # Function to compute the hash of a file for integrity verification
-def compute_file_hash(file_path, chunk_size=512):
-    """Computes a SHA-256 hash for the entire file."""
-    hash_func = hashlib.sha256()
-    
-    # Open the file in binary read mode
-    with open(file_path, 'rb') as f:
-        # Read the file in chunks of the specified size (default 512 bytes)
-        while chunk := f.read(chunk_size):
-            # Update the hash with the content of each chunk
-            hash_func.update(chunk)
-    
+def compute_file_hash(file_path, chunk_size=FILE_HASH_BUFFER_SIZE, algorithm='sha256'):
+    """Computes a hash (SHA-256 by default) for the entire file."""
+    hash_func = get_hash_function(algorithm)()
+
+    # Read into one reusable buffer so large files are hashed at disk speed
+    buffer = bytearray(chunk_size)
+    view = memoryview(buffer)
+    with open(file_path, 'rb', buffering=0) as f:
+        while count := f.readinto(buffer):
+            hash_func.update(view[:count])
+
     # Return the computed hash as a hexadecimal string
     return hash_func.hexdigest()
 
+# Chunk manifest: everything a peer needs to verify a file without trusting the sender.
+# `digests` holds the binary digest of every chunk, computed with `algorithm`, and
+# `root_hash` is the hash of all chunk digests, so it identifies the whole file.
+# Files cut into content-defined chunks (see content_defined_chunks) also carry
+# `chunk_offsets`, where every chunk starts plus the file size at the end, and their
+# `chunk_size` is the average chunk size they were cut for; for fixed-size chunks it is None.
+Manifest = namedtuple('Manifest', ['file_size', 'chunk_size', 'digests', 'root_hash', 'algorithm', 'chunk_offsets'],
+                      defaults=(None,))
+
+# On-disk manifest layout: header, then the root hash, then every chunk digest back to back
+# (version 3, for content-defined chunks, then adds every chunk's length as a 4-byte integer)
+MANIFEST_MAGIC = b'P2MF'
+MANIFEST_VERSION = 2
+CDC_MANIFEST_VERSION = 3
+MANIFEST_HEADER = struct.Struct('!4sBQIIBB')  # magic, version, file_size, chunk_size, chunk_count, hash_id, digest_size
+
+# Function to compute the root hash of a list of chunk digests
+def compute_root_hash(digests, algorithm=DEFAULT_HASH_ALGORITHM):
+    """Computes the hash of the concatenated binary chunk digests."""
+    hash_func = get_hash_function(algorithm)()
+    for digest in digests:
+        hash_func.update(digest)
+    return hash_func.hexdigest()
+
+# Function to find where a chunk of a file is
+def chunk_range(manifest, chunk_index):
+    """Returns the (offset, length) of a chunk described by a manifest."""
+    if manifest.chunk_offsets is not None:
+        offset = manifest.chunk_offsets[chunk_index]
+        return offset, manifest.chunk_offsets[chunk_index + 1] - offset
+    offset = chunk_index * manifest.chunk_size
+    return offset, min(manifest.chunk_size, manifest.file_size - offset)
+
+# Function to find every place in a block of data where a content-defined chunk may end (needs NumPy)
+def gear_boundaries(data, mask):
+    """Returns the sorted offsets `end` (from GEAR_WINDOW on) where the gear hash of data[:end] matches `mask`.
+
+    The hashes of every position are computed at once: the hash of a window of 2w bytes is the
+    hash of its newer w bytes plus the hash of its older w bytes shifted left by w, so six passes
+    build the hashes of all 64-byte windows. The data is taken GEAR_SEGMENT bytes at a time, so
+    the passes run over 64-bit hashes that are still in the CPU cache.
+    """
+    values = numpy.frombuffer(data, dtype=numpy.uint8)
+    mask = numpy.uint64(mask)
+    shifted = numpy.empty(GEAR_SEGMENT + GEAR_WINDOW, dtype=numpy.uint64)
+    found = [numpy.empty(0, dtype=numpy.intp)]
+    for segment in range(0, len(values), GEAR_SEGMENT):
+        # Start with the bytes before the segment that the hashes of its first positions depend on
+        first = max(0, segment - GEAR_WINDOW + 1)
+        hashes = GEAR_ARRAY[values[first:segment + GEAR_SEGMENT]]
+        width = 1
+        while width < min(GEAR_WINDOW, len(hashes)):
+            count = len(hashes) - width
+            numpy.left_shift(hashes[:count], numpy.uint64(width), out=shifted[:count])
+            hashes[width:] += shifted[:count]  # uint64 arithmetic wraps like GEAR_MASK
+            width *= 2
+
+        # Offsets below GEAR_WINDOW are left out, as their windows are cut short by the start of the data
+        ends = numpy.flatnonzero((hashes & mask) == 0) + (first + 1)
+        found.append(ends[ends >= max(GEAR_WINDOW, segment + 1)])
+    return numpy.concatenate(found)
+
+# Function to find the end of the content-defined chunk that starts at `start`
+def find_chunk_boundary(data, start, min_size, max_size, mask, boundaries=None):
+    """Returns the end of the chunk starting at `start`, or None if `data` runs out before it is found.
+
+    The gear hash rolls over the data and a boundary falls after the first byte (at least `min_size`
+    bytes in) where the hash's top bits selected by `mask` are all zero, or at `max_size` bytes.
+    Boundaries depend only on the bytes around them, so an insertion or deletion moves the
+    boundaries near it and leaves the chunks after it unchanged. `boundaries`, if given, is
+    gear_boundaries(data, mask), which saves hashing byte by byte; it gives the same boundaries as
+    long as `min_size` is at least GEAR_WINDOW, so no hash window reaches back past `start`.
+    """
+    limit = min(start + max_size, len(data))
+    if limit - start <= min_size:
+        return limit if limit == start + max_size else None
+
+    # The first candidate past the minimum size, if one was found up front
+    if boundaries is not None:
+        index = numpy.searchsorted(boundaries, start + min_size + 1)
+        if index < len(boundaries) and boundaries[index] <= limit:
+            return int(boundaries[index])
+        return limit if limit == start + max_size else None
+
+    # The hash only remembers its last GEAR_WINDOW bytes, so start it just before the minimum size
+    value = 0
+    position = start + min_size
+    for byte in data[max(start, position - GEAR_WINDOW):position]:
+        value = ((value << 1) + GEAR[byte]) & GEAR_MASK
+    for byte in data[position:limit]:
+        value = ((value << 1) + GEAR[byte]) & GEAR_MASK
+        position += 1
+        if not value & mask:
+            return position
+    return limit if limit == start + max_size else None
+
+# Function to cut a file into content-defined chunks
+def content_defined_chunks(file_path, average_size):
+    """Yields the chunks of a file, cut where the content says rather than at fixed offsets.
+
+    Chunks average about `average_size` bytes (between average_size / CDC_SIZE_RATIO and
+    average_size * CDC_SIZE_RATIO). When a new version of a file only changes some bytes, only
+    the chunks around the changes differ, so the rest can be reused from the old version.
+    With NumPy the boundaries of each block read are found at once (see gear_boundaries);
+    without it the file is hashed byte by byte, which is much slower.
+    """
+    min_size = max(1, average_size // CDC_SIZE_RATIO)
+    max_size = average_size * CDC_SIZE_RATIO
+    bits = max(1, (average_size - min_size).bit_length() - 1)
+    mask = ((1 << bits) - 1) << (64 - bits)
+
+    # A window reaching back past the start of a chunk would differ from the byte-by-byte hash, so
+    # very small chunks are always cut byte by byte
+    vectorized = numpy is not None and min_size >= GEAR_WINDOW
+
+    data = b''
+    boundaries = None
+    start = 0
+    at_end = False
+    with open(file_path, 'rb') as f:
+        while True:
+            end = find_chunk_boundary(data, start, min_size, max_size, mask, boundaries)
+            if end is None:
+                if at_end:
+                    if start < len(data):
+                        yield data[start:]
+                    return
+
+                # Keep the unfinished chunk and read more of the file after it
+                block = f.read(CDC_READ_SIZE)
+                at_end = not block
+                data = data[start:] + block
+                start = 0
+                if vectorized:
+                    boundaries = gear_boundaries(data, mask)
+                continue
+            yield data[start:end]
+            start = end
+
+# Function to hash a run of chunks of a file
+def hash_chunk_range(file_path, first_chunk, chunk_count, chunk_size, algorithm=DEFAULT_HASH_ALGORITHM):
+    """Returns the digests of `chunk_count` chunks starting at `first_chunk`, read through a file handle of its own."""
+    hash_function = get_hash_function(algorithm)
+    digests = []
+
+    # Read large blocks (a whole number of chunks) and hash each chunk as a slice of the block
+    block_size = max(chunk_size, FILE_HASH_BUFFER_SIZE // chunk_size * chunk_size)
+    buffer = bytearray(block_size)
+    view = memoryview(buffer)
+    remaining = chunk_count * chunk_size
+    with open(file_path, 'rb') as f:
+        f.seek(first_chunk * chunk_size)
+
+        # A buffered readinto only returns a partial block at the end of the file, so chunks stay aligned
+        while remaining > 0 and (count := f.readinto(view[:min(block_size, remaining)])):
+            for offset in range(0, count, chunk_size):
+                digests.append(hash_function(view[offset:min(offset + chunk_size, count)]).digest())
+            remaining -= count
+    return digests
+
+# Function to hash every chunk of a file, in parallel for large files
+def iter_chunk_digests(file_path, chunk_size, algorithm=DEFAULT_HASH_ALGORITHM, workers=None, processes=False):
+    """Yields the chunk digests of a file in runs (lists of digests), in file order, as they are hashed.
+
+    Large files are split into runs of about HASH_RANGE_SIZE bytes that `workers` threads hash
+    at once; hashlib releases the GIL while it hashes, so the threads use every core. With
+    `processes`, the runs are hashed in a process pool instead, for hash functions that hold the GIL.
+    """
+    file_size = os.path.getsize(file_path)
+    total_chunks = (file_size + chunk_size - 1) // chunk_size
+    workers = workers or DEFAULT_HASH_WORKERS
+    if workers == 1 or file_size < PARALLEL_HASH_MIN_SIZE:
+        yield hash_chunk_range(file_path, 0, total_chunks, chunk_size, algorithm)
+        return
+
+    range_chunks = max(1, HASH_RANGE_SIZE // chunk_size)
+    starts = range(0, total_chunks, range_chunks)
+    executor_type = ProcessPoolExecutor if processes else ThreadPoolExecutor
+    with executor_type(max_workers=workers) as executor:
+        yield from executor.map(hash_chunk_range, [file_path] * len(starts), starts,
+                                [range_chunks] * len(starts), [chunk_size] * len(starts), [algorithm] * len(starts))
+
+# Function to build the manifest of a file
+def build_manifest(file_path, chunk_size=None, algorithm=DEFAULT_HASH_ALGORITHM, workers=None, processes=False,
+                   progress=None, content_defined=False):
+    """Reads a file once and records its size, chunk size and per-chunk digests.
+
+    Large files are hashed by several workers (see iter_chunk_digests); the digests come out the
+    same either way. `progress`, if given, is called with (chunks hashed, total chunks) as runs finish.
+    With `content_defined`, the file is cut into content-defined chunks averaging `chunk_size` bytes.
+    """
+    file_size = os.path.getsize(file_path)
+    chunk_size = chunk_size or choose_chunk_size(file_size)
+    if content_defined:
+        return build_cdc_manifest(file_path, chunk_size, algorithm, progress)
+    total_chunks = (file_size + chunk_size - 1) // chunk_size
+    progress_log = ProgressLogger(f"Hashing {file_path}", total_chunks, every_chunks=None)  # Every few seconds
+    digests = []
+    for run in iter_chunk_digests(file_path, chunk_size, algorithm, workers, processes):
+        digests += run
+        progress_log.update(len(run), min(len(digests) * chunk_size, file_size) - progress_log.bytes)
+        if progress is not None:
+            progress(len(digests), total_chunks)
+
+    # The file must not have changed size while it was read
+    if len(digests) != total_chunks or os.path.getsize(file_path) != file_size:
+        raise ValueError(f"{file_path} changed while its manifest was being built")
+    progress_log.finish()
+
+    manifest = Manifest(file_size, chunk_size, digests, compute_root_hash(digests, algorithm), algorithm)
+    logging.info("Built manifest for %s: %s chunks, root hash %s", file_path, len(digests), manifest.root_hash)
+    return manifest
+
+# Function to build the manifest of a file cut into content-defined chunks
+def build_cdc_manifest(file_path, average_size, algorithm=DEFAULT_HASH_ALGORITHM, progress=None):
+    """Reads a file once, cutting it into content-defined chunks, and records their digests and offsets.
+
+    Chunk boundaries depend on what came before them, so the file is read by a single worker.
+    The chunk count isn't known up front; progress is reported against the expected count.
+    """
+    file_size = os.path.getsize(file_path)
+    hash_function = get_hash_function(algorithm)
+    if numpy is None and file_size > CDC_SLOW_WARNING_SIZE:
+        logging.warning("Cutting %s (%s bytes) into content-defined chunks without NumPy will be slow; "
+                        "install NumPy or use fixed-size chunks.", file_path, file_size)
+    expected_chunks = max(1, file_size // average_size)
+    progress_log = ProgressLogger(f"Chunking {file_path}", expected_chunks, every_chunks=None)  # Every few seconds
+    digests = []
+    offsets = [0]
+    for chunk in content_defined_chunks(file_path, average_size):
+        digests.append(hash_function(chunk).digest())
+        offsets.append(offsets[-1] + len(chunk))
+        progress_log.update(1, len(chunk))
+        if progress is not None:
+            progress(len(digests), max(expected_chunks, len(digests)))
+
+    # The file must not have changed size while it was read
+    if offsets[-1] != file_size or os.path.getsize(file_path) != file_size:
+        raise ValueError(f"{file_path} changed while its manifest was being built")
+    progress_log.total_chunks = len(digests)  # Now that the actual count is known
+    progress_log.finish()
+
+    manifest = Manifest(file_size, average_size, digests, compute_root_hash(digests, algorithm), algorithm, offsets)
+    logging.info("Built content-defined manifest for %s: %s chunks, root hash %s", file_path, len(digests),
+                 manifest.root_hash)
+    return manifest
+
+# Function to compare two versions of a file
+def diff_manifests(old_manifest, new_manifest):
+    """Returns {new chunk index: old chunk index} for every chunk of the new version that the old one has.
+
+    Chunks are matched by digest, so both manifests need the same hash algorithm (and, to find
+    much in common, the same kind of chunking).
+    """
+    if old_manifest.algorithm != new_manifest.algorithm:
+        return {}
+    old_chunks = {}
+    for chunk_index, digest in enumerate(old_manifest.digests):
+        old_chunks.setdefault(digest, chunk_index)
+    return {chunk_index: old_chunks[digest] for chunk_index, digest in enumerate(new_manifest.digests)
+            if digest in old_chunks}
+
+# Function to write a manifest to a compact binary file
+def save_manifest(manifest, manifest_path):
+    """Saves a manifest to disk."""
+    digest_size = get_hash_function(manifest.algorithm)().digest_size
+
+    # Write to a temporary file first so a crash never leaves a half-written manifest behind
+    # (named after the process and thread, so concurrent writers never share one)
+    temp_path = f"{manifest_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(temp_path, 'wb') as f:
+        version = MANIFEST_VERSION if manifest.chunk_offsets is None else CDC_MANIFEST_VERSION
+        f.write(MANIFEST_HEADER.pack(MANIFEST_MAGIC, version, manifest.file_size, manifest.chunk_size,
+                                     len(manifest.digests), HASH_IDS[manifest.algorithm], digest_size))
+        f.write(bytes.fromhex(manifest.root_hash))
+        f.write(b''.join(manifest.digests))
+        if manifest.chunk_offsets is not None:
+            offsets = manifest.chunk_offsets
+            f.write(struct.pack(f'!{len(manifest.digests)}I', *(offsets[i + 1] - offsets[i]
+                                                                 for i in range(len(manifest.digests)))))
+    os.replace(temp_path, manifest_path)
+
+# Function to read a manifest written by save_manifest
+def load_manifest(manifest_path):
+    """Loads a manifest from disk."""
+    with open(manifest_path, 'rb') as f:
+        data = f.read()
+
+    magic, version, file_size, chunk_size, chunk_count, hash_id, digest_size = MANIFEST_HEADER.unpack_from(data)
+    if magic != MANIFEST_MAGIC or version not in (MANIFEST_VERSION, CDC_MANIFEST_VERSION):
+        raise ValueError(f"{manifest_path} is not a supported manifest file")
+    if hash_id not in HASH_NAMES or HASH_NAMES[hash_id] not in HASH_ALGORITHMS:
+        raise ValueError(f"{manifest_path} uses an unavailable hash algorithm (id {hash_id})")
+    algorithm = HASH_NAMES[hash_id]
+
+    # Split the rest of the file into the root hash and the chunk digests
+    offset = MANIFEST_HEADER.size
+    root_hash = data[offset:offset + digest_size].hex()
+    offset += digest_size
+    digests = [data[i:i + digest_size] for i in range(offset, offset + chunk_count * digest_size, digest_size)]
+    offset += chunk_count * digest_size
+
+    # Content-defined chunks list their lengths, which must add up to the file size
+    chunk_offsets = None
+    if version == CDC_MANIFEST_VERSION and len(data) == offset + 4 * chunk_count:
+        chunk_offsets = [0]
+        for length in struct.unpack_from(f'!{chunk_count}I', data, offset):
+            chunk_offsets.append(chunk_offsets[-1] + length)
+        offset += 4 * chunk_count
+        if chunk_offsets[-1] != file_size:
+            raise ValueError(f"Manifest {manifest_path} is corrupt")
+
+    if len(data) != offset or compute_root_hash(digests, algorithm) != root_hash:
+        raise ValueError(f"Manifest {manifest_path} is corrupt")
+
+    return Manifest(file_size, chunk_size, digests, root_hash, algorithm, chunk_offsets)
+
+# Function to load a file's manifest, building and saving it first if needed
+def load_or_build_manifest(file_path, chunk_size=None, manifest_path=None, algorithm=DEFAULT_HASH_ALGORITHM,
+                           workers=None, processes=False, progress=None, content_defined=False, index=None):
+    """Returns the manifest for a file, reusing the saved one when it still matches the file.
+
+    With a SeedIndex (see seed_index.py), the manifest is looked up in and saved to the index
+    instead of a .manifest file next to the file.
+    """
+    manifest_path = manifest_path or file_path + '.manifest'
+    chunk_size = chunk_size or choose_chunk_size(os.path.getsize(file_path))
+
+    if index is not None:
+        manifest = index.lookup(file_path, chunk_size, algorithm, content_defined)
+        if manifest is not None:
+            logging.info("Loaded manifest of %s from the seed index", file_path)
+            return manifest
+        stat = os.stat(file_path)
+        manifest = build_manifest(file_path, chunk_size, algorithm, workers, processes, progress, content_defined)
+        index.record(file_path, manifest, stat)
+        return manifest
+
+    # Reuse the saved manifest if it was built for this chunking and algorithm and the file hasn't changed since
+    try:
+        manifest = load_manifest(manifest_path)
+        if (manifest.chunk_size == chunk_size and manifest.algorithm == algorithm
+                and (manifest.chunk_offsets is not None) == content_defined
+                and manifest.file_size == os.path.getsize(file_path)
+                and os.path.getmtime(manifest_path) >= os.path.getmtime(file_path)):
+            logging.info("Loaded manifest %s", manifest_path)
+            return manifest
+        logging.info("Manifest %s is out of date; rebuilding.", manifest_path)
+    except FileNotFoundError:
+        pass
+    except (ValueError, struct.error) as e:
+        logging.warning("Ignoring unreadable manifest %s: %s", manifest_path, e)
+
+    manifest = build_manifest(file_path, chunk_size, algorithm, workers, processes, progress, content_defined)
+    save_manifest(manifest, manifest_path)
+    return manifest
+
 # Function to split a file into chunks
-def chunk_file(file_path, chunk_size=512):
-    """Splits a file into smaller chunks."""
+def chunk_file(file_path, chunk_size=None):
+    """Splits a file into smaller chunks (sized for the file unless a chunk size is given)."""
+    chunk_size = chunk_size or choose_chunk_size(os.path.getsize(file_path))
+
     # Initialize a list to store the file chunks
     chunks = []
     
@@ -41,10 +497,10 @@ def chunk_file(file_path, chunk_size=512):
         # Initialize chunk index for logging purposes
         chunk_index = 0
         
-        # Read the file in chunks of the specified size (default 512 bytes)
+        # Read the file in chunks of the specified size
         while chunk := f.read(chunk_size):
-            # Log the size and index of each chunk being read
-            logging.info(f"Chunking: Read chunk {chunk_index} of size {len(chunk)} bytes.")
+            # Log the size and index of each chunk being read (only shown at DEBUG level)
+            logging.debug("Chunking: Read chunk %s of size %s bytes.", chunk_index, len(chunk))
             
             # Append the chunk to the list of chunks
             chunks.append(chunk)
@@ -53,7 +509,7 @@ def chunk_file(file_path, chunk_size=512):
             chunk_index += 1
     
     # Log the total number of chunks created
-    logging.info(f"Total chunks created: {chunk_index}")
+    logging.info("Total chunks created: %s", chunk_index)
     
     # Return the list of file chunks
     return chunks
@@ -65,11 +521,11 @@ def rebuild_file(chunks, output_file):
     with open(output_file, 'wb') as f:
         # Loop through each chunk and write it to the output file
         for i, chunk in enumerate(chunks):
-            # Log the size and index of each chunk being written
-            logging.info(f"Rebuilding: Writing chunk {i} of size {len(chunk)} bytes.")
+            # Log the size and index of each chunk being written (only shown at DEBUG level)
+            logging.debug("Rebuilding: Writing chunk %s of size %s bytes.", i, len(chunk))
             
             # Write the chunk to the file
             f.write(chunk)
     
     # Log a message when the file reconstruction is complete
-    logging.info(f"File reconstruction complete: {output_file}")
\ No newline at end of file
+    logging.info("File reconstruction complete: %s", output_file)
\ No newline at end of file
@@ -1,77 +1,319 @@
 import tkinter as tk
-from tkinter import messagebox, scrolledtext
+from tkinter import scrolledtext, ttk
 import sys
+import time
+import queue
 import logging
-from main_node1 import main
+import threading
+from collections import deque, Counter
+from main_node1 import NODE_CONFIG
+from node import Node
+from downloader import DownloadControl
+from log_utils import add_log_handler, remove_log_handler
 
-# Redirect logging to the Text widget
+# Milliseconds between flushes of queued log lines into the text box
+LOG_FLUSH_INTERVAL = 100
+
+# Milliseconds between polls of the progress queue (and refreshes of the peer table)
+PROGRESS_POLL_INTERVAL = 100
+
+# Most progress events handled in one poll, so a fast download can't starve the Tk event loop
+MAX_EVENTS_PER_POLL = 5000
+
+# Cells in a download's chunk map (each cell covers a run of chunks on large files)
+CHUNK_MAP_CELLS = 100
+CHUNK_MAP_WIDTH = 560
+CHUNK_MAP_HEIGHT = 14
+
+# Chunk map colours: nothing yet, some of the cell's chunks, all of them
+MISSING_COLOUR = '#d9d9d9'
+PARTIAL_COLOUR = '#9fd89f'
+DONE_COLOUR = '#2e8b57'
+
+# Redirect print statements to the log view.
+# Prints may come from the worker thread, so lines are queued for the TextHandler
+# instead of touching the widget here.
 class RedirectText:
-    def __init__(self, text_widget):
-        self.text_widget = text_widget
+    def __init__(self, handler):
+        self.handler = handler
+        self.partial = ''
 
     def write(self, string):
-        self.text_widget.insert(tk.END, string)
-        self.text_widget.see(tk.END)
+        lines = (self.partial + string).split('\n')
+        self.partial = lines.pop()
+        self.handler.lines.extend(lines)
 
     def flush(self):
         pass
 
+# Logging handler that shows records in the Text widget.
+# Records are only queued in emit() (which may run on any thread); show_lines() runs on the
+# Tk thread every LOG_FLUSH_INTERVAL ms and inserts everything queued in a single call,
+# so a burst of log lines costs one widget update instead of one per line.
 class TextHandler(logging.Handler):
     def __init__(self, text_widget):
         super().__init__()
         self.text_widget = text_widget
+        self.lines = deque()
 
     def emit(self, record):
-        msg = self.format(record)
-        self.text_widget.insert(tk.END, msg + '\n')
-        self.text_widget.see(tk.END)
+        self.lines.append(self.format(record))
+
+    def show_lines(self):
+        if self.lines:
+            lines = []
+            while self.lines:
+                lines.append(self.lines.popleft())
+            self.text_widget.insert(tk.END, '\n'.join(lines) + '\n')
+            self.text_widget.see(tk.END)
+        self.text_widget.after(LOG_FLUSH_INTERVAL, self.show_lines)
+
+# Widgets and counters for one file being downloaded: a progress bar, a chunk map
+# (one cell per run of chunks, coloured by how many of them have arrived) and a status line
+class DownloadView:
+    def __init__(self, parent, output, total_chunks, have):
+        self.total_chunks = max(total_chunks, 1)
+        self.done = len(have)
+        self.bytes = 0
+        self.start_time = time.monotonic()
+        self.cells = min(CHUNK_MAP_CELLS, self.total_chunks)
+        self.cell_done = [0] * self.cells
+        self.dirty = set(range(self.cells))
+        for chunk_index in have:
+            self.cell_done[self.cell(chunk_index)] += 1
+
+        self.frame = tk.Frame(parent)
+        self.frame.pack(fill=tk.X, padx=10, pady=2)
+        self.status = tk.Label(self.frame, anchor=tk.W)
+        self.status.pack(fill=tk.X)
+        self.bar = ttk.Progressbar(self.frame, maximum=self.total_chunks, value=self.done)
+        self.bar.pack(fill=tk.X)
+        self.canvas = tk.Canvas(self.frame, width=CHUNK_MAP_WIDTH, height=CHUNK_MAP_HEIGHT, highlightthickness=0)
+        self.canvas.pack(fill=tk.X, pady=2)
+        cell_width = CHUNK_MAP_WIDTH / self.cells
+        self.rectangles = [self.canvas.create_rectangle(i * cell_width, 0, (i + 1) * cell_width, CHUNK_MAP_HEIGHT,
+                                                        width=0, fill=MISSING_COLOUR)
+                           for i in range(self.cells)]
+        self.output = output
+        self.result = None
+
+    # Function to return the chunk map cell that holds a chunk
+    def cell(self, chunk_index):
+        return chunk_index * self.cells // self.total_chunks
+
+    # Function to return the number of chunks in a chunk map cell
+    def cell_size(self, cell):
+        first_chunk = lambda cell: -(-cell * self.total_chunks // self.cells)  # Rounded up
+        return first_chunk(cell + 1) - first_chunk(cell)
+
+    # Function to count a downloaded chunk (the widgets are redrawn by refresh())
+    def add_chunk(self, chunk_index, byte_count):
+        self.done += 1
+        self.bytes += byte_count
+        cell = self.cell(chunk_index)
+        self.cell_done[cell] += 1
+        self.dirty.add(cell)
+
+    # Function to redraw what changed since the last refresh
+    def refresh(self):
+        for cell in self.dirty:
+            done = self.cell_done[cell]
+            colour = DONE_COLOUR if done >= self.cell_size(cell) else PARTIAL_COLOUR if done else MISSING_COLOUR
+            self.canvas.itemconfigure(self.rectangles[cell], fill=colour)
+        self.dirty.clear()
+        self.bar['value'] = self.done
+
+        elapsed = max(time.monotonic() - self.start_time, 1e-6)
+        state = {None: 'downloading', True: 'complete', False: 'incomplete'}[self.result]
+        if self.result is None and control is not None and control.paused:
+            state = 'paused'
+        self.status['text'] = (f"{self.output}: {self.done}/{self.total_chunks} chunks, "
+                               f"{self.bytes / elapsed / (1024 * 1024):.2f} MiB/s ({state})")
 
-# Function to start the process and display a message
+# The node being run, its download control, and the progress events its downloads report
+node = None
+control = None
+progress_events = queue.Queue()
+downloads = {}  # Maps output path -> DownloadView
+peer_chunks = Counter()  # Maps peer name -> chunks received from it
+
+# Function run on the worker thread: seed Node 1's files and run its downloads, reporting
+# progress through the queue (the Tk thread never waits on the network)
+def run_node(worker_node, worker_control):
+    try:
+        worker_node.seed_files()
+        results = worker_node.download_all(worker_control, progress_events.put)
+        progress_events.put({'type': 'finished', 'results': results})
+    except Exception as e:
+        logging.error("The node stopped: %s", e)
+        progress_events.put({'type': 'finished', 'results': {}, 'error': str(e)})
+    finally:
+        worker_node.stop()
+
+# Function to start the node's downloads in the background
 def start_process():
-    # Clear the text box before starting
+    global node, control
+    if node is not None:
+        return
+
+    # Clear the text box and the progress of any earlier run before starting
     output_text.delete(1.0, tk.END)
-    
+    for view in downloads.values():
+        view.frame.destroy()
+    downloads.clear()
+    peer_chunks.clear()
+    peer_table.delete(*peer_table.get_children())
+
     # Redirect print statements to the text box
-    sys.stdout = RedirectText(output_text)
-
-    # Set up logging to redirect to the text box
-    logger = logging.getLogger()
-    logger.setLevel(logging.INFO)
-    text_handler = TextHandler(output_text)
-    formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
-    text_handler.setFormatter(formatter)
-    logger.addHandler(text_handler)
-    
-    # Here you can integrate the functionality from your nodes or server
-    messagebox.showinfo("Process Started", "The nodes and server have been started.")
-    main()  # Call to main from main_node2
+    sys.stdout = RedirectText(text_handler)
+
+    # Set up logging to redirect to the text box (adding the handler again is a no-op)
+    text_handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
+    add_log_handler(text_handler)
+
+    node = Node(NODE_CONFIG)
+    control = DownloadControl()
+    threading.Thread(target=run_node, args=(node, control), daemon=True).start()
+    start_button['state'] = tk.DISABLED
+    pause_button['state'] = cancel_button['state'] = tk.NORMAL
+    pause_button['text'] = "Pause"
+    label['text'] = "Downloading..."
+
+# Function to pause or resume the running downloads
+def toggle_pause():
+    if control is None:
+        return
+    if control.paused:
+        control.resume()
+        pause_button['text'] = "Pause"
+        label['text'] = "Downloading..."
+    else:
+        control.pause()
+        pause_button['text'] = "Resume"
+        label['text'] = "Paused (chunks already requested still arrive)."
+
+# Function to cancel the running downloads (the partial files are kept, so a later run resumes them)
+def cancel_process():
+    if control is not None:
+        control.cancel()
+        cancel_button['state'] = pause_button['state'] = tk.DISABLED
+        label['text'] = "Cancelling..."
+
+# Function to apply one progress event to the widgets
+def handle_progress(event):
+    global node, control
+    kind = event['type']
+    if kind == 'start':
+        view = downloads.get(event['output'])
+        if view is not None:
+            view.frame.destroy()
+        downloads[event['output']] = DownloadView(downloads_frame, event['output'], event['total_chunks'], event['have'])
+    elif kind == 'chunk':
+        view = downloads.get(event['output'])
+        if view is not None:
+            view.add_chunk(event['chunk_index'], event['bytes'])
+        peer_chunks[event['peer']] += 1
+    elif kind == 'finished':
+        for output, complete in event['results'].items():
+            if output in downloads:
+                downloads[output].result = complete
+        cancelled = control is not None and control.cancelled
+        node = control = None
+        start_button['state'] = tk.NORMAL
+        pause_button['state'] = cancel_button['state'] = tk.DISABLED
+        if 'error' in event:
+            label['text'] = f"Stopped: {event['error']}"
+        elif cancelled:
+            label['text'] = "Cancelled. Press 'Start' to resume the downloads."
+        elif all(event['results'].values()):
+            label['text'] = "All downloads complete."
+        else:
+            label['text'] = "Some downloads are incomplete (see the log)."
+
+# Function to refresh the peer table from the node's peer scheduler and the chunk counts
+def refresh_peers():
+    health = node.scheduler.snapshot() if node is not None else {}
+    for name in sorted(set(health) | set(peer_chunks)):
+        peer = health.get(name, {})
+        if peer.get('banned_seconds'):
+            state = f"banned {peer['banned_seconds']:.0f}s"
+        elif peer.get('backoff_seconds'):
+            state = f"backing off {peer['backoff_seconds']:.1f}s"
+        else:
+            state = 'ok'
+        latency = f"{peer['latency'] * 1000:.0f} ms" if peer.get('latency') is not None else '-'
+        throughput = f"{peer['throughput'] / (1024 * 1024):.2f} MiB/s" if peer.get('throughput') else '-'
+        values = (peer_chunks[name], latency, throughput, peer.get('failures', 0), state)
+        if peer_table.exists(name):
+            peer_table.item(name, values=values)
+        else:
+            peer_table.insert('', tk.END, iid=name, text=name, values=values)
+
+# Function run on the Tk thread every PROGRESS_POLL_INTERVAL ms: drain the progress queue
+# (up to MAX_EVENTS_PER_POLL events) and redraw what changed
+def poll_progress():
+    for _ in range(MAX_EVENTS_PER_POLL):
+        try:
+            event = progress_events.get_nowait()
+        except queue.Empty:
+            break
+        handle_progress(event)
+    for view in downloads.values():
+        view.refresh()
+    if node is not None or peer_chunks:
+        refresh_peers()
+    root.after(PROGRESS_POLL_INTERVAL, poll_progress)
 
 # Function to quit the application
 def quit_application():
+    if control is not None:
+        control.cancel()
     sys.stdout = sys.__stdout__  # Restore original stdout
-    logging.getLogger().handlers.clear()  # Clear logging handlers
+    remove_log_handler(text_handler)  # Stop sending log records to the text box
     root.quit()
 
 # Create the main application window
 root = tk.Tk()
 root.title("Distributed System GUI")
-root.geometry("600x400")  # Set window size to be larger
-
-# Create a start button
-start_button = tk.Button(root, text="Start", command=start_process)
-start_button.pack(pady=20)  # Add some vertical padding
+root.geometry("800x700")  # Room for the progress bars and the peer table
 
-# Create a quit button
-quit_button = tk.Button(root, text="Quit", command=quit_application)
-quit_button.pack(pady=10)
+# Create the start, pause/resume, cancel and quit buttons
+buttons = tk.Frame(root)
+buttons.pack(pady=10)
+start_button = tk.Button(buttons, text="Start", command=start_process)
+start_button.pack(side=tk.LEFT, padx=5)
+pause_button = tk.Button(buttons, text="Pause", command=toggle_pause, state=tk.DISABLED)
+pause_button.pack(side=tk.LEFT, padx=5)
+cancel_button = tk.Button(buttons, text="Cancel", command=cancel_process, state=tk.DISABLED)
+cancel_button.pack(side=tk.LEFT, padx=5)
+quit_button = tk.Button(buttons, text="Quit", command=quit_application)
+quit_button.pack(side=tk.LEFT, padx=5)
 
 # Create a label to display text
 label = tk.Label(root, text="Press 'Start' to run the nodes and server.")
-label.pack(pady=10)
+label.pack(pady=5)
+
+# Frame holding a progress bar and chunk map per download
+downloads_frame = tk.Frame(root)
+downloads_frame.pack(fill=tk.X)
+
+# Create a table of the peers: chunks received, latency, throughput, failures and state
+peer_table = ttk.Treeview(root, columns=('chunks', 'latency', 'throughput', 'failures', 'state'), height=5)
+peer_table.heading('#0', text="Peer")
+for column, heading in (('chunks', "Chunks"), ('latency', "Latency"), ('throughput', "Throughput"),
+                        ('failures', "Failures"), ('state', "State")):
+    peer_table.heading(column, text=heading)
+    peer_table.column(column, width=100, anchor=tk.E)
+peer_table.pack(fill=tk.X, padx=10, pady=5)
 
 # Create a larger scrolled text box to display output
 output_text = scrolledtext.ScrolledText(root, wrap=tk.WORD, width=70, height=15)
-output_text.pack(pady=10)
+output_text.pack(fill=tk.BOTH, expand=True, padx=10, pady=10)
+
+# Handler that shows log records in the text box, flushed periodically on the Tk thread
+text_handler = TextHandler(output_text)
+text_handler.show_lines()
+poll_progress()
 
 # Run the application
-root.mainloop()
\ No newline at end of file
+root.mainloop()
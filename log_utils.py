@@ -0,0 +1,125 @@
+import time
+import queue
+import atexit
+import logging
+import threading
+from logging.handlers import QueueHandler, QueueListener
+
+# Format used for log lines written to the console
+LOG_FORMAT = '%(asctime)s - %(levelname)s - %(message)s'
+
+# Default interval between progress summaries, in chunks and in seconds
+PROGRESS_EVERY_CHUNKS = 1000
+PROGRESS_EVERY_SECONDS = 5
+
+# The listener that writes queued records to the real handlers (None until setup_logging runs)
+_listener = None
+_setup_lock = threading.Lock()
+
+
+# Queue handler that leaves message formatting to the listener thread.
+# The stock QueueHandler formats every record on the thread that logs it; here the record
+# is queued as-is, so the logging thread only pays for creating the record and the
+# `%` formatting happens off the critical path. Log arguments must not be changed after
+# the call (pass ints and strings rather than buffers that get reused).
+class DeferredQueueHandler(QueueHandler):
+    def prepare(self, record):
+        return record
+
+
+# Function to route all logging through a queue and a background listener thread.
+# Like logging.basicConfig, it does nothing if the root logger already has handlers,
+# so every module can call it at import time.
+def setup_logging(level=logging.INFO, handlers=None):
+    global _listener
+    root = logging.getLogger()
+    with _setup_lock:
+        if root.handlers:
+            return _listener
+
+        if handlers is None:
+            console = logging.StreamHandler()
+            console.setFormatter(logging.Formatter(LOG_FORMAT))
+            handlers = [console]
+
+        log_queue = queue.SimpleQueue()
+        root.addHandler(DeferredQueueHandler(log_queue))
+        root.setLevel(level)
+        _listener = QueueListener(log_queue, *handlers, respect_handler_level=True)
+        _listener.start()
+
+        # Flush whatever is still queued when the program exits
+        atexit.register(_listener.stop)
+        return _listener
+
+
+# Function to set logging up again in a child process forked from one that had already set it up.
+# The child inherits the queue handler but not the listener thread, so records it logs would
+# pile up in the queue without ever being written; it gets a queue and listener of its own
+# instead, writing to the same output handlers.
+def reset_logging_after_fork():
+    global _listener, _setup_lock
+    _setup_lock = threading.Lock()  # Another thread may have held it at the time of the fork
+    root = logging.getLogger()
+    handlers = None
+    if _listener is not None:
+        handlers = list(_listener.handlers)
+        atexit.unregister(_listener.stop)
+        _listener = None
+    for handler in [h for h in root.handlers if isinstance(h, DeferredQueueHandler)]:
+        root.removeHandler(handler)
+    return setup_logging(root.level, handlers)
+
+
+# Function to attach another output handler (such as a GUI log view) to the logging pipeline
+def add_log_handler(handler):
+    listener = setup_logging()
+    if handler in logging.getLogger().handlers or (listener is not None and handler in listener.handlers):
+        return
+    if listener is None:
+        # Logging was configured by someone else, so hang the handler off the root logger directly
+        logging.getLogger().addHandler(handler)
+    else:
+        listener.handlers = listener.handlers + (handler,)
+
+
+# Function to detach a handler added with add_log_handler
+def remove_log_handler(handler):
+    if _listener is not None and handler in _listener.handlers:
+        _listener.handlers = tuple(h for h in _listener.handlers if h is not handler)
+    else:
+        logging.getLogger().removeHandler(handler)
+
+
+# Progress reporter for long per-chunk loops.
+# Instead of a log line per chunk, update() logs one summary every `every_chunks` chunks
+# (None to go by time alone) or `every_seconds` seconds, whichever comes first, and finish() logs the totals, so
+# the logging cost stays fixed however many chunks there are.
+class ProgressLogger:
+    def __init__(self, label, total_chunks, every_chunks=PROGRESS_EVERY_CHUNKS, every_seconds=PROGRESS_EVERY_SECONDS):
+        self.label = label
+        self.total_chunks = total_chunks
+        self.every_chunks = every_chunks
+        self.every_seconds = every_seconds
+        self.chunks = 0
+        self.bytes = 0
+        self.start_time = self.last_time = time.monotonic()
+        self.last_chunks = 0
+
+    # Function to count finished chunks, logging a summary when one is due
+    def update(self, chunks=1, byte_count=0):
+        self.chunks += chunks
+        self.bytes += byte_count
+        now = time.monotonic()
+        chunks_due = self.every_chunks is not None and self.chunks - self.last_chunks >= self.every_chunks
+        if not chunks_due and now - self.last_time < self.every_seconds:
+            return
+        self.last_time, self.last_chunks = now, self.chunks
+        logging.info("%s: %d/%d chunks (%.1f MiB/s)", self.label, self.chunks, self.total_chunks,
+                     self.bytes / max(now - self.start_time, 1e-6) / (1024 * 1024))
+
+    # Function to log the final totals
+    def finish(self):
+        elapsed = time.monotonic() - self.start_time
+        logging.info("%s: %d/%d chunks, %d bytes in %.2fs", self.label, self.chunks, self.total_chunks,
+                     self.bytes, elapsed)
@@ -1,75 +1,27 @@
-import time
-import threading
-import logging
-from file_utils import chunk_file, rebuild_file, generate_checksum, verify_chunk
-from server import start_server
-from client import get_chunk_from_peer
-
-# Set up logging
-logging.basicConfig(level=logging.INFO)
-
-connected_nodes = []
-statistics = {
-    'uploaded_file_chunks': 0,
-    'downloaded_file_chunks': 0,
-    'downloaded_files': 0,
+from node import Node
+from metrics import METRICS_PORT
+
+# Node 3 starts with no chunks and downloads them all from Node 1 and Node 2 (Node 1 has every chunk,
+# so the download still completes once Node 2 has stopped)
+# (its local copy of file_to_share.txt is only read to build the manifest)
+NODE_CONFIG = {
+    'name': 'Node 3',
+    'port': 8002,
+    'metrics_port': METRICS_PORT + 2,
+    'seed_index': 'seed_index',  # Reuse manifests across restarts instead of hashing the file again
+    'download': [{
+        'source': 'file_to_share.txt',
+        'chunk_size': 64,
+        'output': 'reconstructed_file_node3.txt',
+        'peers': {'127.0.0.1:8000': [0, 1, 2, 3], '127.0.0.1:8001': [2, 3]},
+    }],
+    'keep_seeding': False,
 }
 
-# Function to request and download missing chunks from peers
-def request_missing_chunks(available_chunks, peer_chunk_map, total_chunks):
-    downloaded_chunks = [None] * total_chunks
-
-    for chunk_index in range(total_chunks):
-        if chunk_index not in available_chunks:
-            for peer, peer_chunks in peer_chunk_map.items():
-                if chunk_index in peer_chunks:
-                    peer_ip, peer_port = peer.split(":")
-                    chunk = get_chunk_from_peer(peer_ip, int(peer_port), chunk_index)
-                    if chunk:
-                        downloaded_chunks[chunk_index] = chunk
-                        logging.info(f"Downloaded chunk {chunk_index} from {peer}")
-                        statistics['downloaded_file_chunks'] += 1
-                        break
-                    else:
-                        logging.error(f"Failed to download chunk {chunk_index} from {peer}")
-        else:
-            downloaded_chunks[chunk_index] = available_chunks[chunk_index]
-            logging.info(f"Using local chunk {chunk_index}")
-
-    return downloaded_chunks
-
+# Function to download and reconstruct the file (without starting Node 3's server)
 def main():
-    # Node 3 only handles 4 chunks, so restrict the total number of chunks to 4
-    file_chunks = chunk_file('file_to_share.txt', 512)
-    file_chunks = file_chunks[:4]  # Node 3 will only handle up to 4 chunks
-    total_chunks = len(file_chunks)  # Ensure Node 3 only deals with 4 chunks
-    logging.info(f"Total chunks created: {total_chunks}")
-
-    # Node 3 starts with no chunks, so it will need to download all chunks
-    available_chunks = {}
-    logging.info(f"Node 3 has chunks: {list(available_chunks.keys())}")
-
-    # Node 3 requests chunks from Node 1 and Node 2
-    peer_chunk_map = {
-        '127.0.0.1:8000': [0, 1],  # Node 1 has chunks 0 and 1
-        '127.0.0.1:8001': [2, 3],  # Node 2 has chunks 2 and 3
-    }
-
-    # Request the missing chunks from peers
-    downloaded_chunks = request_missing_chunks(available_chunks, peer_chunk_map, total_chunks)
-
-    # If all chunks are successfully downloaded, reconstruct the file
-    if None not in downloaded_chunks:
-        logging.info(f"Node 3 is reconstructing the file with chunks: {list(range(len(downloaded_chunks)))}")
-        rebuild_file(downloaded_chunks, 'reconstructed_file_node3.txt')
-        logging.info("File successfully reconstructed by Node 3.")
-        statistics['downloaded_files'] += 1
-    else:
-        logging.error("Failed to download all chunks.")
+    return Node(NODE_CONFIG).run(serve=False)
 
+# Entry point for the Node 3 script: serve Node 3's chunks, then download the rest
 if __name__ == '__main__':
-    # Start the server for Node 3, which listens on port 8002
-    node_3_chunks = []
-    threading.Thread(target=start_server, args=(8002, node_3_chunks), daemon=True).start()
-    time.sleep(2)
-    main()
+    Node(NODE_CONFIG).run()
@@ -0,0 +1,303 @@
+import json
+import time
+import bisect
+import logging
+import threading
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from log_utils import setup_logging
+
+setup_logging()
+
+# Default port for the metrics HTTP endpoint
+METRICS_PORT = 9100
+
+# Upper bounds (in seconds) of the latency histogram buckets
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# Seconds of history used to work out per-second rates of rate-tracked counters
+RATE_WINDOW = 10
+
+
+# Function to turn keyword labels into the hashable key a metric stores its values under
+def _label_key(labels):
+    return tuple(sorted((name, str(value)) for name, value in labels.items()))
+
+
+# Function to render a label key in Prometheus syntax, e.g. {peer="127.0.0.1:8001",result="success"}
+def _format_labels(key, extra=()):
+    pairs = list(key) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+
+# Base class for every metric: a name, a help text and one value per label set
+class Metric:
+    kind = 'untyped'
+
+    def __init__(self, name, help_text):
+        self.name = name
+        self.help_text = help_text
+        self._values = {}
+        self._lock = threading.Lock()
+
+    # Function to return a copy of every (label key, value) pair
+    def items(self):
+        with self._lock:
+            return list(self._values.items())
+
+    # Function to return the value for one label set as plain data
+    def value(self, **labels):
+        with self._lock:
+            return self._export(self._values.get(_label_key(labels)))
+
+    def _export(self, value):
+        return value if value is not None else 0
+
+    # Function to return every label set's value as plain data (for snapshots)
+    def snapshot(self):
+        return [{'labels': dict(key), 'value': self._export(value)} for key, value in self.items()]
+
+    # Function to render the metric in the Prometheus text format
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.kind}"]
+        for key, value in sorted(self.items()):
+            lines.append(f"{self.name}{_format_labels(key)} {value}")
+        return lines
+
+
+# Monotonically increasing count (requests, bytes, failures).
+# With `track_rate`, the last RATE_WINDOW seconds are also kept in one-second buckets
+# so rate() can report a current per-second figure such as throughput.
+class Counter(Metric):
+    kind = 'counter'
+
+    def __init__(self, name, help_text, track_rate=False):
+        super().__init__(name, help_text)
+        self.track_rate = track_rate
+        self._recent = {}  # Maps label key -> deque of [second, amount]
+
+    # Function to add to the count
+    def inc(self, amount=1, **labels):
+        key = _label_key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+            if self.track_rate:
+                second = int(time.monotonic())
+                recent = self._recent.setdefault(key, deque())
+                if recent and recent[-1][0] == second:
+                    recent[-1][1] += amount
+                else:
+                    recent.append([second, amount])
+                while recent[0][0] <= second - RATE_WINDOW:
+                    recent.popleft()
+
+    # Function to return the average increase per second over the last RATE_WINDOW seconds
+    def rate(self, **labels):
+        cutoff = int(time.monotonic()) - RATE_WINDOW
+        with self._lock:
+            recent = self._recent.get(_label_key(labels), ())
+            return sum(amount for second, amount in recent if second > cutoff) / RATE_WINDOW
+
+    def snapshot(self):
+        values = super().snapshot()
+        if self.track_rate:
+            for entry in values:
+                entry['rate'] = self.rate(**entry['labels'])
+        return values
+
+    def render(self):
+        lines = super().render()
+        if self.track_rate:
+            rate_name = self.name[:-len('_total')] if self.name.endswith('_total') else self.name
+            rate_name += '_per_second'
+            lines += [f"# HELP {rate_name} {self.help_text} (per second, last {RATE_WINDOW}s)",
+                      f"# TYPE {rate_name} gauge"]
+            for key, _ in sorted(self.items()):
+                lines.append(f"{rate_name}{_format_labels(key)} {self.rate(**dict(key))}")
+        return lines
+
+
+# Value that goes up and down (requests in flight, open sessions)
+class Gauge(Metric):
+    kind = 'gauge'
+
+    # Function to set the value
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[_label_key(labels)] = value
+
+    # Function to add to the value (use a negative amount to subtract)
+    def inc(self, amount=1, **labels):
+        key = _label_key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    # Function to subtract from the value
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+
+# Distribution of observed values (such as request latencies) in cumulative buckets
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help_text, buckets=LATENCY_BUCKETS):
+        super().__init__(name, help_text)
+        self.buckets = tuple(sorted(buckets))
+
+    # Function to record one observation
+    def observe(self, value, **labels):
+        key = _label_key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                # Per-bucket counts (plus one for values above the last bound), sum of values, count
+                state = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            state[0][bisect.bisect_left(self.buckets, value)] += 1
+            state[1] += value
+            state[2] += 1
+
+    def items(self):
+        with self._lock:
+            return [(key, [list(counts), total, count]) for key, (counts, total, count) in self._values.items()]
+
+    def _export(self, state):
+        if state is None:
+            return {'buckets': {}, 'sum': 0.0, 'count': 0}
+        counts, total, count = state
+        cumulative, buckets = 0, {}
+        for bound, bucket_count in zip(self.buckets, counts):
+            cumulative += bucket_count
+            buckets[str(bound)] = cumulative
+        buckets['+Inf'] = count
+        return {'buckets': buckets, 'sum': total, 'count': count}
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        for key, state in sorted(self.items()):
+            exported = self._export(state)
+            for bound, cumulative in exported['buckets'].items():
+                lines.append(f"{self.name}_bucket{_format_labels(key, [('le', bound)])} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(key)} {exported['sum']}")
+            lines.append(f"{self.name}_count{_format_labels(key)} {exported['count']}")
+        return lines
+
+
+# Thread-safe collection of named metrics.
+# Metrics are created once (usually at import time) and then updated from any thread;
+# snapshot() returns plain data for programs and render_prometheus() the text format
+# served by the metrics HTTP endpoint.
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics = {}
+        self.start_time = time.monotonic()
+        self._lock = threading.Lock()
+
+    # Function to return the metric with this name, creating it on first use
+    def _get_or_create(self, metric_class, name, help_text, **options):
+        with self._lock:
+            metric = self.metrics.get(name)
+            if metric is None:
+                metric = self.metrics[name] = metric_class(name, help_text, **options)
+            elif not isinstance(metric, metric_class):
+                raise ValueError(f"Metric {name} is already registered as a {metric.kind}")
+            return metric
+
+    # Function to get (or create) a counter
+    def counter(self, name, help_text, track_rate=False):
+        return self._get_or_create(Counter, name, help_text, track_rate=track_rate)
+
+    # Function to get (or create) a gauge
+    def gauge(self, name, help_text):
+        return self._get_or_create(Gauge, name, help_text)
+
+    # Function to get (or create) a histogram
+    def histogram(self, name, help_text, buckets=LATENCY_BUCKETS):
+        return self._get_or_create(Histogram, name, help_text, buckets=buckets)
+
+    # Function to return every metric's current values as plain (JSON-friendly) data
+    def snapshot(self):
+        with self._lock:
+            metrics = list(self.metrics.values())
+        return {
+            'uptime_seconds': time.monotonic() - self.start_time,
+            'metrics': {metric.name: {'type': metric.kind, 'values': metric.snapshot()} for metric in metrics},
+        }
+
+    # Function to render every metric in the Prometheus text exposition format
+    def render_prometheus(self):
+        with self._lock:
+            metrics = sorted(self.metrics.values(), key=lambda metric: metric.name)
+        lines = []
+        for metric in metrics:
+            lines += metric.render()
+        return '\n'.join(lines) + '\n'
+
+
+# Registry shared by the server, the client and the downloader
+metrics = MetricsRegistry()
+
+# Traffic
+bytes_sent = metrics.counter('p2p_bytes_sent_total', 'Payload bytes sent to peers', track_rate=True)
+bytes_received = metrics.counter('p2p_bytes_received_total', 'Payload bytes received from peers', track_rate=True)
+chunks_served = metrics.counter('p2p_chunks_served_total', 'Chunks uploaded to peers')
+chunks_downloaded = metrics.counter('p2p_chunks_downloaded_total', 'Verified chunks downloaded from peers')
+files_downloaded = metrics.counter('p2p_files_downloaded_total', 'Files downloaded and reconstructed')
+
+# Server side
+server_requests = metrics.counter('p2p_server_requests_total', 'Requests handled by the server, by opcode')
+server_request_seconds = metrics.histogram('p2p_server_request_seconds', 'Time to answer a request, by opcode')
+server_sessions = metrics.gauge('p2p_server_sessions', 'Open client sessions')
+cache_hits = metrics.counter('p2p_cache_hits_total', 'Chunk reads answered from the server chunk cache')
+cache_misses = metrics.counter('p2p_cache_misses_total', 'Chunk reads the server chunk cache had to load')
+cache_evictions = metrics.counter('p2p_cache_evictions_total', 'Chunks evicted from the server chunk cache')
+cache_bytes = metrics.gauge('p2p_cache_bytes', 'Bytes of chunk data held in the server chunk cache')
+chunks_compressed = metrics.counter('p2p_chunks_compressed_total', 'Chunks sent compressed, by algorithm')
+compression_saved_bytes = metrics.counter('p2p_compression_saved_bytes_total', 'Bytes saved by sending chunks compressed')
+upload_wait_seconds = metrics.counter('p2p_upload_wait_seconds_total', 'Seconds chunk uploads were held back by the upload limits')
+uploads_choked = metrics.counter('p2p_uploads_choked_total', 'Chunk requests answered CHOKED for lack of an upload slot')
+
+# Client side
+client_request_seconds = metrics.histogram('p2p_client_request_seconds', 'Time from sending a request to its response, by peer')
+client_requests_in_flight = metrics.gauge('p2p_client_requests_in_flight', 'Requests waiting for a response, by peer')
+peer_requests = metrics.counter('p2p_peer_requests_total',
+                                'Chunk requests by peer and result (success, timeout, checksum_failure, rejected, choked, error)')
+peer_bans = metrics.counter('p2p_peer_bans_total', 'Peers banned for sending corrupt chunks, by peer')
+
+
+# Request handler for the metrics endpoint: /metrics (Prometheus text) and /metrics.json (snapshot)
+class MetricsHandler(BaseHTTPRequestHandler):
+    registry = metrics
+
+    def do_GET(self):
+        if self.path == '/metrics':
+            body = self.registry.render_prometheus().encode()
+            content_type = 'text/plain; version=0.0.4; charset=utf-8'
+        elif self.path == '/metrics.json':
+            body = json.dumps(self.registry.snapshot()).encode()
+            content_type = 'application/json'
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    # Scrapes are frequent, so keep them out of the log
+    def log_message(self, format, *args):
+        logging.debug("Metrics request from %s: " + format, self.address_string(), *args)
+
+
+# Function to serve the metrics over HTTP on a background thread; returns the HTTP server
+def start_metrics_server(port=METRICS_PORT, host='127.0.0.1', registry=None):
+    handler = type('BoundMetricsHandler', (MetricsHandler,), {'registry': registry or metrics})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    logging.info("Metrics available at http://%s:%s/metrics", host, port)
+    return server
@@ -0,0 +1,347 @@
+import os
+import json
+import time
+import asyncio
+import logging
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from chunk_store import ContentStore
+from client import ConnectionPool, MAX_OUTSTANDING_REQUESTS, REQUEST_TIMEOUT
+from downloader import download_to_file, sync_to_file, DEFAULT_WINDOW, DEFAULT_PREFETCH
+from download_stream import DownloadStream
+from file_utils import load_manifest, load_or_build_manifest, DEFAULT_HASH_ALGORITHM
+from server import start_server
+from async_server import AsyncChunkServer, MAX_SESSIONS
+from tracker import TrackerClient
+from erasure import download_erasure_coded, load_layout
+from peer_scheduler import PeerScheduler
+from chunk_cache import ChunkCache
+from upload_limiter import UploadLimiter
+from seed_index import SeedIndex
+from log_utils import setup_logging
+from metrics import start_metrics_server, chunks_served, chunks_downloaded, files_downloaded
+
+# Set up logging to display info and error messages
+setup_logging()
+
+# Seconds to wait for a node's server to start accepting connections
+STARTUP_TIMEOUT = 10
+
+# Settings of a node and their defaults (a config only needs the ones it changes)
+DEFAULT_NODE_CONFIG = {
+    'name': None,  # Name used in log messages (defaults to "node:<port>")
+    'port': 8000,  # Port the chunk server listens on
+    'server': 'threaded',  # 'threaded' or 'async'
+    'metrics_port': None,  # Port for the metrics endpoint (None for no endpoint)
+    'tracker': None,  # "ip:port" of a tracker to announce to and find peers through
+    'blob_dir': None,  # Directory for chunks stored on their own
+    'window': DEFAULT_WINDOW,  # Requests in flight per peer
+    'max_outstanding': MAX_OUTSTANDING_REQUESTS,  # Requests in flight per connection
+    'request_timeout': REQUEST_TIMEOUT,  # Seconds before a chunk request is given up on
+    'max_sessions': MAX_SESSIONS,  # Client sessions the async server accepts at once
+    'cache_bytes': 0,  # Memory budget of the server's chunk cache (0 to serve straight from the store)
+    'read_ahead': 0,  # Chunks the cache loads ahead of each chunk read
+    'upload_rate': None,  # Bytes per second uploaded to all peers together (None for no limit)
+    'peer_upload_rate': None,  # Bytes per second uploaded to any one peer (None for no limit)
+    'upload_slots': None,  # Peers uploaded to at once, favouring those that upload to us (None for every peer)
+    'upload_peer_key': 'host',  # How upload limits tell peers apart: "host", or "address" (host and port) for nodes sharing a host
+    'compression': [],  # Compression algorithms asked of peers, best first (e.g. ["zstd", "zlib"]; empty for none)
+    'max_downloads': 1,  # Files downloaded at the same time
+    'hash_workers': None,  # Workers hashing a large seed file (None for one per CPU core)
+    'hash_processes': False,  # Hash in worker processes instead of threads (for hashes that hold the GIL)
+    'seed_index': None,  # Directory of the persisted seed index (None for a .manifest next to each file)
+    'lazy_seed': False,  # Start serving before every seed file is hashed (each is served once it is ready)
+    'seed': [],  # Files to serve: {"path", "chunk_size", "algorithm", "chunks", "content_defined"}
+                 # (content-defined chunking of large files needs NumPy to be fast, see requirements-optional.txt)
+    'download': [],  # Files to fetch: {"output", "manifest" or "source", "chunk_size", "algorithm", "content_defined",
+                     #                  "peers", "erasure" (layout file of an erasure-coded file, see erasure.py),
+                     #                  "previous" (older local version to sync from, see sync_to_file)}
+    'keep_seeding': True,  # Keep serving after the downloads finish (until interrupted)
+}
+
+
+# Function to fill in the defaults of a node config, rejecting settings we don't know
+def node_config(config):
+    unknown = set(config) - set(DEFAULT_NODE_CONFIG)
+    if unknown:
+        raise ValueError(f"Unknown node settings: {', '.join(sorted(unknown))}")
+    if config.get('server', 'threaded') not in ('threaded', 'async'):
+        raise ValueError(f"Unknown server kind {config['server']!r}")
+    return {**DEFAULT_NODE_CONFIG, **config}
+
+
+# Function to read a JSON config file holding one node, or several under "nodes"
+def load_node_configs(config_path):
+    with open(config_path) as f:
+        config = json.load(f)
+    configs = config['nodes'] if 'nodes' in config else [config]
+    return [node_config(node) for node in configs]
+
+
+# One peer of the network: a chunk server and a downloader sharing one ContentStore.
+# Seeded files are read once (to build their manifests) and then served from memory maps;
+# downloaded chunks are served to other peers as soon as they are written, and chunks the
+# store already holds are never downloaded again. Every node has its own store, connection
+# pool, peer scheduler and server, so one process can run many of them (the metrics registry, and with it
+# statistics(), is shared by every node in the process).
+class Node:
+    def __init__(self, config):
+        self.config = node_config(config)
+        self.name = self.config['name'] or f"node:{self.config['port']}"
+        self.port = self.config['port']
+        self.store = ContentStore(self.config['blob_dir'])
+        self.pool = ConnectionPool(self.config['max_outstanding'], self.config['request_timeout'],
+                                   self.config['compression'], self.port)
+        self.scheduler = PeerScheduler()  # Peer health, shared by the node's downloads
+        self.tracker = None
+        if self.config['tracker']:
+            self.tracker = TrackerClient(self.config['tracker'], self.port, self.pool)
+        self.seeded = {}  # Maps seeded file path -> file id
+        self.seeding = {}  # Maps seed file path -> Future of its file id, while it is being added
+        self.seed_index = SeedIndex(self.config['seed_index']) if self.config['seed_index'] else None
+        self._ingester = ThreadPoolExecutor(max_workers=1)  # Adds seed files one at a time, in order
+        self._seed_lock = threading.Lock()
+        self._serving = False  # Set once the server is up, so files added later are announced straight away
+        self.cache = None
+        if self.config['cache_bytes']:
+            self.cache = ChunkCache(self.config['cache_bytes'], self.config['read_ahead'])
+        # Upload limits, shared by every client session (they can be changed while the node runs)
+        self.limiter = UploadLimiter(self.config['upload_rate'], self.config['peer_upload_rate'],
+                                     self.config['upload_slots'], peer_key=self.config['upload_peer_key'])
+        self.server = None  # The AsyncChunkServer, when running the async server
+        self.metrics_server = None
+
+    # Function to add every configured seed file to the store (each file is read once, and not at
+    # all if the seed index already has its manifest). Files are added on a background thread;
+    # with wait=False this returns straight away and each file is served once it is ready.
+    def seed_files(self, wait=True):
+        for entry in self.config['seed']:
+            if entry['path'] not in self.seeded and entry['path'] not in self.seeding:
+                self.seeding[entry['path']] = self._ingester.submit(self._seed_file, entry)
+        if wait:
+            for future in list(self.seeding.values()):
+                future.result()
+
+    # Function to add one seed file to the store; returns its file id
+    def _seed_file(self, entry):
+        try:
+            file_id = self.store.add_file(entry['path'], entry.get('chunk_size'),
+                                          entry.get('algorithm', DEFAULT_HASH_ALGORITHM),
+                                          chunk_indices=entry.get('chunks'), workers=self.config['hash_workers'],
+                                          processes=self.config['hash_processes'],
+                                          content_defined=entry.get('content_defined', False), index=self.seed_index)
+        except Exception as e:
+            logging.error("%s could not seed %s: %s", self.name, entry['path'], e)
+            raise
+        with self._seed_lock:
+            self.seeded[entry['path']] = file_id
+            announce = self._serving
+        if announce:
+            self._announce(file_id)
+        return file_id
+
+    # Function to announce a seeded file to the tracker, if the node has one
+    def _announce(self, file_id):
+        if self.tracker is None:
+            return
+        try:
+            self.tracker.announce(file_id, self.store.get_file(file_id).bitfield())
+        except Exception as e:
+            logging.error("%s failed to announce %s to the tracker: %s", self.name, file_id, e)
+
+    # Function to seed the files, start the server (returning once it accepts connections),
+    # serve the metrics and announce the seeded files to the tracker.
+    # With lazy_seed, files that still need hashing are added while the server runs.
+    def start(self):
+        self.seed_files(wait=not self.config['lazy_seed'])
+
+        ready = threading.Event()
+        if self.config['server'] == 'async':
+            self.server = AsyncChunkServer(self.store, self.config['max_sessions'], cache=self.cache,
+                                           limiter=self.limiter)
+            target = lambda: asyncio.run(self.server.serve(self.port, ready=ready))
+        else:
+            target = lambda: start_server(self.port, self.store, ready=ready, cache=self.cache, limiter=self.limiter)
+        server_thread = threading.Thread(target=target, daemon=True)
+        server_thread.start()
+
+        # The server thread ends straight away if it can't listen (e.g. the port is taken)
+        deadline = time.monotonic() + STARTUP_TIMEOUT
+        while not ready.wait(0.05):
+            if not server_thread.is_alive() or time.monotonic() > deadline:
+                raise RuntimeError(f"{self.name}: the server did not start on port {self.port}")
+
+        if self.config['metrics_port'] is not None:
+            self.metrics_server = start_metrics_server(self.config['metrics_port'])
+
+        with self._seed_lock:
+            self._serving = True
+            file_ids = list(self.seeded.values())
+        for file_id in file_ids:
+            self._announce(file_id)
+        logging.info("%s is running on port %s, seeding %s files (%s more being added).", self.name, self.port,
+                     len(file_ids), len(self.seeding) - len(file_ids))
+
+    # Function to find the manifest of a file to download: a saved manifest, the manifest of
+    # a file we seed, or one built from a local copy of the file
+    def _manifest(self, entry):
+        if entry.get('manifest'):
+            return load_manifest(entry['manifest'])
+
+        # A file we seed (waiting for it if it is still being added)
+        future = self.seeding.get(entry['source'])
+        if future is not None:
+            try:
+                return self.store.get_file(future.result()).manifest
+            except Exception:
+                pass  # Already logged; build the manifest from the file instead
+        return load_or_build_manifest(entry['source'], entry.get('chunk_size'),
+                                      algorithm=entry.get('algorithm', DEFAULT_HASH_ALGORITHM),
+                                      workers=self.config['hash_workers'], processes=self.config['hash_processes'],
+                                      content_defined=entry.get('content_defined', False), index=self.seed_index)
+
+    # Function to find the peers to download a file from, as a {"ip:port": [chunk indices]} map
+    # (a download entry may also list peers that have the whole file)
+    def _peers(self, entry, manifest):
+        peers = entry.get('peers', {})
+        if not isinstance(peers, dict):
+            peers = {name: range(len(manifest.digests)) for name in peers}
+        return peers
+
+    # Function to collect the downloader options shared by every download of the node
+    def _download_options(self, control=None, on_progress=None):
+        return dict(store=self.store, tracker=self.tracker, pool=self.pool, scheduler=self.scheduler,
+                    window=self.config['window'], request_timeout=self.config['request_timeout'],
+                    control=control, on_progress=on_progress)
+
+    # Function to start downloading a configured file and return a DownloadStream reading it
+    # while it downloads (the chunks from the read position on are fetched first)
+    def open_stream(self, entry, prefetch=DEFAULT_PREFETCH, control=None, on_progress=None):
+        manifest = self._manifest(entry)
+        return DownloadStream(entry['output'], manifest, self._peers(entry, manifest), prefetch,
+                              **self._download_options(control, on_progress))
+
+    # Function to download one configured file; returns True once it is complete.
+    # `control` and `on_progress` are handed to the downloader (see SwarmDownloader); progress
+    # updates also carry the entry's output path.
+    def download(self, entry, control=None, on_progress=None):
+        manifest = self._manifest(entry)
+        report = on_progress
+
+        # Peers we download from earn upload slots from us (see UploadLimiter)
+        def on_progress(update):
+            if update['type'] == 'chunk':
+                self.limiter.credit(update['peer'], update['bytes'])
+            if report is not None:
+                report({**update, 'output': entry['output']})
+
+        peers = self._peers(entry, manifest)
+        options = self._download_options(control, on_progress)
+        if entry.get('erasure'):
+            # Any data_shards chunks of each stripe will do; the original file is rebuilt from them
+            complete = download_erasure_coded(entry['output'], manifest, load_layout(entry['erasure']), peers, **options)
+        elif entry.get('previous') and os.path.exists(entry['previous']):
+            # Only the chunks the older version doesn't have are downloaded
+            complete = sync_to_file(entry['output'], manifest, entry['previous'], peers, **options)
+        else:
+            complete = download_to_file(entry['output'], manifest, peers, **options)
+        if complete:
+            logging.info("File %s successfully reconstructed by %s.", entry['output'], self.name)
+            files_downloaded.inc()
+        elif control is not None and control.cancelled:
+            logging.info("%s cancelled the download of %s.", self.name, entry['output'])
+        else:
+            logging.error("%s failed to download all chunks of %s.", self.name, entry['output'])
+        return complete
+
+    # Function to run every configured download, `max_downloads` at a time; returns {output: complete}
+    def download_all(self, control=None, on_progress=None):
+        downloads = self.config['download']
+        if not downloads:
+            return {}
+        with ThreadPoolExecutor(max_workers=self.config['max_downloads']) as executor:
+            results = executor.map(lambda entry: self._try_download(entry, control, on_progress), downloads)
+            return {entry['output']: complete for entry, complete in zip(downloads, results)}
+
+    # Function to download a file, logging (not raising) failures so other downloads carry on
+    def _try_download(self, entry, control=None, on_progress=None):
+        if control is not None and control.cancelled:
+            return False
+        try:
+            return self.download(entry, control, on_progress)
+        except Exception as e:
+            logging.error("%s could not download %s: %s", self.name, entry.get('output'), e)
+            return False
+
+    # Function to report the node's statistics (kept in the shared, thread-safe metrics registry)
+    def statistics(self):
+        stats = {
+            'uploaded_file_chunks': chunks_served.value(),
+            'downloaded_file_chunks': chunks_downloaded.value(),
+            'downloaded_files': files_downloaded.value(),
+        }
+        if self.cache is not None:
+            stats['cache'] = self.cache.stats()
+        stats['upload'] = self.limiter.stats()
+        return stats
+
+    # Function to run the node: serve, download, then keep seeding if configured to.
+    # With serve=False only the downloads run (seeded files are still used as local chunks).
+    def run(self, serve=True):
+        return run_nodes([self], serve)
+
+    # Function to stop the node's async server and metrics endpoint and release its
+    # connections and memory maps (the threaded server runs until the process exits)
+    def stop(self):
+        if self.server is not None:
+            self.server.stop()
+        if self.metrics_server is not None:
+            self.metrics_server.shutdown()
+        self._ingester.shutdown(wait=False, cancel_futures=True)
+        self.pool.close_all()
+        self.store.close()
+
+
+# Function to run several nodes in this process: every server is started before any
+# download begins, so nodes can fetch from each other; returns {node name: download results}
+def run_nodes(nodes, serve=True):
+    for node in nodes:
+        if serve:
+            node.start()
+        else:
+            node.seed_files()
+
+    results = {}
+
+    def download(node):
+        results[node.name] = node.download_all()
+        logging.info("%s statistics: %s", node.name, node.statistics())
+
+    threads = [threading.Thread(target=download, args=(node,)) for node in nodes]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    if serve and any(node.config['keep_seeding'] for node in nodes):
+        logging.info("Seeding until interrupted (Ctrl+C to stop).")
+        try:
+            threading.Event().wait()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            for node in nodes:
+                node.stop()
+    return results
+
+
+# Entry point: run the node(s) described by one or more JSON config files
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Run one or more peer nodes from JSON config files.")
+    parser.add_argument('configs', nargs='+', help="config file holding a node, or several under \"nodes\"")
+    parser.add_argument('--no-serve', action='store_true', help="only run the downloads, without a server")
+    args = parser.parse_args()
+
+    nodes = [Node(config) for config_path in args.configs for config in load_node_configs(config_path)]
+    run_nodes(nodes, serve=not args.no_serve)
@@ -0,0 +1,185 @@
+import os
+import struct
+import logging
+from file_utils import get_hash_function, DEFAULT_HASH_ALGORITHM
+from log_utils import setup_logging
+
+# Set up logging to display informational messages
+setup_logging()
+
+# Bitfield sidecar layout: header, then one bit per chunk (1 = chunk written and verified)
+BITFIELD_MAGIC = b'P2BF'
+BITFIELD_VERSION = 1
+BITFIELD_HEADER = struct.Struct('!4sBQIB')  # magic, version, file_size, chunk_size, file_id_length
+
+
+# A download in progress, written straight into its final output file.
+# The file is preallocated to its full size and every verified chunk is written at
+# its offset (`index * chunk_size`, or `chunk_offsets[index]` for content-defined chunks)
+# as soon as it arrives. A small bitfield sidecar
+# (`<output_file>.bitfield`) records which chunks are on disk, so a restarted node
+# only fetches the chunks that are still missing. Memory use doesn't grow with the file.
+# Given the chunk `digests`, chunks already in the output file are checked when it is opened:
+# those the sidecar claims (a power loss can leave a bit on disk without its chunk's data),
+# or, for a file that is there without a sidecar (such as an earlier, finished download),
+# every chunk it holds, so only the chunks that don't match are downloaded again.
+class PartialFile:
+    def __init__(self, output_file, file_size, chunk_size, file_id=b'', chunk_offsets=None, digests=None,
+                 algorithm=DEFAULT_HASH_ALGORITHM):
+        self.output_file = output_file
+        self.bitfield_path = output_file + '.bitfield'
+        self.file_size = file_size
+        self.chunk_size = chunk_size
+        self.file_id = file_id
+        self.chunk_offsets = chunk_offsets
+        if chunk_offsets is not None:
+            self.total_chunks = len(chunk_offsets) - 1
+        else:
+            self.total_chunks = (file_size + chunk_size - 1) // chunk_size
+
+        # Resume from the sidecar if it belongs to this download, otherwise start over
+        self.bitfield = self._load_bitfield()
+        existing = os.path.exists(output_file)
+        resuming = self.bitfield is not None and existing
+        if not resuming:
+            self.bitfield = bytearray((self.total_chunks + 7) // 8)
+
+        # Open (or create) the output file, check the chunks already in it, and make sure it has its full size
+        self.fd = os.open(output_file, os.O_RDWR | os.O_CREAT, 0o644)
+        existing_size = os.fstat(self.fd).st_size
+        if digests is not None and existing:
+            if resuming:
+                claimed = [i for i in range(self.total_chunks) if self.has(i)]
+            else:
+                claimed = [i for i in range(self.total_chunks) if sum(self.chunk_range(i)) <= existing_size]
+            self.bitfield = self._check_chunks(claimed, digests, algorithm)
+            failed = len(claimed) - self._count()
+            if resuming and failed:
+                logging.warning("%s: %s chunks the sidecar claims don't match; downloading them again.",
+                                output_file, failed)
+        if existing_size != file_size:
+            self._preallocate()
+        self._write_bitfield()
+        self.bitfield_fd = os.open(self.bitfield_path, os.O_RDWR)
+
+        self.available_count = self._count()
+        if resuming:
+            logging.info("Resuming %s: %s/%s chunks already on disk.", output_file, self.available_count, self.total_chunks)
+        elif self.available_count:
+            logging.info("%s already holds %s/%s chunks of the download.", output_file, self.available_count,
+                         self.total_chunks)
+
+    # Function to read the sidecar, returning None if it is missing or for a different download
+    def _load_bitfield(self):
+        try:
+            with open(self.bitfield_path, 'rb') as f:
+                data = f.read()
+            magic, version, file_size, chunk_size, id_length = BITFIELD_HEADER.unpack_from(data)
+        except (FileNotFoundError, struct.error):
+            return None
+
+        header_size = BITFIELD_HEADER.size + id_length
+        if (magic != BITFIELD_MAGIC or version != BITFIELD_VERSION or file_size != self.file_size
+                or chunk_size != self.chunk_size or data[BITFIELD_HEADER.size:header_size] != self.file_id
+                or len(data) != header_size + (self.total_chunks + 7) // 8):
+            logging.warning("Ignoring %s: it belongs to a different download.", self.bitfield_path)
+            return None
+        return bytearray(data[header_size:])
+
+    # Function to check chunks in the output file against their digests; returns a bitfield of those that match
+    def _check_chunks(self, chunk_indices, digests, algorithm):
+        hash_function = get_hash_function(algorithm)
+        bitfield = bytearray((self.total_chunks + 7) // 8)
+        for chunk_index in chunk_indices:
+            offset, length = self.chunk_range(chunk_index)
+            if hash_function(os.pread(self.fd, length, offset)).digest() == digests[chunk_index]:
+                bitfield[chunk_index >> 3] |= 0x80 >> (chunk_index & 7)
+        return bitfield
+
+    # Function to count the chunks marked in the bitfield
+    def _count(self):
+        return sum(bin(byte).count('1') for byte in self.bitfield)
+
+    # Function to write the whole sidecar (atomically, via a temporary file)
+    def _write_bitfield(self):
+        temp_path = self.bitfield_path + '.tmp'
+        with open(temp_path, 'wb') as f:
+            f.write(BITFIELD_HEADER.pack(BITFIELD_MAGIC, BITFIELD_VERSION, self.file_size,
+                                         self.chunk_size, len(self.file_id)))
+            f.write(self.file_id)
+            f.write(self.bitfield)
+        os.replace(temp_path, self.bitfield_path)
+
+    # Function to give the output file its full size up front
+    def _preallocate(self):
+        os.ftruncate(self.fd, self.file_size)
+
+        # Reserve the blocks too where the platform supports it, so writes can't fail halfway for lack of space
+        if self.file_size and hasattr(os, 'posix_fallocate'):
+            try:
+                os.posix_fallocate(self.fd, 0, self.file_size)
+            except OSError:
+                pass
+
+    # Function to check whether a chunk is already on disk
+    def has(self, chunk_index):
+        return bool(self.bitfield[chunk_index >> 3] & (0x80 >> (chunk_index & 7)))
+
+    # Function to list the chunks that still need to be downloaded
+    def missing(self):
+        return [i for i in range(self.total_chunks) if not self.has(i)]
+
+    # Function to check whether every chunk has been written
+    def complete(self):
+        return self.available_count == self.total_chunks
+
+    # Function to find where a chunk goes in the file: (offset, length)
+    def chunk_range(self, chunk_index):
+        if self.chunk_offsets is not None:
+            offset = self.chunk_offsets[chunk_index]
+            return offset, self.chunk_offsets[chunk_index + 1] - offset
+        offset = chunk_index * self.chunk_size
+        return offset, min(self.chunk_size, self.file_size - offset)
+
+    # Function to write a verified chunk at its offset and record it in the sidecar
+    def write_chunk(self, chunk_index, data):
+        if self.has(chunk_index):
+            return
+
+        offset, expected_length = self.chunk_range(chunk_index)
+        if len(data) != expected_length:
+            raise ValueError(f"Chunk {chunk_index} has {len(data)} bytes, expected {expected_length}")
+
+        # Write the data before marking it, so a crashed process can lose a chunk but never claim one that
+        # isn't there. Neither write is synced, so after a power loss the bit may reach the disk without
+        # the data; claimed chunks are checked again on resume when the digests are known.
+        written = 0
+        view = memoryview(data)
+        while written < len(data):
+            written += os.pwrite(self.fd, view[written:], offset + written)
+
+        byte_index = chunk_index >> 3
+        self.bitfield[byte_index] |= 0x80 >> (chunk_index & 7)
+        os.pwrite(self.bitfield_fd, bytes([self.bitfield[byte_index]]),
+                  BITFIELD_HEADER.size + len(self.file_id) + byte_index)
+        self.available_count += 1
+
+    # Function to read a chunk that is already on disk
+    def read_chunk(self, chunk_index):
+        offset, length = self.chunk_range(chunk_index)
+        return os.pread(self.fd, length, offset)
+
+    # Function to flush the file and close it, removing the sidecar once the download is complete
+    def close(self):
+        os.fsync(self.fd)
+        os.close(self.fd)
+        os.close(self.bitfield_fd)
+        if self.complete():
+            os.remove(self.bitfield_path)
+            logging.info("Download of %s complete.", self.output_file)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,226 @@
+import time
+import random
+import logging
+import threading
+from collections import deque
+from log_utils import setup_logging
+from metrics import peer_bans
+
+setup_logging()
+
+# Weights of the newest sample in the latency average and its variation (as in TCP's RTO estimator)
+LATENCY_ALPHA = 0.125
+LATENCY_BETA = 0.25
+
+# Weight of the newest sample in the throughput average
+THROUGHPUT_ALPHA = 0.25
+
+# Seconds of deliveries pooled into one throughput sample, so chunks that arrive together don't spike it
+THROUGHPUT_SAMPLE_SECONDS = 0.1
+
+# Shortest adaptive request timeout, in seconds
+MIN_REQUEST_TIMEOUT = 0.5
+
+# Delay before retrying a failed peer: BACKOFF_BASE * 2^failures seconds, at most BACKOFF_MAX, with jitter
+BACKOFF_BASE = 0.1
+BACKOFF_MAX = 10
+
+# Seconds before asking a peer that answered CHOKED again (it chooses whom to upload to every few seconds)
+CHOKED_RETRY_SECONDS = 2
+
+# Corrupt chunks within CORRUPTION_WINDOW seconds that get a peer banned (the circuit breaker opens)
+CORRUPTION_THRESHOLD = 3
+CORRUPTION_WINDOW = 60
+
+# Seconds a peer stays banned the first time; each further ban doubles it, up to MAX_BAN_SECONDS
+BAN_SECONDS = 30
+MAX_BAN_SECONDS = 600
+
+
+# Function to work out how long to wait before retry number `failures` (exponential backoff with jitter).
+# Half the delay is fixed and half random, so peers that failed together don't all retry together.
+def backoff_delay(failures, base=BACKOFF_BASE, cap=BACKOFF_MAX):
+    delay = min(cap, base * 2 ** max(failures - 1, 0))
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
+# What we have learned about one peer: smoothed latency and throughput, recent failures and bans
+class PeerHealth:
+    def __init__(self):
+        self.latency = None  # Smoothed seconds from request to first response
+        self.latency_var = 0.0  # Smoothed deviation of the latency
+        self.throughput = None  # Smoothed bytes per second while the peer has requests in flight
+        self.failures = 0  # Failures since the last success
+        self.retry_at = 0.0  # Monotonic time before which the peer is backing off
+        self.banned_until = 0.0  # Monotonic time before which the peer is banned
+        self.bans = 0
+        self.corruptions = deque()  # Times of recent corrupt chunks
+        self.last_delivery = 0.0
+        self.sample_bytes = 0
+        self.sample_seconds = 0.0
+
+    # Function to fold a latency sample into the average and its variation
+    def add_latency(self, seconds):
+        if self.latency is None:
+            self.latency, self.latency_var = seconds, seconds / 2
+        else:
+            self.latency_var += LATENCY_BETA * (abs(seconds - self.latency) - self.latency_var)
+            self.latency += LATENCY_ALPHA * (seconds - self.latency)
+
+    # Function to count bytes delivered since `busy_since`, updating the throughput once enough time has passed
+    def add_delivery(self, byte_count, busy_since, now):
+        self.sample_bytes += byte_count
+        self.sample_seconds += max(now - busy_since, 0.0)
+        self.last_delivery = now
+        if self.sample_seconds < THROUGHPUT_SAMPLE_SECONDS:
+            return
+        sample = self.sample_bytes / self.sample_seconds
+        if self.throughput is None:
+            self.throughput = sample
+        else:
+            self.throughput += THROUGHPUT_ALPHA * (sample - self.throughput)
+        self.sample_bytes, self.sample_seconds = 0, 0.0
+
+    # Function to estimate the seconds one more request of `chunk_size` bytes would take
+    # (peers we know nothing about yet count as fast, so they get tried)
+    def expected_seconds(self, chunk_size):
+        seconds = self.latency or 0.0
+        if self.throughput:
+            seconds += chunk_size / self.throughput
+        return seconds
+
+
+# Per-peer health tracking shared by the downloads of a node.
+# Every response updates the peer's smoothed latency and throughput; failures make the peer
+# back off exponentially (with jitter) before it is tried again, and a peer that keeps sending
+# corrupt chunks is banned for a while (the circuit breaker opens), for longer each time it
+# happens again. Downloaders ask the scheduler which peers are usable, rank them fastest
+# first, size each peer's request window by its share of the best throughput, and time
+# requests out after the peer's usual latency plus four deviations instead of a fixed timeout,
+# so a slow or dead peer holds on to few chunks and gives them up quickly.
+class PeerScheduler:
+    def __init__(self, corruption_threshold=CORRUPTION_THRESHOLD, ban_seconds=BAN_SECONDS):
+        self.corruption_threshold = corruption_threshold
+        self.ban_seconds = ban_seconds
+        self.peers = {}  # Maps "ip:port" -> PeerHealth
+        self._lock = threading.Lock()
+
+    # Function to return a peer's health record, creating it on first use
+    def _health(self, name):
+        health = self.peers.get(name)
+        if health is None:
+            health = self.peers[name] = PeerHealth()
+        return health
+
+    # Function to record a chunk received from a peer. `sent_at` is when its request was sent;
+    # only the first chunk of a request says anything about latency (later ones queue behind it).
+    def record_success(self, name, sent_at, byte_count, first_in_request=True):
+        now = time.monotonic()
+        with self._lock:
+            health = self._health(name)
+            if first_in_request:
+                health.add_latency(now - sent_at)
+            health.add_delivery(byte_count, max(sent_at, health.last_delivery), now)
+            health.failures = 0
+            health.retry_at = 0.0
+
+    # Function to record a timeout or connection failure; returns the seconds the peer now backs off
+    def record_failure(self, name):
+        with self._lock:
+            health = self._health(name)
+            health.failures += 1
+            delay = backoff_delay(health.failures)
+            health.retry_at = time.monotonic() + delay
+            return delay
+
+    # Function to record that a peer is choking us: it isn't failing, so it is simply left alone for a while
+    def record_choked(self, name):
+        with self._lock:
+            health = self._health(name)
+            health.retry_at = max(health.retry_at, time.monotonic() + CHOKED_RETRY_SECONDS)
+
+    # Function to record a corrupt chunk from a peer; returns True if this got the peer banned
+    def record_corruption(self, name):
+        now = time.monotonic()
+        with self._lock:
+            health = self._health(name)
+
+            # Requests sent before the ban are still coming back; they don't count again
+            if health.banned_until > now:
+                return False
+            health.corruptions.append(now)
+            while health.corruptions and health.corruptions[0] < now - CORRUPTION_WINDOW:
+                health.corruptions.popleft()
+            if len(health.corruptions) < self.corruption_threshold:
+                return False
+
+            # Open the circuit: leave the peer alone for a while, longer for repeat offenders
+            ban = min(MAX_BAN_SECONDS, self.ban_seconds * 2 ** health.bans)
+            health.banned_until = now + ban
+            health.bans += 1
+            health.corruptions.clear()
+        peer_bans.inc(peer=name)
+        logging.warning("Banning peer %s for %ss after %s corrupt chunks", name, ban, self.corruption_threshold)
+        return True
+
+    # Function to check whether a peer may be sent requests right now
+    def available(self, name):
+        return self.retry_in(name) == 0
+
+    # Function to return the seconds until a peer may be sent requests again (0 if it may now)
+    def retry_in(self, name):
+        with self._lock:
+            health = self.peers.get(name)
+            if health is None:
+                return 0
+            return max(0.0, health.retry_at - time.monotonic(), health.banned_until - time.monotonic())
+
+    # Function to check whether a peer is banned for sending corrupt chunks
+    def banned(self, name):
+        with self._lock:
+            health = self.peers.get(name)
+            return health is not None and health.banned_until > time.monotonic()
+
+    # Function to return the timeout for a request to a peer: its smoothed latency plus four
+    # deviations, between MIN_REQUEST_TIMEOUT and `max_timeout` (which is used until we know the peer)
+    def timeout(self, name, max_timeout):
+        with self._lock:
+            health = self.peers.get(name)
+            if health is None or health.latency is None:
+                return max_timeout
+            return min(max_timeout, max(MIN_REQUEST_TIMEOUT, health.latency + 4 * health.latency_var))
+
+    # Function to sort peers fastest first by the expected time to fetch a chunk of `chunk_size` bytes
+    def rank(self, names, chunk_size):
+        with self._lock:
+            return sorted(names, key=lambda name: self._health(name).expected_seconds(chunk_size))
+
+    # Function to scale a request window to a peer's share of the best throughput we've seen,
+    # so slow peers keep fewer chunks tied up (every peer keeps at least one request)
+    def window(self, name, window):
+        with self._lock:
+            health = self.peers.get(name)
+            best = max((h.throughput or 0 for h in self.peers.values()), default=0)
+            if health is None or not health.throughput or not best:
+                return window
+            return max(1, min(window, round(window * health.throughput / best)))
+
+    # Function to return every peer's health as plain data (for logs and status displays)
+    def snapshot(self):
+        now = time.monotonic()
+        with self._lock:
+            return {
+                name: {
+                    'latency': health.latency,
+                    'throughput': health.throughput,
+                    'failures': health.failures,
+                    'backoff_seconds': max(0.0, health.retry_at - now),
+                    'banned_seconds': max(0.0, health.banned_until - now),
+                    'bans': health.bans,
+                }
+                for name, health in self.peers.items()
+            }
+
+
+# Scheduler used by downloads unless a different one is passed in
+peer_scheduler = PeerScheduler()
@@ -0,0 +1,248 @@
+import asyncio
+import struct
+
+# Binary frame layout shared by the client and the server.
+#
+# Every message on the wire is a fixed-size header followed by the digest and
+# then the payload:
+#
+#   magic (2s) | version (B) | opcode (B) | request_id (I) | chunk_index (I) | payload_length (Q) | hash_id (B) | digest_length (B)
+#
+# The receiver always knows exactly how many bytes to read, so chunks of any
+# size (and chunks containing arbitrary binary data) can be transferred safely.
+# Responses echo the request_id of the request they answer, which lets a client
+# keep several requests outstanding on one connection and match the replies
+# in whatever order they arrive. The digest is binary and hash_id names the
+# algorithm that produced it (see file_utils.HASH_IDS); in a request, hash_id
+# asks the server for a particular algorithm (0 lets the server choose).
+MAGIC = b'P2'
+PROTOCOL_VERSION = 3
+HEADER = struct.Struct('!2sBBIIQBB')
+
+# Opcodes for requests sent by a client
+OP_GET_CHUNK = 1
+OP_VERIFY_CHUNK = 2
+
+# Opcodes for responses sent by a server
+OP_CHUNK = 3
+OP_OK = 4
+OP_ERROR = 5
+
+# Chunk availability exchanged between peers: GET_BITFIELD (payload: file id) is answered
+# with BITFIELD (chunk_index: number of chunks, payload: one bit per chunk the peer has)
+OP_GET_BITFIELD = 6
+OP_BITFIELD = 7
+
+# Tracker messages (see tracker.py); their payloads start with a length-prefixed file id
+OP_HAVE = 8  # chunk_index: the chunk the sender now has
+OP_ANNOUNCE = 9  # chunk_index: number of chunks, payload also carries the listen port and bitfield
+OP_GET_PEERS = 10
+OP_PEERS = 11  # payload: the peers seeding the file and their bitfields
+
+# Batched chunk requests, answered by one CHUNK (or ERROR) frame per chunk, in the order
+# requested and all tagged with the batch's request id. Their payloads start with a
+# length-prefixed file id, followed by the chunk count (GET_RANGE: chunk_index is the
+# first chunk of a contiguous run) or by every chunk index (GET_CHUNKS).
+OP_GET_RANGE = 12
+OP_GET_CHUNKS = 13
+BATCH_OPCODES = (OP_GET_RANGE, OP_GET_CHUNKS)
+
+# Session handshake: a client that wants compressed chunks sends HELLO (payload: the ids of
+# the compression algorithms it accepts, best first, one byte each) before any other request.
+# The server answers HELLO (payload: the id it picked, or nothing for none); servers that
+# predate the handshake answer ERROR, which also means no compression. With compression
+# agreed, the server may answer a chunk request with COMPRESSED_CHUNK instead of CHUNK: the
+# payload is compressed, while the digest is still that of the uncompressed chunk.
+# A client that serves chunks itself also puts its listening port in the HELLO's chunk_index
+# (0 for none), so the server can tell it apart from other peers on the same host.
+OP_HELLO = 14
+OP_COMPRESSED_CHUNK = 15
+CHUNK_OPCODES = (OP_CHUNK, OP_COMPRESSED_CHUNK)
+
+# A server that only uploads to a few peers at a time (see upload_limiter.py) answers the chunk
+# requests of the others with CHOKED (chunk_index: the chunk asked for). The server still has
+# the chunk; the client should ask other peers for now and try this one again later.
+OP_CHOKED = 16
+
+# Most chunks a single batched request may ask for
+MAX_BATCH_CHUNKS = 1024
+
+# Opcode names, for logs and metrics
+OPCODE_NAMES = {value: name[3:] for name, value in dict(globals()).items() if name.startswith('OP_')}
+
+# Refuse frames larger than this so a corrupt header can't make us allocate unbounded memory
+MAX_PAYLOAD_SIZE = 64 * 1024 * 1024
+
+# Payloads smaller than this are sent in the same call as the header
+SMALL_PAYLOAD_SIZE = 64 * 1024
+
+
+class ProtocolError(Exception):
+    """Raised when a peer sends a malformed or unsupported frame."""
+
+
+class Frame:
+    """A decoded protocol frame."""
+
+    __slots__ = ('opcode', 'chunk_index', 'digest', 'payload', 'request_id', 'hash_id')
+
+    def __init__(self, opcode, chunk_index=0, digest=b'', payload=b'', request_id=0, hash_id=0):
+        self.opcode = opcode
+        self.chunk_index = chunk_index
+        self.digest = digest
+        self.payload = payload
+        self.request_id = request_id
+        self.hash_id = hash_id
+
+    def __repr__(self):
+        return (f"Frame(opcode={self.opcode}, request_id={self.request_id}, chunk_index={self.chunk_index}, "
+                f"hash_id={self.hash_id}, digest={self.digest.hex()}, payload_length={len(self.payload)})")
+
+
+# Function to encode a file id (hex root hash) with a length prefix, for payloads that carry more after it
+def pack_file_id(file_id):
+    raw = bytes.fromhex(file_id)
+    return bytes([len(raw)]) + raw
+
+
+# Function to split a length-prefixed file id off the front of a payload; returns (file_id, rest)
+def unpack_file_id(payload):
+    payload = bytes(payload)
+    if not payload or len(payload) < 1 + payload[0]:
+        raise ProtocolError("Payload is missing its file id")
+    length = payload[0]
+    return payload[1:1 + length].hex(), payload[1 + length:]
+
+
+# Function to build a batched request for `chunk_indices`; returns (opcode, chunk_index, payload).
+# A contiguous run is sent as GET_RANGE, anything else as GET_CHUNKS.
+def pack_batch_request(chunk_indices, file_id=None):
+    if not 0 < len(chunk_indices) <= MAX_BATCH_CHUNKS:
+        raise ValueError(f"A batch must ask for 1 to {MAX_BATCH_CHUNKS} chunks")
+    prefix = pack_file_id(file_id or '')
+    first = chunk_indices[0]
+    if list(chunk_indices) == list(range(first, first + len(chunk_indices))):
+        return OP_GET_RANGE, first, prefix + struct.pack('!I', len(chunk_indices))
+    return OP_GET_CHUNKS, 0, prefix + struct.pack(f'!{len(chunk_indices)}I', *chunk_indices)
+
+
+# Function to decode a batched request; returns (file_id, chunk_indices)
+def unpack_batch_request(frame):
+    file_id, rest = unpack_file_id(frame.payload)
+    if frame.opcode == OP_GET_RANGE:
+        if len(rest) != 4:
+            raise ProtocolError("GET_RANGE payload must end with a chunk count")
+        count = struct.unpack('!I', rest)[0]
+        chunk_indices = range(frame.chunk_index, frame.chunk_index + count)
+    else:
+        if len(rest) % 4:
+            raise ProtocolError("GET_CHUNKS payload must end with whole chunk indices")
+        chunk_indices = struct.unpack(f'!{len(rest) // 4}I', rest)
+
+    if not 0 < len(chunk_indices) <= MAX_BATCH_CHUNKS:
+        raise ProtocolError(f"Batch of {len(chunk_indices)} chunks (limit {MAX_BATCH_CHUNKS})")
+    return file_id, chunk_indices
+
+
+# Function to build the header (and digest) that precedes a payload
+def pack_header(opcode, chunk_index=0, payload_length=0, digest=b'', request_id=0, hash_id=0):
+    if len(digest) > 255:
+        raise ProtocolError(f"Digest too long: {len(digest)} bytes")
+    return HEADER.pack(MAGIC, PROTOCOL_VERSION, opcode, request_id, chunk_index, payload_length, hash_id, len(digest)) + digest
+
+
+# Function to send a complete frame over a socket
+def send_frame(sock, opcode, chunk_index=0, payload=b'', digest=b'', request_id=0, hash_id=0):
+    header = pack_header(opcode, chunk_index, len(payload), digest, request_id, hash_id)
+
+    # Small payloads go out in a single call; large ones are sent without copying them into the header buffer
+    if len(payload) < SMALL_PAYLOAD_SIZE:
+        sock.sendall(header + bytes(payload))
+    else:
+        sock.sendall(header)
+        sock.sendall(payload)
+
+
+# Function to send a frame whose payload is read straight from a file with sendfile()
+# (the kernel copies the bytes from the page cache to the socket without passing through Python)
+def send_frame_file(sock, opcode, chunk_index, file, offset, count, digest=b'', request_id=0, hash_id=0):
+    sock.sendall(pack_header(opcode, chunk_index, count, digest, request_id, hash_id))
+    if count:
+        sock.sendfile(file, offset, count)
+
+
+# Function to read exactly `size` bytes from a socket
+# (returns None instead if `eof_ok` is set and the peer closed before sending anything)
+def recv_exact(sock, size, eof_ok=False):
+    buffer = bytearray(size)
+    view = memoryview(buffer)
+    received = 0
+
+    # Keep reading until the buffer is full; recv may return fewer bytes than requested
+    while received < size:
+        count = sock.recv_into(view[received:], size - received)
+        if count == 0:
+            if eof_ok and received == 0:
+                return None
+            raise ConnectionError(f"Connection closed after {received} of {size} bytes")
+        received += count
+
+    return buffer
+
+
+# Function to parse a header into (opcode, request_id, chunk_index, payload_length, hash_id, digest_length)
+def unpack_header(data):
+    magic, version, opcode, request_id, chunk_index, payload_length, hash_id, digest_length = HEADER.unpack(data)
+
+    # Reject anything that isn't one of our frames
+    if magic != MAGIC:
+        raise ProtocolError(f"Bad frame magic: {bytes(magic)!r}")
+    if version != PROTOCOL_VERSION:
+        raise ProtocolError(f"Unsupported protocol version: {version}")
+    if payload_length > MAX_PAYLOAD_SIZE:
+        raise ProtocolError(f"Payload too large: {payload_length} bytes")
+
+    return opcode, request_id, chunk_index, payload_length, hash_id, digest_length
+
+
+# Function to receive a complete frame from a socket
+# (returns None if the peer closed the connection cleanly between frames)
+def recv_frame(sock):
+    header = recv_exact(sock, HEADER.size, eof_ok=True)
+    if header is None:
+        return None
+
+    opcode, request_id, chunk_index, payload_length, hash_id, digest_length = unpack_header(header)
+    digest = bytes(recv_exact(sock, digest_length)) if digest_length else b''
+    payload = recv_exact(sock, payload_length) if payload_length else b''
+    return Frame(opcode, chunk_index, digest, payload, request_id, hash_id)
+
+
+# Function to receive a complete frame from an asyncio StreamReader
+# (returns None if the peer closed the connection cleanly between frames)
+async def read_frame_async(reader):
+    try:
+        header = await reader.readexactly(HEADER.size)
+    except asyncio.IncompleteReadError as e:
+        if not e.partial:
+            return None
+        raise ConnectionError(f"Connection closed after {len(e.partial)} of {HEADER.size} bytes")
+
+    opcode, request_id, chunk_index, payload_length, hash_id, digest_length = unpack_header(header)
+    try:
+        digest = await reader.readexactly(digest_length) if digest_length else b''
+        payload = await reader.readexactly(payload_length) if payload_length else b''
+    except asyncio.IncompleteReadError as e:
+        raise ConnectionError(f"Connection closed in the middle of a frame ({len(e.partial)} bytes read)")
+    return Frame(opcode, chunk_index, digest, payload, request_id, hash_id)
+
+
+# Function to queue a complete frame on an asyncio StreamWriter
+# (callers await writer.drain() afterwards so a slow reader applies backpressure;
+# pass payload_length to write only the header of a payload that is sent separately)
+def write_frame_async(writer, opcode, chunk_index=0, payload=b'', digest=b'', request_id=0, payload_length=None, hash_id=0):
+    if payload_length is None:
+        payload_length = len(payload)
+    writer.write(pack_header(opcode, chunk_index, payload_length, digest, request_id, hash_id))
+    if payload:
+        writer.write(payload)
@@ -0,0 +1,179 @@
+import time
+import queue
+import random
+import socket
+import logging
+import argparse
+import threading
+from log_utils import setup_logging
+
+setup_logging()
+
+# Largest piece of data forwarded at once (roughly one burst of TCP segments)
+SEGMENT_SIZE = 16 * 1024
+
+# Segments a direction may hold in flight before the sender is made to wait (the "TCP window")
+MAX_QUEUED_SEGMENTS = 64
+
+# Minimum retransmission timeout added to a "lost" segment, like TCP's minimum RTO
+MIN_RETRANSMIT_DELAY = 0.2
+
+
+# Shared pacing for one direction of a link, so every connection through the shim shares its bandwidth
+class Pacer:
+    def __init__(self, bandwidth):
+        self.bandwidth = bandwidth  # Bytes per second (None for unlimited)
+        self.free_at = 0.0
+        self._lock = threading.Lock()
+
+    # Function to wait until `size` bytes have had time to cross the link
+    def wait(self, size):
+        if not self.bandwidth:
+            return
+        with self._lock:
+            start = max(time.monotonic(), self.free_at)
+            self.free_at = start + size / self.bandwidth
+            done_at = self.free_at
+        delay = done_at - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+
+
+# TCP proxy that makes a localhost link behave like a slower network.
+# Every connection to `port` is forwarded to the target, and each direction of it
+# gets a one-way `latency` (seconds), a shared `bandwidth` limit (bytes per second) and
+# a `loss` rate. TCP hides lost packets from the application, so a lost segment shows up
+# the way it does on a real link: it arrives late (after a retransmission timeout) and
+# holds back everything behind it.
+class LinkShim:
+    def __init__(self, target_host, target_port, latency=0.0, bandwidth=None, loss=0.0,
+                 listen_host='127.0.0.1', listen_port=0, seed=None):
+        self.target = (target_host, target_port)
+        self.latency = latency
+        self.loss = loss
+        self.retransmit_delay = max(MIN_RETRANSMIT_DELAY, 4 * latency)
+        self.pacers = (Pacer(bandwidth), Pacer(bandwidth))  # Upstream and downstream
+        self.random = random.Random(seed)
+        self.listener = socket.create_server((listen_host, listen_port))
+        self.host = listen_host
+        self.port = self.listener.getsockname()[1]
+        self.connections = set()
+        self.closed = False
+        self._lock = threading.Lock()
+
+    # Function to start accepting connections on a background thread; returns the shim
+    def start(self):
+        threading.Thread(target=self._accept_loop, daemon=True).start()
+        logging.info("Link shim on port %s -> %s:%s (latency %ss, bandwidth %s B/s, loss %s)",
+                     self.port, self.target[0], self.target[1], self.latency, self.pacers[0].bandwidth, self.loss)
+        return self
+
+    # Function to accept client connections and pair each with a connection to the target
+    def _accept_loop(self):
+        while not self.closed:
+            try:
+                client, _ = self.listener.accept()
+            except OSError:
+                break
+            try:
+                upstream = socket.create_connection(self.target)
+            except OSError as e:
+                logging.error("Link shim could not reach %s:%s: %s", self.target[0], self.target[1], e)
+                client.close()
+                continue
+
+            for sock in (client, upstream):
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            with self._lock:
+                self.connections.update((client, upstream))
+            open_directions = [2]  # The sockets are closed once both directions have finished
+            self._forward(client, upstream, self.pacers[0], open_directions)
+            self._forward(upstream, client, self.pacers[1], open_directions)
+
+    # Function to start forwarding one direction of a connection
+    def _forward(self, source, destination, pacer, open_directions):
+        segments = queue.Queue(MAX_QUEUED_SEGMENTS)  # (release time, data); None once the source is done
+        threading.Thread(target=self._read_segments, args=(source, segments), daemon=True).start()
+        threading.Thread(target=self._write_segments, args=(source, destination, segments, pacer, open_directions),
+                         daemon=True).start()
+
+    # Function to read from the source and schedule each segment for delivery
+    def _read_segments(self, source, segments):
+        try:
+            while data := source.recv(SEGMENT_SIZE):
+                release_at = time.monotonic() + self.latency
+                if self.loss and self.random.random() < self.loss:
+                    release_at += self.retransmit_delay
+                segments.put((release_at, data))
+        except OSError:
+            pass
+        segments.put(None)
+
+    # Function to deliver segments in order once their delay has passed and the link has capacity
+    def _write_segments(self, source, destination, segments, pacer, open_directions):
+        try:
+            while (segment := segments.get()) is not None:
+                release_at, data = segment
+                delay = release_at - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+                pacer.wait(len(data))
+                destination.sendall(data)
+            destination.shutdown(socket.SHUT_WR)
+        except OSError:
+            # One side went away, so tear down both
+            self._close_pair(source, destination)
+            return
+
+        with self._lock:
+            open_directions[0] -= 1
+            finished = open_directions[0] == 0
+        if finished:
+            self._close_pair(source, destination)
+
+    # Function to close both sockets of a connection
+    def _close_pair(self, *socks):
+        with self._lock:
+            self.connections.difference_update(socks)
+        for sock in socks:
+            try:
+                sock.close()
+            except OSError:
+                pass
+
+    # Function to stop the shim and drop every connection through it
+    def close(self):
+        self.closed = True
+        self.listener.close()
+        with self._lock:
+            connections, self.connections = list(self.connections), set()
+        for sock in connections:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            sock.close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+# Entry point for running a shim in front of a node by hand
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Forward a local port to a node with added latency, bandwidth limits and loss.")
+    parser.add_argument('target', help="host:port to forward to")
+    parser.add_argument('--port', type=int, default=0, help="port to listen on (default: any free port)")
+    parser.add_argument('--latency', type=float, default=0.0, help="one-way delay in seconds")
+    parser.add_argument('--bandwidth', type=float, default=None, help="bytes per second in each direction")
+    parser.add_argument('--loss', type=float, default=0.0, help="fraction of segments to treat as lost")
+    args = parser.parse_args()
+
+    target_host, target_port = args.target.rsplit(':', 1)
+    shim = LinkShim(target_host, int(target_port), args.latency, args.bandwidth, args.loss, listen_port=args.port).start()
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        shim.close()
@@ -0,0 +1,104 @@
+import os
+import json
+import struct
+import hashlib
+import logging
+import threading
+from file_utils import load_manifest, save_manifest
+from log_utils import setup_logging
+
+setup_logging()
+
+# Name and format version of the index file in a seed index directory
+INDEX_FILE = 'index.json'
+INDEX_VERSION = 1
+
+
+# Persisted index of the files a node seeds, kept in its own directory. For every file (by
+# absolute path) it records the size and modification time the file had when it was hashed,
+# how it was chunked, and the manifest built from it. A file whose size and mtime still match
+# loads its chunk layout and digests from that manifest instead of being read again, so
+# restarting a node that seeds hundreds of GB costs a stat() and a manifest read per file.
+# Manifests are kept in the index directory rather than next to the seeded files, which may
+# be on read-only storage. Several processes may share a directory: an entry lost to a
+# concurrent update only means that file gets hashed again.
+class SeedIndex:
+    def __init__(self, directory):
+        self.directory = directory
+        self.index_path = os.path.join(directory, INDEX_FILE)
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self.entries = self._load()  # Maps absolute path -> {size, mtime_ns, chunk_size, algorithm, content_defined, manifest}
+
+    # Function to read the index file (an unreadable or outdated index counts as empty)
+    def _load(self):
+        try:
+            with open(self.index_path) as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as e:
+            logging.warning("Ignoring unreadable seed index %s: %s", self.index_path, e)
+            return {}
+        if data.get('version') != INDEX_VERSION:
+            logging.warning("Ignoring seed index %s: it has format version %s.", self.index_path, data.get('version'))
+            return {}
+        return data.get('files', {})
+
+    # Function to write the index file (atomically, via a temporary file; called with the lock held)
+    def _save(self):
+        temp_path = f"{self.index_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(temp_path, 'w') as f:
+            json.dump({'version': INDEX_VERSION, 'files': self.entries}, f, indent=1, sort_keys=True)
+        os.replace(temp_path, self.index_path)
+
+    # Function to name the file a seeded file's manifest is kept in
+    def manifest_path(self, file_path):
+        name = hashlib.sha256(os.path.abspath(file_path).encode()).hexdigest()[:32]
+        return os.path.join(self.directory, name + '.manifest')
+
+    # Function to return the indexed manifest of a file if the file hasn't changed since it was
+    # hashed and was chunked the way asked for (None otherwise)
+    def lookup(self, file_path, chunk_size, algorithm, content_defined=False):
+        stat = os.stat(file_path)
+        with self._lock:
+            entry = self.entries.get(os.path.abspath(file_path))
+        if (entry is None or entry['size'] != stat.st_size or entry['mtime_ns'] != stat.st_mtime_ns
+                or entry['chunk_size'] != chunk_size or entry['algorithm'] != algorithm
+                or entry['content_defined'] != content_defined):
+            return None
+
+        try:
+            manifest = load_manifest(entry['manifest'])
+        except (OSError, ValueError, struct.error) as e:
+            logging.warning("Ignoring unreadable indexed manifest of %s: %s", file_path, e)
+            return None
+        return manifest if manifest.file_size == stat.st_size else None
+
+    # Function to add a manifest just built from a file to the index.
+    # `stat` is the file's os.stat() from before it was read; a file that changed while it was
+    # being hashed is left out, so it is hashed again next time. The index is only a cache, so
+    # failing to write it is logged rather than raised.
+    def record(self, file_path, manifest, stat):
+        try:
+            current = os.stat(file_path)
+            if (current.st_size, current.st_mtime_ns) != (stat.st_size, stat.st_mtime_ns):
+                logging.warning("%s changed while it was hashed; not adding it to the seed index.", file_path)
+                return
+
+            manifest_path = self.manifest_path(file_path)
+            save_manifest(manifest, manifest_path)
+            with self._lock:
+                # Keep entries other processes sharing the directory added since we loaded it
+                self.entries = {**self._load(), **self.entries}
+                self.entries[os.path.abspath(file_path)] = {
+                    'size': stat.st_size,
+                    'mtime_ns': stat.st_mtime_ns,
+                    'chunk_size': manifest.chunk_size,
+                    'algorithm': manifest.algorithm,
+                    'content_defined': manifest.chunk_offsets is not None,
+                    'manifest': manifest_path,
+                }
+                self._save()
+        except OSError as e:
+            logging.warning("Could not add %s to the seed index %s: %s", file_path, self.directory, e)
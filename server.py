@@ -1,70 +1,277 @@
+import time
 import socket
 import threading
 import logging
-from file_utils import chunk_file, generate_checksum, verify_chunk
+from file_utils import (chunk_file, generate_digest, HASH_ALGORITHMS, HASH_IDS, HASH_NAMES,
+                        DEFAULT_HASH_ALGORITHM)
+from protocol import (Frame, ProtocolError, recv_frame, send_frame, send_frame_file, unpack_batch_request,
+                      OP_GET_CHUNK, OP_VERIFY_CHUNK, OP_GET_BITFIELD, OP_CHUNK, OP_OK, OP_ERROR, OP_BITFIELD,
+                      OP_HELLO, OP_COMPRESSED_CHUNK, OP_CHOKED, BATCH_OPCODES, CHUNK_OPCODES, OPCODE_NAMES)
+from availability import full_bitfield
+from chunk_cache import CachedChunks
+from compression import choose_compression, compress_chunk, COMPRESSION_IDS
+from log_utils import setup_logging
+from metrics import (bytes_sent, chunks_served, server_requests, server_request_seconds, server_sessions,
+                     chunks_compressed, compression_saved_bytes)
 
 # Set up logging to display info and error messages
-logging.basicConfig(level=logging.INFO)
+setup_logging()
+
+# Seconds a persistent client session may stay idle before the server closes it
+IDLE_TIMEOUT = 60
+
+# Function to work out the digest of a chunk in the algorithm the client asked for
+# (the manifest's cached digest is used whenever it is in that algorithm, and a cached
+# chunk source remembers digests it has already worked out)
+def chunk_digest(frame, chunk, manifest=None, file_chunks=None):
+    if frame.hash_id:
+        algorithm = HASH_NAMES.get(frame.hash_id)
+    else:
+        algorithm = manifest.algorithm if manifest else DEFAULT_HASH_ALGORITHM
+
+    if manifest and algorithm == manifest.algorithm:
+        return HASH_IDS[algorithm], manifest.digests[frame.chunk_index]
+    if algorithm not in HASH_ALGORITHMS:
+        return None, None
+    if isinstance(file_chunks, CachedChunks):
+        return HASH_IDS[algorithm], file_chunks.digest(frame.chunk_index, algorithm, chunk)
+    return HASH_IDS[algorithm], generate_digest(chunk, algorithm)
+
+# Function to find the chunks (and manifest) a request refers to.
+# Requests carry the file id (the manifest's root hash) in their payload. A server seeding
+# a ContentStore looks the file up by id; a server seeding a single file serves it for an
+# empty id or its own id. Returns (None, None) for a file we don't have.
+# With a ChunkCache, the chunks are read through the cache.
+def resolve_chunks(frame, file_chunks, manifest=None, cache=None):
+    chunks, chunk_manifest = _find_chunks(frame, file_chunks, manifest)
+    if cache is not None and chunks is not None:
+        chunks = CachedChunks(chunks, cache, chunk_manifest.root_hash if chunk_manifest else '')
+    return chunks, chunk_manifest
+
+# Function to look up the chunks (and manifest) a request's file id refers to
+def _find_chunks(frame, file_chunks, manifest=None):
+    if frame.opcode in BATCH_OPCODES:
+        file_id = unpack_batch_request(frame)[0]
+    else:
+        file_id = bytes(frame.payload).hex()
+
+    if hasattr(file_chunks, 'get_file'):
+        stored_file = file_chunks.get_file(file_id)
+        if stored_file is None:
+            return None, None
+        return stored_file, stored_file.manifest
+
+    if file_id and manifest and file_id != manifest.root_hash:
+        return None, None
+    return file_chunks, manifest
+
+# Function to build the response for a single decoded request frame
+# (with the file's manifest, cached digests are served instead of hashing every request)
+def handle_request(frame, file_chunks, manifest=None):
+    # The client asked for a file this server doesn't seed
+    if file_chunks is None:
+        logging.warning("Request for unknown file %s.", bytes(frame.payload).hex())
+        return Frame(OP_ERROR, frame.chunk_index, payload=b'unknown file')
+
+    # Check if the request is for a chunk (GET_CHUNK)
+    if frame.opcode == OP_GET_CHUNK:
+        chunk_index = frame.chunk_index
+
+        # A file that is still downloading can only serve the chunks it already has
+        if hasattr(file_chunks, 'has') and 0 <= chunk_index < len(file_chunks) and not file_chunks.has(chunk_index):
+            return Frame(OP_ERROR, chunk_index, payload=b'chunk not available')
+
+        # Ensure the chunk index is valid (within available chunks)
+        if 0 <= chunk_index < len(file_chunks):
+            chunk = file_chunks[chunk_index]  # Fetch the requested chunk
+            hash_id, digest = chunk_digest(frame, chunk, manifest, file_chunks)  # Digest in the client's algorithm
+            if digest is None:
+                return Frame(OP_ERROR, chunk_index, payload=b'unsupported hash algorithm')
+
+            # Log (at DEBUG level, so it costs nothing normally) and send the chunk along with its digest to the client
+            logging.debug("Serving chunk %s to client.", chunk_index)
+            return Frame(OP_CHUNK, chunk_index, digest, chunk, hash_id=hash_id)
+
+        # Log a warning and send an error frame if the requested chunk is invalid
+        logging.warning("Invalid chunk request for index %s.", chunk_index)
+        return Frame(OP_ERROR, chunk_index, payload=b'invalid chunk index')
+
+    # Check if the client is requesting chunk verification (VERIFY_CHUNK)
+    if frame.opcode == OP_VERIFY_CHUNK:
+        chunk_index = frame.chunk_index
+
+        # A chunk we don't have yet can't be verified (nor retransmitted)
+        if hasattr(file_chunks, 'has') and 0 <= chunk_index < len(file_chunks) and not file_chunks.has(chunk_index):
+            return Frame(OP_ERROR, chunk_index, payload=b'chunk not available')
+
+        # Ensure the chunk index is valid (within available chunks)
+        if 0 <= chunk_index < len(file_chunks):
+            chunk = file_chunks[chunk_index]  # Fetch the chunk for verification
+            hash_id, digest = chunk_digest(frame, chunk, manifest, file_chunks)
+            if digest is None:
+                return Frame(OP_ERROR, chunk_index, payload=b'unsupported hash algorithm')
+
+            # If the chunk is not valid (checksum mismatch), retransmit the chunk
+            if digest != frame.digest:
+                logging.debug("Retransmitting chunk %s due to checksum mismatch.", chunk_index)
+                return Frame(OP_CHUNK, chunk_index, digest, chunk, hash_id=hash_id)
+
+            # If the chunk is valid, notify the client that no retransmission is needed
+            logging.debug("Chunk %s verified successfully. No retransmission needed.", chunk_index)
+            return Frame(OP_OK, chunk_index)
+
+        logging.warning("Invalid verify request for index %s.", chunk_index)
+        return Frame(OP_ERROR, chunk_index, payload=b'invalid chunk index')
+
+    # Check if the client is asking which chunks we have (GET_BITFIELD)
+    if frame.opcode == OP_GET_BITFIELD:
+        total_chunks = len(file_chunks)
+        bitfield = file_chunks.bitfield() if hasattr(file_chunks, 'bitfield') else full_bitfield(total_chunks)
+        return Frame(OP_BITFIELD, total_chunks, payload=bitfield)
+
+    # Anything else is not part of the protocol
+    logging.warning("Unknown opcode %s from client.", frame.opcode)
+    return Frame(OP_ERROR, frame.chunk_index, payload=b'unknown opcode')
+
+# Function to build the responses to a batched request (GET_RANGE/GET_CHUNKS), one per chunk in request order
+def handle_batch(frame, file_chunks, manifest=None):
+    file_id, chunk_indices = unpack_batch_request(frame)
+    if file_chunks is None:
+        logging.warning("Batch request for unknown file %s.", file_id)
+
+    for chunk_index in chunk_indices:
+        if file_chunks is None:
+            yield Frame(OP_ERROR, chunk_index, payload=b'unknown file')
+        else:
+            yield handle_request(Frame(OP_GET_CHUNK, chunk_index, hash_id=frame.hash_id), file_chunks, manifest)
+
+# Function to build every response to a request frame
+def handle_frame(frame, file_chunks, manifest=None):
+    if frame.opcode in BATCH_OPCODES:
+        return handle_batch(frame, file_chunks, manifest)
+    return (handle_request(frame, file_chunks, manifest),)
+
+# Function to answer a HELLO handshake; returns (response, compression algorithm for the session).
+# `compression` lists the algorithms this server is willing to use (None for any installed one).
+def handle_hello(frame, compression=None):
+    algorithm = choose_compression(bytes(frame.payload), compression)
+    logging.debug("Client asked for compression %s; using %s.", list(bytes(frame.payload)), algorithm)
+    return Frame(OP_HELLO, payload=bytes([COMPRESSION_IDS[algorithm]]) if algorithm else b''), algorithm
+
+# Function to swap a CHUNK response for a COMPRESSED_CHUNK one when the chunk compresses well
+# (a cached chunk source keeps the compressed form, so a hot chunk is only compressed once)
+def compress_response(response, chunks, algorithm):
+    if response.opcode != OP_CHUNK:
+        return response
+    if isinstance(chunks, CachedChunks):
+        compressed = chunks.compressed(response.chunk_index, algorithm, response.payload)
+    else:
+        compressed = compress_chunk(response.payload, algorithm)
+    if compressed is None:
+        return response
+    chunks_compressed.inc(algorithm=algorithm)
+    compression_saved_bytes.inc(len(response.payload) - len(compressed))
+    return Frame(OP_COMPRESSED_CHUNK, response.chunk_index, response.digest, compressed, hash_id=response.hash_id)
+
+# Function to send a response frame tagged with the id of the request it answers; returns the payload size
+def send_response(client_socket, response, chunks, request_id):
+    # Chunks from a file-backed store are sent with sendfile() instead of copying them
+    if response.opcode == OP_CHUNK and hasattr(chunks, 'chunk_location'):
+        file, offset, length = chunks.chunk_location(response.chunk_index)
+        send_frame_file(client_socket, response.opcode, response.chunk_index, file,
+                        offset, length, response.digest, request_id, response.hash_id)
+        return length
+
+    send_frame(client_socket, response.opcode, response.chunk_index, response.payload,
+               response.digest, request_id, response.hash_id)
+    return len(response.payload)
+
+# Function to record what answering one request cost in the shared metrics
+def record_request(request, start_time, served_chunks, sent_bytes):
+    opcode = OPCODE_NAMES.get(request.opcode, request.opcode)
+    server_requests.inc(opcode=opcode)
+    server_request_seconds.observe(time.monotonic() - start_time, opcode=opcode)
+    if served_chunks:
+        chunks_served.inc(served_chunks)
+    bytes_sent.inc(sent_bytes)
 
 # Function to handle incoming client requests
-def handle_client(client_socket, file_chunks):
+# The connection stays open so the client can send many (pipelined) requests over it.
+# Chunks are compressed once the client asks for it in a HELLO handshake (see protocol.py),
+# using one of the `compression` algorithms (None for any installed one), and with an
+# UploadLimiter they are sent within its bandwidth limits and upload slots.
+def handle_client(client_socket, file_chunks, idle_timeout=IDLE_TIMEOUT, manifest=None, cache=None, compression=None,
+                  limiter=None):
+    server_sessions.inc()
+    session_compression = None
+    session = None
     try:
-        # Receive the request from the client (up to 1024 bytes) and decode it
-        request = client_socket.recv(1024).decode('utf-8')  # Decode the received bytes into a string
-
-        # Check if the request is for a chunk (GET_CHUNK)
-        if request.startswith("GET_CHUNK"):
-            # Extract the chunk index from the request string (formatted as "GET_CHUNK <chunk_index>")
-            chunk_index = int(request.split()[1])
-
-            # Ensure the chunk index is valid (within available chunks)
-            if 0 <= chunk_index < len(file_chunks):
-                chunk = file_chunks[chunk_index]  # Fetch the requested chunk
-                checksum = generate_checksum(chunk)  # Generate a checksum for the chunk
-
-                # Log and send the chunk along with its checksum to the client
-                logging.info(f"Serving chunk {chunk_index} with checksum {checksum} to client.")
-                client_socket.sendall(chunk + b"||" + checksum.encode('utf-8'))  # Send chunk and checksum
-
-            else:
-                # Log a warning and send an empty response if the requested chunk is invalid
-                logging.warning(f"Invalid chunk request for index {chunk_index}.")
-                client_socket.sendall(b'')  # Send an empty response if the index is out of bounds
-
-        # Check if the client is requesting chunk verification (VERIFY_CHUNK)
-        elif request.startswith("VERIFY_CHUNK"):
-            # Extract the chunk index and the checksum received by the client
-            chunk_index, received_checksum = request.split()[1:]
-            chunk_index = int(chunk_index)
-            
-            # Ensure the chunk index is valid (within available chunks)
-            if 0 <= chunk_index < len(file_chunks):
-                chunk = file_chunks[chunk_index]  # Fetch the chunk for verification
-                valid = verify_chunk(chunk, received_checksum)  # Verify the client's checksum
-
-                # If the chunk is not valid (checksum mismatch), retransmit the chunk
-                if not valid:
-                    logging.info(f"Retransmitting chunk {chunk_index} due to checksum mismatch.")
-                    client_socket.sendall(chunk + b"||" + generate_checksum(chunk).encode('utf-8'))  # Resend chunk
-                else:
-                    # If the chunk is valid, notify the client that no retransmission is needed
-                    logging.info(f"Chunk {chunk_index} verified successfully. No retransmission needed.")
-                    client_socket.sendall(b'OK')  # Send 'OK' to indicate success
+        # Close sessions that stay idle for too long so they don't hold a thread forever
+        client_socket.settimeout(idle_timeout)
+        if limiter is not None:
+            session = limiter.open_session(client_socket.getpeername())
+
+        while True:
+            # Receive a complete request frame from the client (None once the client hangs up)
+            request = recv_frame(client_socket)
+            if request is None:
+                break
+
+            # Build the response frame(s) and tag them with the request id so the client can match them
+            start_time = time.monotonic()
+            served_chunks = sent_bytes = 0
+            if request.opcode == OP_HELLO:
+                response, session_compression = handle_hello(request, compression)
+                if limiter is not None:
+                    limiter.identify(session, request.chunk_index)
+                sent_bytes = send_response(client_socket, response, None, request.request_id)
+                record_request(request, start_time, served_chunks, sent_bytes)
+                continue
+
+            chunks, chunk_manifest = resolve_chunks(request, file_chunks, manifest, cache)
+            for response in handle_frame(request, chunks, chunk_manifest):
+                # A peer without an upload slot is told to ask again later
+                if response.opcode == OP_CHUNK and limiter is not None and limiter.choked(session):
+                    response = Frame(OP_CHOKED, response.chunk_index)
+                if session_compression:
+                    response = compress_response(response, chunks, session_compression)
+                if limiter is not None and response.opcode in CHUNK_OPCODES:
+                    limiter.acquire(session, len(response.payload))
+                sent_bytes += send_response(client_socket, response, chunks, request.request_id)
+                served_chunks += response.opcode in CHUNK_OPCODES
+            record_request(request, start_time, served_chunks, sent_bytes)
+
+    except socket.timeout:
+        # The client kept the session idle past the timeout
+        logging.info("Closing idle client session.")
+
+    except ProtocolError as e:
+        # Log malformed requests from the client
+        logging.error("Protocol error: %s", e)
 
     except socket.error as e:
         # Log socket-related errors, such as connection issues
-        logging.error(f"Socket error: {e}")
+        logging.error("Socket error: %s", e)
 
     except Exception as e:
         # Log any other general errors encountered while handling the client request
-        logging.error(f"Error handling client request: {e}")
+        logging.error("Error handling client request: %s", e)
 
     finally:
-        # Close the client connection after the request is handled or if an error occurs
+        # Close the client connection once the session ends or if an error occurs
         client_socket.close()
+        server_sessions.dec()
+        if session is not None:
+            limiter.close_session(session)
 
 # Function to start the server, listen for incoming connections, and serve file chunks
-def start_server(port, file_chunks):
+# (pass the file's manifest to serve its precomputed checksums instead of hashing every request,
+# or pass a ContentStore as file_chunks to serve every file in it).
+# `ready`, if given, is a threading.Event set once the server is accepting connections,
+# `cache`, if given, is a ChunkCache that hot chunks are served from, `compression`
+# limits the compression algorithms clients may ask for (None for any installed one) and
+# `limiter`, if given, is an UploadLimiter shaping what is sent to clients.
+def start_server(port, file_chunks, manifest=None, ready=None, cache=None, compression=None, limiter=None):
     # Create a TCP/IP socket (AF_INET for IPv4, SOCK_STREAM for TCP)
     server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     
@@ -74,23 +281,26 @@ def start_server(port, file_chunks):
         
         # Start listening for incoming client connections (up to 5 pending connections allowed)
         server.listen(5)
-        logging.info(f"Server listening on port {port}...")  # Log that the server is ready to accept connections
+        logging.info("Server listening on port %s...", port)  # Log that the server is ready to accept connections
+        if ready is not None:
+            ready.set()
 
         # Main server loop: keep running and accept client connections
         while True:
             # Accept an incoming connection, returning the client socket and address
             client_socket, addr = server.accept()
-            logging.info(f"Accepted connection from {addr}")  # Log the client's IP address and port
+            logging.info("Accepted connection from %s", addr)  # Log the client's IP address and port
 
-            # Create a new thread to handle the client's request using the handle_client function
-            client_handler = threading.Thread(target=handle_client, args=(client_socket, file_chunks))
+            # Create a new thread to handle the client's session using the handle_client function
+            # (daemon so long-lived sessions don't keep the process alive on exit)
+            client_handler = threading.Thread(target=handle_client, args=(client_socket, file_chunks, IDLE_TIMEOUT, manifest, cache, compression, limiter), daemon=True)
             
-            # Start the client handler thread to handle the client's request
+            # Start the client handler thread to handle the client's requests
             client_handler.start()
 
     except Exception as e:
         # Log any errors that occur during server operation, such as binding issues or connection failures
-        logging.error(f"Server error: {e}")
+        logging.error("Server error: %s", e)
 
     finally:
         # Ensure that the server socket is closed when the server shuts down
@@ -0,0 +1,78 @@
+import asyncio
+import threading
+import unittest
+from async_server import AsyncChunkServer
+from benchmark import free_port, wait_for_port
+from client import ConnectionPool
+from protocol import OP_CHUNK, OP_CHOKED
+from upload_limiter import UploadLimiter
+
+
+# Upload slots, per-peer limits and reciprocation credit for peers that share a host
+class UploadLimiterPeerKeyTest(unittest.TestCase):
+    # Function to open a session from 127.0.0.1 whose client serves chunks on `listen_port`
+    def open_session(self, limiter, source_port, listen_port):
+        session = limiter.open_session(('127.0.0.1', source_port))
+        limiter.identify(session, listen_port)
+        return session
+
+    def test_host_key_counts_one_host_as_one_peer(self):
+        limiter = UploadLimiter(upload_slots=1)
+        first = self.open_session(limiter, 40001, 9001)
+        second = self.open_session(limiter, 40002, 9002)
+        self.assertEqual(first.peer, second.peer)
+        self.assertFalse(limiter.choked(first))
+        self.assertFalse(limiter.choked(second))
+
+    def test_address_key_gives_peers_on_one_host_their_own_slot(self):
+        limiter = UploadLimiter(upload_slots=1, peer_key='address')
+        first = self.open_session(limiter, 40001, 9001)
+        second = self.open_session(limiter, 40002, 9002)
+        self.assertEqual((first.peer, second.peer), ('127.0.0.1:9001', '127.0.0.1:9002'))
+        self.assertEqual(sorted([limiter.choked(first), limiter.choked(second)]), [False, True])
+
+    def test_credit_lands_on_the_peer_we_downloaded_from(self):
+        limiter = UploadLimiter(upload_slots=1, peer_key='address')
+        first = self.open_session(limiter, 40001, 9001)
+        second = self.open_session(limiter, 40002, 9002)
+        limiter.choked(first)
+        limiter.choked(second)
+
+        # The downloader credits the server address it got chunks from, not the client's source port
+        limiter.credit('127.0.0.1:9002', 1 << 20)
+        limiter.next_round = 0.0
+        self.assertTrue(limiter.choked(first))
+        self.assertFalse(limiter.choked(second))
+
+    def test_address_key_gives_peers_on_one_host_their_own_rate(self):
+        limiter = UploadLimiter(peer_rate=1000, peer_key='address')
+        limiter.set_peer_rate(None, '127.0.0.1:9002')
+        first = self.open_session(limiter, 40001, 9001)
+        second = self.open_session(limiter, 40002, 9002)
+        limiter.acquire(first, 5000)
+        limiter.acquire(second, 5000)
+        self.assertIsNotNone(limiter.peer_buckets.get('127.0.0.1:9001'))
+        self.assertIsNone(limiter.peer_buckets.get('127.0.0.1:9002'))
+
+    def test_server_tells_two_clients_on_one_host_apart(self):
+        limiter = UploadLimiter(upload_slots=1, peer_key='address')
+        server = AsyncChunkServer([b'a' * 100, b'b' * 100], limiter=limiter)
+        port = free_port()
+        thread = threading.Thread(target=lambda: asyncio.run(server.serve(port)), daemon=True)
+        thread.start()
+        wait_for_port(port)
+        pools = [ConnectionPool(listen_port=9001), ConnectionPool(listen_port=9002)]
+        try:
+            first = pools[0].get('127.0.0.1', port).get_chunk(0).result(5)
+            second = pools[1].get('127.0.0.1', port).get_chunk(1).result(5)
+            self.assertEqual((first.opcode, second.opcode), (OP_CHUNK, OP_CHOKED))
+            self.assertEqual(limiter.stats()['unchoked'], ['127.0.0.1:9001'])
+        finally:
+            for pool in pools:
+                pool.close_all()
+            server.stop()
+            thread.join(10)
+
+
+if __name__ == '__main__':
+    unittest.main()
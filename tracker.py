@@ -0,0 +1,215 @@
+import time
+import socket
+import struct
+import logging
+import argparse
+import threading
+from client import connection_pool, REQUEST_TIMEOUT
+from protocol import (Frame, ProtocolError, recv_frame, send_frame, pack_file_id, unpack_file_id,
+                      OP_HAVE, OP_ANNOUNCE, OP_GET_PEERS, OP_PEERS, OP_OK, OP_ERROR, OP_HELLO)
+from log_utils import setup_logging
+
+# Set up logging to display info and error messages
+setup_logging()
+
+# Default port the tracker listens on
+TRACKER_PORT = 9000
+
+# Seconds after its last announce before a peer is forgotten
+PEER_TTL = 120
+
+# Listen port that follows the file id in HAVE/ANNOUNCE/GET_PEERS payloads
+PORT_FIELD = struct.Struct('!H')
+
+# Each peer in a PEERS payload: IPv4 address, listen port, bitfield length, then the bitfield
+PEER_ENTRY = struct.Struct('!4sHI')
+
+
+# Function to encode a {"ip:port": bitfield} map as a PEERS payload
+def pack_peers(peers):
+    parts = []
+    for name, bitfield in peers.items():
+        peer_ip, peer_port = name.rsplit(':', 1)
+        parts.append(PEER_ENTRY.pack(socket.inet_aton(peer_ip), int(peer_port), len(bitfield)))
+        parts.append(bytes(bitfield))
+    return b''.join(parts)
+
+
+# Function to decode a PEERS payload into a {"ip:port": bitfield} map
+def unpack_peers(payload):
+    payload = bytes(payload)
+    peers = {}
+    offset = 0
+    while offset < len(payload):
+        raw_ip, peer_port, length = PEER_ENTRY.unpack_from(payload, offset)
+        offset += PEER_ENTRY.size
+        peers[f"{socket.inet_ntoa(raw_ip)}:{peer_port}"] = payload[offset:offset + length]
+        offset += length
+    return peers
+
+
+# Swarm tracker: remembers which peers seed each file and which chunks they have.
+# Peers ANNOUNCE their full bitfield when they start seeding a file and send a HAVE for
+# every chunk they finish afterwards, so downloaders asking for peers (GET_PEERS) also
+# learn about nodes that are still downloading and can already serve part of the file.
+class Tracker:
+    def __init__(self, peer_ttl=PEER_TTL):
+        self.peer_ttl = peer_ttl
+        self.swarms = {}  # Maps file id -> {"ip:port": [bitfield, last_seen]}
+        self._lock = threading.Lock()
+
+    # Function to record a peer's full bitfield for a file
+    def announce(self, file_id, name, bitfield):
+        with self._lock:
+            self.swarms.setdefault(file_id, {})[name] = [bytearray(bitfield), time.monotonic()]
+        logging.info("Peer %s announced %s chunks of %s", name, int.from_bytes(bitfield, 'big').bit_count(), file_id)
+
+    # Function to record that a peer has one more chunk of a file
+    def have(self, file_id, name, chunk_index):
+        with self._lock:
+            entry = self.swarms.get(file_id, {}).get(name)
+            if entry is None:
+                return False
+            bitfield = entry[0]
+            if chunk_index >> 3 >= len(bitfield):
+                bitfield.extend(bytes((chunk_index >> 3) + 1 - len(bitfield)))
+            bitfield[chunk_index >> 3] |= 0x80 >> (chunk_index & 7)
+            entry[1] = time.monotonic()
+            return True
+
+    # Function to list the live peers of a file (other than `exclude`) with their bitfields
+    def peers(self, file_id, exclude=None):
+        now = time.monotonic()
+        with self._lock:
+            swarm = self.swarms.get(file_id, {})
+
+            # Forget peers that stopped announcing
+            for name in [name for name, (_, last_seen) in swarm.items() if now - last_seen > self.peer_ttl]:
+                del swarm[name]
+
+            return {name: bytes(bitfield) for name, (bitfield, _) in swarm.items() if name != exclude}
+
+    # Function to build the response to a tracker request from `remote_ip`
+    def handle_request(self, frame, remote_ip):
+        # Tracker messages are small, so a connection asking for compression gets none
+        if frame.opcode == OP_HELLO:
+            return Frame(OP_HELLO)
+
+        file_id, rest = unpack_file_id(frame.payload)
+
+        # Peers are known by the address they connect from and the port they listen on
+        name = None
+        if len(rest) >= PORT_FIELD.size:
+            name = f"{remote_ip}:{PORT_FIELD.unpack_from(rest)[0]}"
+            rest = rest[PORT_FIELD.size:]
+
+        if frame.opcode == OP_ANNOUNCE and name:
+            self.announce(file_id, name, rest)
+            return Frame(OP_PEERS, payload=pack_peers(self.peers(file_id, exclude=name)))
+
+        if frame.opcode == OP_HAVE and name:
+            if self.have(file_id, name, frame.chunk_index):
+                return Frame(OP_OK, frame.chunk_index)
+            return Frame(OP_ERROR, frame.chunk_index, payload=b'announce first')
+
+        if frame.opcode == OP_GET_PEERS:
+            return Frame(OP_PEERS, payload=pack_peers(self.peers(file_id, exclude=name)))
+
+        return Frame(OP_ERROR, frame.chunk_index, payload=b'unknown tracker request')
+
+
+# Function to handle a client session on the tracker
+def handle_tracker_client(client_socket, addr, tracker):
+    try:
+        while True:
+            request = recv_frame(client_socket)
+            if request is None:
+                break
+            response = tracker.handle_request(request, addr[0])
+            send_frame(client_socket, response.opcode, response.chunk_index, response.payload,
+                       request_id=request.request_id)
+
+    except ProtocolError as e:
+        logging.error("Protocol error from %s: %s", addr, e)
+
+    except socket.error as e:
+        logging.error("Socket error: %s", e)
+
+    finally:
+        client_socket.close()
+
+
+# Function to run the tracker, listening for announces and peer requests
+def start_tracker(port=TRACKER_PORT, tracker=None):
+    tracker = tracker or Tracker()
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+
+    try:
+        server.bind(('0.0.0.0', port))
+        server.listen(128)
+        logging.info("Tracker listening on port %s...", port)
+
+        while True:
+            client_socket, addr = server.accept()
+            threading.Thread(target=handle_tracker_client, args=(client_socket, addr, tracker), daemon=True).start()
+
+    except Exception as e:
+        logging.error("Tracker error: %s", e)
+
+    finally:
+        server.close()
+        logging.info("Tracker has been shut down.")
+
+
+# Client side of the tracker protocol, used by nodes to announce themselves and find peers
+class TrackerClient:
+    def __init__(self, tracker_address, listen_port=None, pool=None):
+        tracker_ip, tracker_port = tracker_address.rsplit(':', 1)
+        self.tracker_ip = tracker_ip
+        self.tracker_port = int(tracker_port)
+        self.listen_port = listen_port  # Our own server port, so the tracker can tell others about us
+        self.pool = pool or connection_pool
+
+    # Function to build the file id + listen port prefix of a request payload
+    def _payload(self, file_id):
+        payload = pack_file_id(file_id)
+        if self.listen_port is not None:
+            payload += PORT_FIELD.pack(self.listen_port)
+        return payload
+
+    # Function to send a request to the tracker and return the response's Future
+    def _request(self, opcode, file_id, chunk_index=0, extra=b''):
+        connection = self.pool.get(self.tracker_ip, self.tracker_port)
+        return connection.request(opcode, chunk_index, self._payload(file_id) + extra)
+
+    # Function to wait for a PEERS response and decode it
+    def _peers_response(self, future):
+        response = future.result(timeout=REQUEST_TIMEOUT)
+        if response.opcode != OP_PEERS:
+            raise ProtocolError(f"Tracker error: {bytes(response.payload).decode(errors='replace')}")
+        return unpack_peers(response.payload)
+
+    # Function to announce every chunk we have of a file; returns the other peers of the file
+    def announce(self, file_id, bitfield):
+        if self.listen_port is None:
+            raise ValueError("A listen port is needed to announce")
+        return self._peers_response(self._request(OP_ANNOUNCE, file_id, extra=bytes(bitfield)))
+
+    # Function to tell the tracker we have another chunk (doesn't wait for the answer)
+    def have(self, file_id, chunk_index):
+        future = self._request(OP_HAVE, file_id, chunk_index)
+        future.add_done_callback(lambda f: f.exception() and logging.error("HAVE to tracker failed: %s", f.exception()))
+
+    # Function to fetch the peers of a file and their bitfields
+    def get_peers(self, file_id):
+        return self._peers_response(self._request(OP_GET_PEERS, file_id))
+
+
+# Entry point for running a tracker on its own
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Run a swarm tracker.")
+    parser.add_argument('--port', type=int, default=TRACKER_PORT, help="port to listen on")
+    parser.add_argument('--peer-ttl', type=int, default=PEER_TTL, help="seconds before a silent peer is forgotten")
+    args = parser.parse_args()
+    start_tracker(args.port, Tracker(args.peer_ttl))
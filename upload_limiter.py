@@ -0,0 +1,327 @@
+import time
+import heapq
+import random
+import asyncio
+import logging
+import itertools
+import threading
+from log_utils import setup_logging
+from metrics import upload_wait_seconds, uploads_choked
+
+setup_logging()
+
+# Seconds of traffic a token bucket saves up while idle and may then send at once
+DEFAULT_BURST_SECONDS = 1.0
+
+# Seconds between choke rounds, when the peers given upload slots are chosen again
+CHOKE_INTERVAL = 10
+
+# Every this many choke rounds the optimistic unchoke moves on to another choked peer
+OPTIMISTIC_UNCHOKE_ROUNDS = 3
+
+# Shortest and longest sleep of a transfer queued behind other sessions (it checks again after each)
+MIN_QUEUE_WAIT = 0.002
+MAX_QUEUE_WAIT = 0.5
+
+
+# Ways the limiter can tell peers apart: by host (every session from one IP address is the same
+# peer) or by address (IP address and listening port, so several nodes on one host are separate peers)
+PEER_KEYS = ('host', 'address')
+
+
+# Function to find the host of a peer ("ip:port" or an (ip, port) address)
+def peer_host(peer):
+    if isinstance(peer, tuple):
+        return peer[0]
+    return peer.rsplit(':', 1)[0]
+
+
+# Function to name a peer ("ip:port" or an (ip, port) address) the way the limiter keys it
+def peer_name(peer, key='host'):
+    if key == 'host':
+        return peer_host(peer)
+    if isinstance(peer, tuple):
+        return f"{peer[0]}:{peer[1]}"
+    return peer
+
+
+# Token bucket filling at `rate` bytes per second, holding at most `burst` bytes (no limit for a rate
+# of None or 0). Taking more than the bucket holds leaves it in debt, so a chunk larger than the
+# burst still goes out whole and whoever comes next waits for the debt to be paid back.
+# Not thread-safe on its own; the UploadLimiter holds its lock while using it.
+class TokenBucket:
+    def __init__(self, rate, burst_seconds=DEFAULT_BURST_SECONDS):
+        self.burst_seconds = burst_seconds
+        self.rate = rate
+        self.tokens = (rate or 0) * burst_seconds
+        self.updated = time.monotonic()
+
+    # Function to change the rate (the bytes saved up so far are kept, up to the new burst size)
+    def set_rate(self, rate, now):
+        self._refill(now)
+        self.rate = rate
+        self.tokens = min(self.tokens, (rate or 0) * self.burst_seconds)
+
+    # Function to add the tokens earned since the last update
+    def _refill(self, now):
+        if self.rate:
+            self.tokens = min(self.rate * self.burst_seconds, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    # Function to return the seconds until the bucket is out of debt (0 if bytes may be sent now)
+    def delay(self, now):
+        self._refill(now)
+        if not self.rate or self.tokens >= 0:
+            return 0
+        return -self.tokens / self.rate
+
+    # Function to take tokens for bytes about to be sent
+    def take(self, byte_count, now):
+        self._refill(now)
+        if self.rate:
+            self.tokens -= byte_count
+
+
+# One client session as the limiter sees it: its client's (ip, port) address, its peer (as the
+# limiter keys it), the virtual time at which its last transfer finishes in the fair queue, and
+# when it last asked for a chunk
+class UploadSession:
+    __slots__ = ('address', 'peer', 'finish', 'last_active')
+
+    def __init__(self, address, peer):
+        self.address = address
+        self.peer = peer
+        self.finish = 0.0
+        self.last_active = time.monotonic()
+
+
+# Upload bandwidth shaping shared by every session of a chunk server.
+#  - `rate` caps the bytes per second sent to all peers together and `peer_rate` those sent to
+#    any one peer, each with a token bucket; None means no limit. Peers are told apart by host or,
+#    with `peer_key='address'`, by host and listening port (see PEER_KEYS and identify()).
+#  - Sessions waiting for the global bucket are served by weighted fair queuing (self-clocked:
+#    each transfer is stamped with the virtual time at which it would finish if every waiting
+#    session got its weighted share, and the smallest stamp goes next), so a session with many
+#    requests in flight can't starve the others. Peers weigh 1 unless set_weight() says otherwise.
+#  - With `upload_slots`, only that many peers are sent chunks at a time (the others are answered
+#    CHOKED). Every CHOKE_INTERVAL seconds the slots go to the peers that recently uploaded the
+#    most to us (see credit()), with one slot kept for an "optimistic unchoke" that rotates among
+#    the rest, so newcomers get a chance to start trading.
+# Every limit can be changed while the server runs.
+class UploadLimiter:
+    def __init__(self, rate=None, peer_rate=None, upload_slots=None, burst_seconds=DEFAULT_BURST_SECONDS,
+                 peer_key='host'):
+        if peer_key not in PEER_KEYS:
+            raise ValueError(f"Unknown peer key {peer_key!r} (expected one of {PEER_KEYS})")
+        self.peer_key = peer_key
+        self.burst_seconds = burst_seconds
+        self.bucket = TokenBucket(rate, burst_seconds)
+        self.peer_rate = peer_rate
+        self.peer_rates = {}  # Maps peer -> rate for peers with their own limit
+        self.peer_buckets = {}  # Maps peer -> TokenBucket
+        self.weights = {}  # Maps peer -> fair queuing weight
+        self.upload_slots = upload_slots
+        self.sessions = set()
+        self.unchoked = set()  # Peers that currently have an upload slot
+        self.optimistic = None  # Peer holding the optimistic unchoke slot
+        self.credits = {}  # Maps peer -> bytes it uploaded to us recently (halved every choke round)
+        self.rounds = 0
+        self.next_round = 0.0
+        self.queue = []  # Heap of (virtual finish time, sequence number) of transfers waiting for the global bucket
+        self.virtual_time = 0.0
+        self._sequence = itertools.count()
+        self._lock = threading.Lock()
+
+    # Function to register a client session from the client's (ip, port) address
+    def open_session(self, address):
+        session = UploadSession(address, peer_name(address, self.peer_key))
+        with self._lock:
+            self.sessions.add(session)
+        return session
+
+    # Function to record the port a session's client listens on (from its HELLO), so that with
+    # peer_key='address' the session counts as the peer we download from at that address
+    # rather than as the connection's ephemeral source port
+    def identify(self, session, listen_port):
+        if listen_port and isinstance(session.address, tuple):
+            with self._lock:
+                session.peer = peer_name((session.address[0], listen_port), self.peer_key)
+
+    # Function to forget a session once its client disconnects
+    def close_session(self, session):
+        with self._lock:
+            self.sessions.discard(session)
+
+    # Function to change the total upload rate (bytes per second, None for no limit)
+    def set_rate(self, rate):
+        with self._lock:
+            self.bucket.set_rate(rate, time.monotonic())
+        logging.info("Upload rate limit set to %s bytes/s.", rate)
+
+    # Function to change the upload rate of every peer, or of one peer (None for no limit)
+    def set_peer_rate(self, rate, peer=None):
+        now = time.monotonic()
+        with self._lock:
+            if peer is None:
+                self.peer_rate = rate
+                peers = [name for name in self.peer_buckets if name not in self.peer_rates]
+            else:
+                name = peer_name(peer, self.peer_key)
+                self.peer_rates[name] = rate
+                peers = [name] if name in self.peer_buckets else []
+            for name in peers:
+                self.peer_buckets[name].set_rate(rate, now)
+        logging.info("Upload rate limit of %s set to %s bytes/s.", peer or "each peer", rate)
+
+    # Function to change the number of peers sent chunks at once (None for every peer)
+    def set_upload_slots(self, upload_slots):
+        with self._lock:
+            self.upload_slots = upload_slots
+            self.next_round = 0.0  # Choose the unchoked peers again straight away
+        logging.info("Upload slots set to %s.", upload_slots)
+
+    # Function to change a peer's share of the upload bandwidth relative to other peers (default 1)
+    def set_weight(self, peer, weight):
+        if weight <= 0:
+            raise ValueError("A fair queuing weight must be positive")
+        with self._lock:
+            self.weights[peer_name(peer, self.peer_key)] = weight
+
+    # Function to record bytes a peer ("ip:port" of its server) uploaded to us, which earns it an
+    # upload slot in later choke rounds
+    def credit(self, peer, byte_count):
+        name = peer_name(peer, self.peer_key)
+        with self._lock:
+            self.credits[name] = self.credits.get(name, 0) + byte_count
+
+    # Function to check whether a session's peer has no upload slot right now
+    def choked(self, session):
+        now = time.monotonic()
+        with self._lock:
+            session.last_active = now
+            if not self.upload_slots:
+                return False
+            if now >= self.next_round:
+                self._choke_round(now)
+            if session.peer in self.unchoked:
+                return False
+            if len(self.unchoked) < self.upload_slots:
+                self.unchoked.add(session.peer)
+                return False
+        uploads_choked.inc()
+        return True
+
+    # Function to give the upload slots to the peers that asked for chunks during the last round
+    # and uploaded the most to us, plus one optimistic unchoke (called with the lock held)
+    def _choke_round(self, now):
+        interested = {session.peer for session in self.sessions if now - session.last_active < CHOKE_INTERVAL}
+        ranked = sorted(interested, key=lambda name: (-self.credits.get(name, 0), random.random()))
+        regular_slots = self.upload_slots - 1 if self.upload_slots > 1 else self.upload_slots
+        unchoked = set(ranked[:regular_slots])
+        others = ranked[regular_slots:]
+        if others and len(unchoked) < self.upload_slots:
+            if self.optimistic not in others or self.rounds % OPTIMISTIC_UNCHOKE_ROUNDS == 0:
+                self.optimistic = random.choice(others)
+            unchoked.add(self.optimistic)
+
+        if unchoked != self.unchoked:
+            logging.debug("Unchoked peers: %s (%s interested).", sorted(unchoked), len(interested))
+        self.unchoked = unchoked
+        self.credits = {name: credit / 2 for name, credit in self.credits.items() if credit >= 2}
+        self.rounds += 1
+        self.next_round = now + CHOKE_INTERVAL
+
+    # Function to return the bucket limiting a peer (None if it has no limit; called with the lock held)
+    def _peer_bucket(self, name):
+        rate = self.peer_rates.get(name, self.peer_rate)
+        bucket = self.peer_buckets.get(name)
+        if bucket is None and rate:
+            bucket = self.peer_buckets[name] = TokenBucket(rate, self.burst_seconds)
+        return bucket
+
+    # Function to step a transfer of `byte_count` bytes through the limits, yielding the seconds
+    # to sleep whenever it has to wait; once it returns, the bytes may be sent
+    def _waits(self, session, byte_count):
+        # First the peer's own limit
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                bucket = self._peer_bucket(session.peer)
+                wait = bucket.delay(now) if bucket is not None else 0
+                if not wait:
+                    if bucket is not None:
+                        bucket.take(byte_count, now)
+                    break
+            yield wait
+
+        # Then the shared limit, in fair queuing order
+        with self._lock:
+            if not self.bucket.rate:
+                return
+            weight = self.weights.get(session.peer, 1)
+            session.finish = max(self.virtual_time, session.finish) + byte_count / weight
+            ticket = (session.finish, next(self._sequence))
+            heapq.heappush(self.queue, ticket)
+
+        granted = False
+        try:
+            while True:
+                with self._lock:
+                    now = time.monotonic()
+                    wait = self.bucket.delay(now)
+                    if self.queue[0] == ticket and not wait:
+                        heapq.heappop(self.queue)
+                        self.bucket.take(byte_count, now)
+                        self.virtual_time = ticket[0]
+                        granted = True
+                        return
+                    if self.queue[0] != ticket:
+                        wait = min(MAX_QUEUE_WAIT, max(wait, MIN_QUEUE_WAIT))
+                yield wait
+        finally:
+            # A transfer given up on (e.g. its session closed) leaves the queue
+            if not granted:
+                with self._lock:
+                    self.queue.remove(ticket)
+                    heapq.heapify(self.queue)
+
+    # Function to wait until `byte_count` bytes may be sent to a session's peer
+    def acquire(self, session, byte_count):
+        started = time.monotonic()
+        waits = self._waits(session, byte_count)
+        try:
+            for wait in waits:
+                time.sleep(wait)
+        finally:
+            waits.close()
+        self._record_wait(started)
+
+    # Function to wait until `byte_count` bytes may be sent, without blocking the event loop
+    async def acquire_async(self, session, byte_count):
+        started = time.monotonic()
+        waits = self._waits(session, byte_count)
+        try:
+            for wait in waits:
+                await asyncio.sleep(wait)
+        finally:
+            waits.close()
+        self._record_wait(started)
+
+    # Function to count the time a transfer was held back
+    def _record_wait(self, started):
+        waited = time.monotonic() - started
+        if waited > MIN_QUEUE_WAIT:
+            upload_wait_seconds.inc(waited)
+
+    # Function to report the current limits and who holds an upload slot (for logs and status displays)
+    def stats(self):
+        with self._lock:
+            return {
+                'rate': self.bucket.rate,
+                'peer_rate': self.peer_rate,
+                'peer_key': self.peer_key,
+                'upload_slots': self.upload_slots,
+                'unchoked': sorted(self.unchoked) if self.upload_slots else None,
+                'sessions': len(self.sessions),
+                'queued': len(self.queue),
+            }